@@ -11,6 +11,17 @@ DEFAULT_EMBEDDING_MODEL = "sentence-transformers/all-mpnet-base-v2"
 DEFAULT_REMOTE_SD_HOST = "127.0.0.1"
 DEFAULT_REMOTE_SD_PORT = 7860
 DEFAULT_CHROMA_PORT = 8000
+# Micro-batching of classify, embeddings, summarize and caption requests
+DEFAULT_BATCH_MAX_SIZE = 8
+DEFAULT_BATCH_MAX_WAIT_MS = 10
+# Number of Coqui TTS voices kept loaded
+DEFAULT_COQUI_CACHE_SIZE = 2
+# Memory for loaded RVC retrieval indexes
+DEFAULT_RVC_INDEX_CACHE_MB = 1024
+# Number of RVC voices kept loaded
+DEFAULT_RVC_CACHE_SIZE = 2
+# Number of RVC conversion requests waiting for the worker before answering 429
+DEFAULT_RVC_QUEUE_SIZE = 8
 SILERO_SAMPLES_PATH = "tts_samples"
 SILERO_SAMPLE_TEXT = "The quick brown fox jumps over the lazy dog"
 DEFAULT_SUMMARIZE_PARAMS = {
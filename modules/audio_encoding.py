@@ -0,0 +1,106 @@
+"""
+Audio output encoding for the voice endpoints of SillyTavern Extras
+
+Voice endpoints (RVC, Coqui TTS, Silero TTS) return uncompressed WAV at the model sample rate
+by default. Clients can ask for a compressed format and/or another sample rate with the
+request parameters `format` and `sample_rate`:
+    - format: "wav" (16 bit PCM, default), "flac", "ogg-opus" or "mp3"
+    - sample_rate: output sample rate in Hz (default: the model sample rate)
+
+Encoding is done in-process with libsndfile (soundfile). Formats that the installed libsndfile
+cannot write (Opus before 1.0.29, MP3 before 1.1.0) are encoded by an ffmpeg subprocess.
+"""
+import io
+import math
+import subprocess
+from typing import Optional, Tuple
+
+import numpy as np
+
+DEBUG_PREFIX = "<Audio encoding>"
+
+FORMATS = {
+    # format: (mimetype, soundfile format, soundfile subtype, ffmpeg arguments)
+    "wav": ("audio/x-wav", "WAV", "PCM_16", ["-f", "wav", "-c:a", "pcm_s16le"]),
+    "flac": ("audio/flac", "FLAC", "PCM_16", ["-f", "flac"]),
+    "ogg-opus": ("audio/ogg", "OGG", "OPUS", ["-f", "ogg", "-c:a", "libopus", "-b:a", "64k"]),
+    "mp3": ("audio/mpeg", "MP3", "MPEG_LAYER_III", ["-f", "mp3", "-c:a", "libmp3lame", "-q:a", "4"]),
+}
+OPUS_SAMPLE_RATES = [8000, 12000, 16000, 24000, 48000]
+
+
+def read_options(parameters) -> Tuple[str, Optional[int]]:
+    """Return the `(format, sample_rate)` requested in `parameters` (dict). Raise ValueError if invalid."""
+    audio_format = parameters.get("format") or "wav"
+    if audio_format not in FORMATS:
+        raise ValueError("Unknown audio format %s, expected one of %s" % (audio_format, ", ".join(FORMATS)))
+    sample_rate = parameters.get("sample_rate")
+    if sample_rate is not None and sample_rate != "":
+        sample_rate = int(sample_rate)
+        if not 8000 <= sample_rate <= 192000:
+            raise ValueError("Invalid sample rate %d" % sample_rate)
+    else:
+        sample_rate = None
+    return audio_format, sample_rate
+
+
+def mimetype(audio_format: str) -> str:
+    return FORMATS[audio_format][0]
+
+
+def resample(audio: np.ndarray, sr: int, target_sr: int) -> np.ndarray:
+    if sr == target_sr:
+        return audio
+    from scipy import signal
+
+    gcd = math.gcd(sr, target_sr)
+    return signal.resample_poly(audio, target_sr // gcd, sr // gcd, axis=0)
+
+
+def _encode_ffmpeg(audio: np.ndarray, sr: int, audio_format: str) -> bytes:
+    channels = 1 if audio.ndim == 1 else audio.shape[1]
+    result = subprocess.run(
+        ["ffmpeg", "-nostdin", "-loglevel", "error", "-f", "f32le", "-ar", str(sr), "-ac", str(channels), "-i", "pipe:0"]
+        + FORMATS[audio_format][3] + ["pipe:1"],
+        input=audio.astype("<f4").tobytes(), capture_output=True, check=True)
+    return result.stdout
+
+
+def encode(audio: np.ndarray, sr: int, audio_format: str = "wav", sample_rate: Optional[int] = None) -> bytes:
+    """Encode `audio` (float in [-1, 1] or int16, mono or samples x channels) at `sr` Hz."""
+    import soundfile
+
+    if audio.dtype == np.int16:
+        audio = audio.astype(np.float32) / 32768
+    audio = np.clip(np.asarray(audio, dtype=np.float32), -1, 1)
+    target_sr = sample_rate or sr
+    if audio_format == "ogg-opus" and target_sr not in OPUS_SAMPLE_RATES:
+        target_sr = 48000  # Opus only encodes these rates
+    audio = resample(audio, sr, target_sr).astype(np.float32)
+
+    _, sf_format, sf_subtype, _ = FORMATS[audio_format]
+    buffer = io.BytesIO()
+    try:
+        soundfile.write(buffer, audio, target_sr, format=sf_format, subtype=sf_subtype)
+        return buffer.getvalue()
+    except (ValueError, TypeError, RuntimeError) as e:
+        print(DEBUG_PREFIX, "libsndfile cannot write", audio_format, "(%s), using ffmpeg" % e)
+    return _encode_ffmpeg(audio, target_sr, audio_format)
+
+
+def encode_file(audio_file, audio_format: str = "wav", sample_rate: Optional[int] = None) -> bytes:
+    """Re-encode an audio file (path, file object or bytes). WAV files that need no change are returned as is."""
+    import soundfile
+
+    if isinstance(audio_file, (bytes, bytearray)):
+        audio_file = io.BytesIO(audio_file)
+    if audio_format == "wav" and sample_rate is None:
+        if isinstance(audio_file, str):
+            with open(audio_file, "rb") as f:
+                return f.read()
+        audio_file.seek(0)
+        return audio_file.read()
+    if not isinstance(audio_file, str):
+        audio_file.seek(0)
+    audio, sr = soundfile.read(audio_file, dtype="float32")
+    return encode(audio, sr, audio_format, sample_rate)
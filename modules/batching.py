@@ -0,0 +1,133 @@
+"""
+Micro-batching scheduler for SillyTavern Extras
+
+Collects requests for the same model that arrive within a short time window and runs them
+through the model as a single batched forward pass. Each caller blocks until its own result
+is ready, so endpoint code stays synchronous.
+
+Usage:
+    batcher = MicroBatcher("classify", lambda texts: pipe(texts), max_batch_size=8, max_wait=0.01)
+    result = batcher.submit(text)
+"""
+from concurrent.futures import Future
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+DEBUG_PREFIX = "<Batching>"
+
+# name -> MicroBatcher, for the stats endpoint
+batchers = {}
+
+
+class MicroBatcher:
+    """Run `process_batch` over groups of items submitted from many threads.
+
+    `process_batch`: function taking a list of items and returning a list of results, in the same order.
+    `max_batch_size`: upper limit on the number of items in one batch. 1 disables batching.
+    `max_wait`: seconds to keep collecting after the first item of a batch arrives.
+
+    If a batch fails, its items are retried one at a time, so that a single bad input
+    only fails its own caller.
+    """
+
+    def __init__(self, name: str, process_batch: Callable[[List[Any]], List[Any]],
+                 max_batch_size: int = 8, max_wait: float = 0.01) -> None:
+        self.name = name
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait)
+
+        self._pending = []  # [(item, future), ...]
+        self._condition = threading.Condition()
+
+        # Statistics
+        self._stats_lock = threading.Lock()
+        self.total_items = 0
+        self.total_batches = 0
+        self.largest_batch = 0
+        self.batch_size_histogram = {}  # batch size -> count
+        self.total_batch_time = 0.0
+
+        self._worker = threading.Thread(target=self._run, name=f"batcher-{name}", daemon=True)
+        self._worker.start()
+
+        batchers[name] = self
+
+    def submit(self, item: Any) -> Any:
+        """Queue `item` for processing and block until its result is available."""
+        future = Future()
+        with self._condition:
+            self._pending.append((item, future))
+            self._condition.notify()
+        return future.result()
+
+    def queue_depth(self) -> int:
+        with self._condition:
+            return len(self._pending)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            average_batch_size = self.total_items / self.total_batches if self.total_batches else 0.0
+            average_batch_time = self.total_batch_time / self.total_batches if self.total_batches else 0.0
+            return {"queue_depth": self.queue_depth(),
+                    "max_batch_size": self.max_batch_size,
+                    "max_wait": self.max_wait,
+                    "total_items": self.total_items,
+                    "total_batches": self.total_batches,
+                    "average_batch_size": average_batch_size,
+                    "largest_batch": self.largest_batch,
+                    "average_batch_time": average_batch_time,
+                    "batch_size_histogram": dict(sorted(self.batch_size_histogram.items()))}
+
+    def _collect(self) -> List[Any]:
+        """Wait for the first item, then keep collecting until the batch is full or the window closes."""
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+            deadline = time.monotonic() + self.max_wait
+            while len(self._pending) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = self._pending[:self.max_batch_size]
+            del self._pending[:self.max_batch_size]
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            items = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+
+            time_start = time.monotonic()
+            try:
+                results = self.process_batch(items)
+                if len(results) != len(items):
+                    raise RuntimeError(f"batch function returned {len(results)} results for {len(items)} items")
+                for future, result in zip(futures, results):
+                    future.set_result(result)
+            except Exception as e:
+                if len(items) == 1:
+                    futures[0].set_exception(e)
+                else:
+                    print(DEBUG_PREFIX, self.name, "batch of", len(items), "failed, retrying items one by one:", e)
+                    for item, future in zip(items, futures):
+                        try:
+                            future.set_result(self.process_batch([item])[0])
+                        except Exception as item_e:
+                            future.set_exception(item_e)
+            elapsed = time.monotonic() - time_start
+
+            with self._stats_lock:
+                self.total_items += len(items)
+                self.total_batches += 1
+                self.largest_batch = max(self.largest_batch, len(items))
+                self.batch_size_histogram[len(items)] = self.batch_size_histogram.get(len(items), 0) + 1
+                self.total_batch_time += elapsed
+
+
+def get_stats() -> Dict[str, Dict[str, Any]]:
+    """Return statistics of all batchers, keyed by name."""
+    return {name: batcher.stats() for name, batcher in batchers.items()}
@@ -11,31 +11,74 @@ References:
     - https://huggingface.co/tasks/text-classification
 """
 
+from collections import OrderedDict
+import hashlib
+import threading
+
 from transformers import pipeline
 
+from modules.batching import MicroBatcher
+from modules.model_manager import model_registry
+
 DEBUG_PREFIX = "<Classify module>"
+EMOTION_CACHE_SIZE = 1024  # classification results kept, by text hash
 
 # Models init
 
-text_emotion_pipe = None
+text_emotion_batcher = None
+
+# Memoized results, so that a text classified by /api/classify is not classified again
+# by another module (RVC emotion routing...): text hash -> scores, least recently used first
+emotion_cache = OrderedDict()
+emotion_cache_lock = threading.Lock()
+
+def init_text_emotion_classifier(model_name: str, device: str, torch_dtype: str, max_batch_size: int = 8, max_wait: float = 0.01) -> None:
+    global text_emotion_batcher
+
+    print(DEBUG_PREFIX,"Registering text classification pipeline with model",model_name)
+    model_registry.register("classify",
+                            lambda: pipeline(
+                                "text-classification",
+                                model=model_name,
+                                top_k=None,
+                                device=device,
+                                torch_dtype=torch_dtype,
+                            ),
+                            device=device)
+    text_emotion_batcher = MicroBatcher("classify", classify_text_emotions, max_batch_size=max_batch_size, max_wait=max_wait)
 
-def init_text_emotion_classifier(model_name: str, device: str, torch_dtype: str) -> None:
-    global text_emotion_pipe
 
-    print(DEBUG_PREFIX,"Initializing text classification pipeline with model",model_name)
-    text_emotion_pipe = pipeline(
-            "text-classification",
-            model=model_name,
-            top_k=None,
-            device=device,
-            torch_dtype=torch_dtype,
+def classify_text_emotions(texts: list) -> list:
+    """Classify several texts in one forward pass. Return one sorted score list per text."""
+    with model_registry.use("classify") as text_emotion_pipe:
+        outputs = text_emotion_pipe(
+            texts,
+            truncation=True,
+            max_length=text_emotion_pipe.model.config.max_position_embeddings,
+            batch_size=len(texts),
         )
+    return [sorted(output, key=lambda x: x["score"], reverse=True) for output in outputs]
+
+
+def _text_key(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
 
 
 def classify_text_emotion(text: str) -> list:
-    output = text_emotion_pipe(
-        text,
-        truncation=True,
-        max_length=text_emotion_pipe.model.config.max_position_embeddings,
-    )[0]
-    return sorted(output, key=lambda x: x["score"], reverse=True)
+    text = text.strip()  # classify exactly the text the memo is keyed on
+    key = _text_key(text)
+    with emotion_cache_lock:
+        if key in emotion_cache:
+            emotion_cache.move_to_end(key)
+            return [dict(score) for score in emotion_cache[key]]
+
+    if text_emotion_batcher is None:
+        scores = classify_text_emotions([text])[0]
+    else:
+        scores = text_emotion_batcher.submit(text)
+
+    with emotion_cache_lock:
+        emotion_cache[key] = scores
+        while len(emotion_cache) > EMOTION_CACHE_SIZE:
+            emotion_cache.popitem(last=False)
+    return [dict(score) for score in scores]
@@ -0,0 +1,124 @@
+"""
+Bounded job queues for SillyTavern Extras
+
+Runs the jobs of a device (or any other resource) one at a time on a dedicated worker thread,
+instead of on the threads of the Flask server. Jobs wait in a queue of bounded depth; when it is
+full, `submit` raises `QueueFull` right away so the endpoint can answer 429 instead of piling up
+requests whose clients will time out.
+
+Usage:
+    queue = get_queue("rvc:cuda:0", max_depth=8)
+    result = queue.submit(convert, audio, parameters)  # blocks until done, or raises QueueFull
+"""
+from concurrent.futures import Future
+import itertools
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+DEBUG_PREFIX = "<Job queue>"
+
+# name -> JobQueue, for the stats endpoints
+queues = {}
+queues_lock = threading.Lock()
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    """Run the submitted functions in order on `workers` threads, with at most `max_depth` jobs waiting."""
+
+    def __init__(self, name: str, max_depth: int = 8, workers: int = 1) -> None:
+        self.name = name
+        self.max_depth = max(1, max_depth)
+        self._queue = queue.Queue(maxsize=self.max_depth)
+        self._job_ids = itertools.count(1)
+
+        # Statistics
+        self._stats_lock = threading.Lock()
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_wait_time = 0.0
+        self.total_run_time = 0.0
+
+        for i in range(max(1, workers)):
+            threading.Thread(target=self._run, name=f"jobs-{name}-{i}", daemon=True).start()
+
+    def submit(self, function: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run `function(*args, **kwargs)` on the worker and return its result. Raise QueueFull if the queue is full."""
+        future = Future()
+        try:
+            self._queue.put_nowait((function, args, kwargs, future, time.monotonic()))
+        except queue.Full:
+            with self._stats_lock:
+                self.rejected += 1
+            raise QueueFull(f"{self.name}: {self.max_depth} jobs already waiting")
+        return future.result()
+
+    def submit_wait(self, function: Callable[..., Any], *args, **kwargs) -> Any:
+        """Like `submit`, but when the queue is full, wait for a free place instead of raising QueueFull.
+
+        For the later jobs of work already accepted (e.g. the next block of a stream), which must not be dropped.
+        """
+        future = Future()
+        self._queue.put((function, args, kwargs, future, time.monotonic()))
+        return future.result()
+
+    def full(self) -> bool:
+        return self._queue.full()
+
+    def next_job_id(self) -> int:
+        """A unique number, for per-job file names."""
+        return next(self._job_ids)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            finished = self.completed + self.failed
+            return {"queue_depth": self._queue.qsize(),
+                    "max_depth": self.max_depth,
+                    "running": self.running,
+                    "completed": self.completed,
+                    "failed": self.failed,
+                    "rejected": self.rejected,
+                    "average_wait_time": self.total_wait_time / finished if finished else 0.0,
+                    "average_run_time": self.total_run_time / finished if finished else 0.0}
+
+    def _run(self) -> None:
+        while True:
+            function, args, kwargs, future, submit_time = self._queue.get()
+            start_time = time.monotonic()
+            with self._stats_lock:
+                self.running += 1
+            failed = False
+            try:
+                future.set_result(function(*args, **kwargs))
+            except Exception as e:
+                failed = True
+                future.set_exception(e)
+            end_time = time.monotonic()
+            with self._stats_lock:
+                self.running -= 1
+                if failed:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+                self.total_wait_time += start_time - submit_time
+                self.total_run_time += end_time - start_time
+
+
+def get_queue(name: str, max_depth: Optional[int] = None, workers: int = 1) -> JobQueue:
+    """Return the queue `name`, creating it (with `max_depth`, default 8) on first use."""
+    with queues_lock:
+        if name not in queues:
+            queues[name] = JobQueue(name, max_depth if max_depth is not None else 8, workers)
+        return queues[name]
+
+
+def get_stats() -> Dict[str, Dict[str, Any]]:
+    """Return statistics of all queues, keyed by name."""
+    return {name: job_queue.stats() for name, job_queue in queues.items()}
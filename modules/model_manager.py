@@ -0,0 +1,362 @@
+"""
+Model lifecycle manager for SillyTavern Extras
+
+A central registry through which modules load their models. Models are loaded on first use,
+their approximate memory footprint is tracked, and they are unloaded again when:
+    - a configurable RAM or VRAM budget is exceeded (least recently used models go first)
+    - they have not been used for longer than a configurable idle TTL
+
+Usage:
+    model_registry.register("summarize", lambda: pipeline(...), device="cuda:0")
+    with model_registry.use("summarize") as summarization_pipeline:
+        summarization_pipeline(text)
+
+Models that are in use (inside a `use` block) are never unloaded.
+
+Models can also be put in a named group (e.g. all Coqui voices) whose number of loaded
+models or total size is capped separately with `set_group_limit`.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+import gc
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import torch
+
+DEBUG_PREFIX = "<Model manager>"
+
+MB = 1024 * 1024
+
+
+def estimate_size(model: Any) -> int:
+    """Approximate memory footprint in bytes of the parameters and buffers reachable from `model`."""
+    seen = set()
+
+    def module_size(module: torch.nn.Module) -> int:
+        total = 0
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            if tensor.data_ptr() in seen:
+                continue
+            seen.add(tensor.data_ptr())
+            total += tensor.numel() * tensor.element_size()
+        return total
+
+    def size_of(obj: Any, depth: int = 0) -> int:
+        if depth > 3 or obj is None:
+            return 0
+        if isinstance(obj, torch.nn.Module):
+            return module_size(obj)
+        if isinstance(obj, torch.Tensor):
+            return obj.numel() * obj.element_size()
+        if isinstance(obj, np.ndarray):
+            return obj.nbytes
+        if isinstance(obj, (list, tuple)):
+            return sum(size_of(x, depth + 1) for x in obj)
+        if isinstance(obj, dict):
+            return sum(size_of(x, depth + 1) for x in obj.values())
+        if isinstance(getattr(obj, "nbytes", None), int):  # objects reporting their own size
+            return obj.nbytes
+        if hasattr(obj, "components") and isinstance(obj.components, dict):  # diffusers pipeline
+            return size_of(obj.components, depth + 1)
+        if hasattr(obj, "model"):  # transformers pipeline, Coqui TTS...
+            return size_of(obj.model, depth + 1)
+        return 0
+
+    return size_of(model)
+
+
+def is_vram(device: Any) -> bool:
+    return str(device).startswith("cuda")
+
+
+def free_memory() -> None:
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class ModelEntry:
+    def __init__(self, key: str, loader: Callable[[], Any], unloader: Optional[Callable[[Any], None]],
+                 device: Any, pinned: bool, group: Optional[str] = None) -> None:
+        self.key = key
+        self.loader = loader
+        self.unloader = unloader
+        self.device = str(device)
+        self.pinned = pinned
+        self.group = group
+
+        self.model = None
+        self.size_bytes = 0
+        self.in_use = 0
+        self.load_count = 0
+        self.last_used = None
+        self.load_time = None
+        self.lock = threading.Lock()  # serializes loading/unloading of this model
+        self.retired_key = None  # set when unregistered while in use; see `ModelRegistry.unregister`
+
+    @property
+    def loaded(self) -> bool:
+        return self.model is not None
+
+    def info(self) -> Dict[str, Any]:
+        return {"key": self.key,
+                "device": self.device,
+                "group": self.group,
+                "loaded": self.loaded,
+                "pinned": self.pinned,
+                "retired": self.retired_key is not None,
+                "in_use": self.in_use,
+                "size_mb": round(self.size_bytes / MB, 1),
+                "load_count": self.load_count,
+                "load_time": self.load_time,
+                "idle_seconds": round(time.time() - self.last_used, 1) if self.last_used is not None else None}
+
+
+class ModelRegistry:
+    def __init__(self) -> None:
+        self._entries = OrderedDict()  # key -> ModelEntry, in least recently used order
+        self._lock = threading.RLock()
+        self.ram_budget = None  # bytes, None = unlimited
+        self.vram_budget = None
+        self.idle_ttl = None  # seconds, None = never unload idle models
+        self.group_limits = {}  # group -> (max_models, max_bytes), None = unlimited
+        self._reaper_thread = None
+
+    def configure(self, ram_budget_mb: Optional[float] = None, vram_budget_mb: Optional[float] = None,
+                  idle_ttl: Optional[float] = None) -> None:
+        self.ram_budget = int(ram_budget_mb * MB) if ram_budget_mb else None
+        self.vram_budget = int(vram_budget_mb * MB) if vram_budget_mb else None
+        self.idle_ttl = idle_ttl if idle_ttl else None
+        if self.idle_ttl is not None and self._reaper_thread is None:
+            self._reaper_thread = threading.Thread(target=self._reap_idle_models, name="model-reaper", daemon=True)
+            self._reaper_thread.start()
+
+    def set_group_limit(self, group: str, max_models: Optional[int] = None, max_mb: Optional[float] = None) -> None:
+        """Cap the number of loaded models and/or their total size in the group `group`."""
+        with self._lock:
+            self.group_limits[group] = (max_models if max_models else None,
+                                        int(max_mb * MB) if max_mb else None)
+
+    # --------------------------------------------------------------------------------
+    # Registration and access
+
+    def register(self, key: str, loader: Callable[[], Any], unloader: Optional[Callable[[Any], None]] = None,
+                 device: Any = "cpu", pinned: bool = False, group: Optional[str] = None) -> None:
+        """Declare how to load the model `key`. Nothing is loaded until the model is first used.
+
+        `unloader`: optional cleanup called with the model when it is unloaded.
+        `pinned`: pinned models are never unloaded automatically.
+        `group`: optional group name, see `set_group_limit`.
+        """
+        with self._lock:
+            if key in self._entries:
+                entry = self._entries[key]
+                entry.loader, entry.unloader, entry.device, entry.pinned, entry.group = loader, unloader, str(device), pinned, group
+            else:
+                self._entries[key] = ModelEntry(key, loader, unloader, device, pinned, group)
+
+    def is_registered(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def is_loaded(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries and self._entries[key].loaded
+
+    def get(self, key: str, loader: Optional[Callable[[], Any]] = None, **register_kwargs) -> Any:
+        """Return the model `key`, loading it first if needed.
+
+        If the key is not registered yet and `loader` is given, register it on the fly
+        (`register_kwargs` are passed to `register`).
+
+        The returned model is not protected from unloading; to run the model, use `use` instead.
+        """
+        with self.use(key, loader, **register_kwargs) as model:
+            return model
+
+    @contextmanager
+    def use(self, key: str, loader: Optional[Callable[[], Any]] = None, **register_kwargs):
+        """Context manager yielding the model `key`. The model is not unloaded while the block runs."""
+        with self._lock:
+            if key not in self._entries:
+                if loader is None:
+                    raise KeyError(f"model '{key}' is not registered")
+                self._entries[key] = ModelEntry(key, loader, register_kwargs.get("unloader"),
+                                                register_kwargs.get("device", "cpu"), register_kwargs.get("pinned", False),
+                                                register_kwargs.get("group"))
+            entry = self._entries[key]
+            entry.in_use += 1
+            entry.last_used = time.time()
+            self._entries.move_to_end(key)
+
+        try:
+            with entry.lock:
+                if not entry.loaded:
+                    self._load(entry)
+                model = entry.model
+            yield model
+        finally:
+            with self._lock:
+                entry.in_use -= 1
+                entry.last_used = time.time()
+                release = entry.retired_key is not None and not entry.in_use
+                if release:
+                    self._entries.pop(entry.retired_key, None)
+            if release:  # the last user of an unregistered model is done with it
+                self._unload(entry)
+
+    def unload(self, key: str) -> bool:
+        """Unload the model `key` (if loaded and not in use). Return whether it was unloaded."""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return False
+        return self._unload(entry)
+
+    def unregister(self, key: str) -> None:
+        """Unload the model `key` and forget it, so that the key can be registered again.
+
+        A model still in use is retired instead: it keeps counting toward the memory budget
+        (listed under a separate key), and is unloaded when its last `use` block ends.
+        """
+        self.unload(key)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return
+            if entry.in_use:
+                entry.retired_key = "%s (retired %x)" % (key, id(entry))
+                self._entries[entry.retired_key] = entry
+                print(DEBUG_PREFIX, "Model", key, "is in use; unloading it when released")
+                return
+        self._unload(entry)  # not in use any more (it may have been released since `unload` above)
+
+    def preload(self) -> None:
+        """Load all registered models now, e.g. at startup."""
+        with self._lock:
+            keys = list(self._entries.keys())
+        for key in keys:
+            self.get(key)
+
+    # --------------------------------------------------------------------------------
+    # Statistics
+
+    def loaded_models(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = [entry.info() for entry in reversed(self._entries.values())]  # most recently used first
+            ram_used = sum(entry.size_bytes for entry in self._entries.values() if entry.loaded and not is_vram(entry.device))
+            vram_used = sum(entry.size_bytes for entry in self._entries.values() if entry.loaded and is_vram(entry.device))
+        return {"models": entries,
+                "ram_used_mb": round(ram_used / MB, 1),
+                "vram_used_mb": round(vram_used / MB, 1),
+                "ram_budget_mb": round(self.ram_budget / MB, 1) if self.ram_budget else None,
+                "vram_budget_mb": round(self.vram_budget / MB, 1) if self.vram_budget else None,
+                "idle_ttl": self.idle_ttl}
+
+    # --------------------------------------------------------------------------------
+    # Internals
+
+    def _load(self, entry: ModelEntry) -> None:
+        """Load `entry`. Called with `entry.lock` held."""
+        print(DEBUG_PREFIX, "Loading model", entry.key, "on", entry.device)
+        vram = is_vram(entry.device) and torch.cuda.is_available()
+        vram_before = torch.cuda.memory_allocated() if vram else 0
+        time_start = time.time()
+
+        model = entry.loader()
+
+        entry.load_time = round(time.time() - time_start, 3)
+        size = estimate_size(model)
+        if size == 0 and vram:
+            size = max(0, torch.cuda.memory_allocated() - vram_before)
+        entry.model = model
+        entry.size_bytes = size
+        entry.load_count += 1
+        print(DEBUG_PREFIX, "Loaded", entry.key, f"({size / MB:.1f} MB) in {entry.load_time}s")
+
+        if entry.group is not None:
+            self._enforce_group_limit(entry.group, keep=entry)
+        self._enforce_budget(is_vram(entry.device), keep=entry)
+
+    def _unload(self, entry: ModelEntry) -> bool:
+        with self._lock:
+            # A model being loaded is in use, so this also avoids waiting for `entry.lock` held by its loader
+            # (which may itself be evicting other models).
+            if not entry.loaded or entry.in_use:
+                return False
+        with entry.lock:
+            # `use` counts itself in under `self._lock` before taking `entry.lock`, so checking `in_use` and
+            # detaching the model under both locks means no `use` block can get hold of a model being unloaded.
+            with self._lock:
+                if not entry.loaded or entry.in_use:
+                    return False
+                model = entry.model
+                entry.model = None
+                entry.size_bytes = 0
+            print(DEBUG_PREFIX, "Unloading model", entry.key)
+            if entry.unloader is not None:  # before a new `use` can load the model again
+                try:
+                    entry.unloader(model)
+                except Exception as e:
+                    print(DEBUG_PREFIX, "WARNING: unloader of", entry.key, "failed:", e)
+        del model
+        free_memory()
+        return True
+
+    def _enforce_budget(self, vram: bool, keep: Optional[ModelEntry] = None) -> None:
+        """Unload least recently used models until the RAM or VRAM budget is respected."""
+        budget = self.vram_budget if vram else self.ram_budget
+        if budget is None:
+            return
+        while True:
+            with self._lock:
+                loaded = [entry for entry in self._entries.values() if entry.loaded and is_vram(entry.device) == vram]
+                used = sum(entry.size_bytes for entry in loaded)
+                if used <= budget:
+                    return
+                candidates = [entry for entry in loaded if entry is not keep and not entry.pinned and not entry.in_use]
+            if not candidates:
+                print(DEBUG_PREFIX, f"WARNING: {'VRAM' if vram else 'RAM'} budget of {budget / MB:.0f} MB exceeded "
+                                    f"({used / MB:.0f} MB used) but no model can be unloaded")
+                return
+            print(DEBUG_PREFIX, f"{'VRAM' if vram else 'RAM'} budget exceeded, evicting least recently used model", candidates[0].key)
+            self._unload(candidates[0])
+
+    def _enforce_group_limit(self, group: str, keep: Optional[ModelEntry] = None) -> None:
+        """Unload least recently used models of `group` until its count and size limits are respected."""
+        max_models, max_bytes = self.group_limits.get(group, (None, None))
+        if max_models is None and max_bytes is None:
+            return
+        while True:
+            with self._lock:
+                loaded = [entry for entry in self._entries.values() if entry.loaded and entry.group == group]
+                used = sum(entry.size_bytes for entry in loaded)
+                if (max_models is None or len(loaded) <= max_models) and (max_bytes is None or used <= max_bytes):
+                    return
+                candidates = [entry for entry in loaded if entry is not keep and not entry.pinned and not entry.in_use]
+            if not candidates:
+                print(DEBUG_PREFIX, f"WARNING: limit of group {group} exceeded ({len(loaded)} models, {used / MB:.0f} MB) "
+                                    "but no model can be unloaded")
+                return
+            print(DEBUG_PREFIX, f"Limit of group {group} exceeded, evicting least recently used model", candidates[0].key)
+            self._unload(candidates[0])
+
+    def _idle_models(self) -> List[ModelEntry]:
+        now = time.time()
+        with self._lock:
+            return [entry for entry in self._entries.values()
+                    if entry.loaded and not entry.pinned and not entry.in_use
+                    and entry.last_used is not None and now - entry.last_used > self.idle_ttl]
+
+    def _reap_idle_models(self) -> None:
+        while True:
+            time.sleep(max(1.0, min(self.idle_ttl / 2, 30.0)))
+            for entry in self._idle_models():
+                print(DEBUG_PREFIX, "Model", entry.key, "idle for more than", self.idle_ttl, "seconds")
+                self._unload(entry)
+
+
+model_registry = ModelRegistry()
@@ -12,16 +12,22 @@ References:
         - Coqui TTS https://tts.readthedocs.io/en/latest/
         - Audio-webui: https://github.com/gitmylo/audio-webui
 """
+from contextlib import contextmanager
 import json
 import os
 import io
 import shutil
+import threading
 
-from flask import abort, request, send_file, jsonify
+import numpy as np
+
+from flask import abort, request, send_file, jsonify, Response
 
 from TTS.api import TTS
 from TTS.utils.manage import ModelManager
 
+from modules import audio_encoding
+from modules.model_manager import model_registry
 from modules.utils import silence_log
 
 DEBUG_PREFIX = "<Coqui-TTS module>"
@@ -29,27 +35,62 @@ COQUI_MODELS_PATH = "data/models/coqui/"
 IGNORED_FILES = [".placeholder"]
 COQUI_LOCAL_MODEL_FILE_NAME = "model.pth"
 COQUI_LOCAL_CONFIG_FILE_NAME = "config.json"
+TTS_CACHE_GROUP = "coqui"
+WARMUP_TEXT = "this is a test message"
 
 gpu_mode = False
 is_downloading = False
 
+# One lock per cached TTS instance, a TTS object cannot synthesize two texts at the same time
+tts_locks = {}
+tts_locks_lock = threading.Lock()
+
+def set_cache_limit(max_models=None, max_mb=None):
+    """
+    Limit how many TTS instances (and/or how many MB of them) stay loaded, least recently used ones are unloaded first
+    """
+    model_registry.set_group_limit(TTS_CACHE_GROUP, max_models=max_models, max_mb=max_mb)
+
+def _tts_key(model_name=None, model_folder=None):
+    model = model_name if model_name is not None else "local/"+model_folder
+    return "coqui:%s:%s" % (model, "gpu" if gpu_mode else "cpu")
+
+@contextmanager
+def use_tts(model_name=None, model_folder=None):
+    """
+    Yield the cached TTS instance of a coqui-api model id or of a local model folder, constructing it on first use.
+    Only one request at a time uses a given instance.
+    """
+    if model_name is not None:
+        loader = lambda: TTS(model_name=model_name, progress_bar=True, gpu=gpu_mode)
+    else:
+        model_path = os.path.join(COQUI_MODELS_PATH,model_folder,COQUI_LOCAL_MODEL_FILE_NAME)
+        config_path = os.path.join(COQUI_MODELS_PATH,model_folder,COQUI_LOCAL_CONFIG_FILE_NAME)
+        loader = lambda: TTS(model_path=model_path, config_path=config_path, progress_bar=True, gpu=gpu_mode)
+
+    key = _tts_key(model_name, model_folder)
+    with tts_locks_lock:
+        lock = tts_locks.setdefault(key, threading.Lock())
+
+    with model_registry.use(key, loader, device="cuda" if gpu_mode else "cpu", group=TTS_CACHE_GROUP) as tts:
+        with lock:
+            yield tts
+
+def warm_up(tts):
+    """
+    Run a short synthesis so that the first real request does not pay for lazy initializations
+    """
+    speaker_id = tts.speakers[0] if tts.is_multi_speaker else None
+    language_id = tts.languages[0] if tts.is_multi_lingual else None
+    tts.tts_to_file(text=WARMUP_TEXT, file_path=io.BytesIO(), speaker=speaker_id, language=language_id)
+
 def install_model(model_id):
     global gpu_mode
-    audio_buffer = io.BytesIO()
-    speaker_id = None
-    language_id = None
     
     print(DEBUG_PREFIX,"Loading model",model_id)
     try:
-        tts = TTS(model_name=model_id, progress_bar=True, gpu=gpu_mode)
-
-        if tts.is_multi_lingual:
-            language_id = tts.languages[0]
-
-        if tts.is_multi_speaker:
-            speaker_id =tts.speakers[0]
-
-        tts.tts_to_file(text="this is a test message", file_path=audio_buffer, speaker=speaker_id, language=language_id)
+        with use_tts(model_name=model_id) as tts:
+            warm_up(tts)
     except Exception as e:
         print(DEBUG_PREFIX,"ERROR:", e)
         print("Model", model_id, "cannot be loaded, maybe wrong model name? Must be one of")
@@ -150,8 +191,9 @@ def coqui_install_model():
                     abort(500, DEBUG_PREFIX + "Bad request, model already installed.")
 
                 is_downloading = True
-                TTS(model_name=model_id, progress_bar=True, gpu=gpu_mode)
-                is_downloading = False
+                with use_tts(model_name=model_id) as tts:
+                    is_downloading = False
+                    warm_up(tts)
 
             if action == "repare":
                 if not model_installed:
@@ -159,11 +201,14 @@ def coqui_install_model():
 
 
                 print(DEBUG_PREFIX,"Deleting corrupted model folder:",model_path)
+                model_registry.unregister(_tts_key(model_id))
                 shutil.rmtree(model_path, ignore_errors=True)
 
-        is_downloading = True
-        TTS(model_name=model_id, progress_bar=True, gpu=gpu_mode)
-        is_downloading = False
+        is_downloading = not model_registry.is_loaded(_tts_key(model_id))
+        with use_tts(model_name=model_id) as tts:
+            if is_downloading:
+                is_downloading = False
+                warm_up(tts)
 
         response = json.dumps({"status":"done"})
         return response
@@ -230,7 +275,9 @@ def coqui_generate_tts():
             "text": text,
             "model_id": voiceId,
             "language_id": language,
-            "speaker_id": speaker
+            "speaker_id": speaker,
+            "format": "wav" (optional: wav, flac, ogg-opus or mp3),
+            "sample_rate": int (optional)
         }
 
         - model_id formats:
@@ -256,6 +303,11 @@ def coqui_generate_tts():
             print(DEBUG_PREFIX,"Rejected, currently downloading a model, cannot perform TTS")
             abort(500, DEBUG_PREFIX + " Requested TTS while downloading a model")
         
+        try:
+            audio_format, sample_rate = audio_encoding.read_options(request_json)
+        except ValueError as e:
+            return Response(DEBUG_PREFIX + " " + str(e), status=400)
+
         text = request_json["text"]
         model_name = request_json["model_id"]
         language_id = None
@@ -264,7 +316,7 @@ def coqui_generate_tts():
         # Local model
         model_type = model_name.split("/")[0]
         if model_type == "local":
-            return generate_tts_local(model_name.split("/")[1], text)
+            return generate_tts_local(model_name.split("/")[1], text, audio_format, sample_rate)
 
 
         if request_json["language_id"] != "none":
@@ -275,26 +327,27 @@ def coqui_generate_tts():
 
         print(DEBUG_PREFIX,"Loading tts \n- model", model_name, "\n - speaker_id: ",speaker_id,"\n - language_id: ",language_id, "\n - using",("GPU" if gpu_mode else "CPU"))
 
-        is_downloading = True
-        tts = TTS(model_name=model_name, progress_bar=True, gpu=gpu_mode)
-        is_downloading = False
+        is_downloading = not model_registry.is_loaded(_tts_key(model_name))
+        with use_tts(model_name=model_name) as tts:
+            is_downloading = False
 
-        if tts.is_multi_lingual:
-            if language_id is None:
-                abort(400, DEBUG_PREFIX + " Requested model "+model_name+" is multi-lingual but no language id provided")
-            language_id = tts.languages[int(language_id)]
+            if tts.is_multi_lingual:
+                if language_id is None:
+                    abort(400, DEBUG_PREFIX + " Requested model "+model_name+" is multi-lingual but no language id provided")
+                language_id = tts.languages[int(language_id)]
 
-        if tts.is_multi_speaker:
-            if speaker_id is None:
-                abort(400, DEBUG_PREFIX + " Requested model "+model_name+" is multi-speaker but no speaker id provided")
-            speaker_id =tts.speakers[int(speaker_id)]
+            if tts.is_multi_speaker:
+                if speaker_id is None:
+                    abort(400, DEBUG_PREFIX + " Requested model "+model_name+" is multi-speaker but no speaker id provided")
+                speaker_id =tts.speakers[int(speaker_id)]
 
-        tts.tts_to_file(text=text, file_path=audio_buffer, speaker=speaker_id, language=language_id)
+            tts.tts_to_file(text=text, file_path=audio_buffer, speaker=speaker_id, language=language_id)
 
         print(DEBUG_PREFIX, "Success, saved to",audio_buffer)
         
         # Return the output_audio_path object as a response
-        response = send_file(audio_buffer, mimetype="audio/x-wav")
+        output_audio = audio_encoding.encode_file(audio_buffer, audio_format, sample_rate)
+        response = send_file(io.BytesIO(output_audio), mimetype=audio_encoding.mimetype(audio_format))
         audio_buffer = io.BytesIO()
         
         return response
@@ -303,7 +356,7 @@ def coqui_generate_tts():
         print(e)
         abort(500, DEBUG_PREFIX + " Exception occurs while trying to process request "+str(request_json))
 
-def generate_tts_local(model_folder, text):
+def generate_tts_local(model_folder, text, audio_format="wav", sample_rate=None):
     """
     Generate tts using local coqui model
     """
@@ -321,13 +374,46 @@ def generate_tts_local(model_folder, text):
         raise ValueError("File does not exists:",config_path)
 
     print(DEBUG_PREFIX,"Loading local tts model", model_path,"using",("GPU" if gpu_mode else "CPU"))
-    tts = TTS(model_path=model_path, config_path=config_path, progress_bar=True, gpu=gpu_mode)
-    tts.tts_to_file(text=text, file_path=audio_buffer)
+    with use_tts(model_folder=model_folder) as tts:
+        tts.tts_to_file(text=text, file_path=audio_buffer)
 
     print(DEBUG_PREFIX, "Success, saved to",audio_buffer)
         
     # Return the output_audio_path object as a response
-    response = send_file(audio_buffer, mimetype="audio/x-wav")
+    output_audio = audio_encoding.encode_file(audio_buffer, audio_format, sample_rate)
+    response = send_file(io.BytesIO(output_audio), mimetype=audio_encoding.mimetype(audio_format))
     audio_buffer = io.BytesIO()
     
-    return response
\ No newline at end of file
+    return response
+
+
+def synthesize(request_json):
+    """
+    Synthesize a request of coqui_generate_tts in memory, for the chained TTS to RVC endpoint.
+    Return (sample rate, float32 waveform).
+    """
+    text = request_json["text"]
+    model_name = request_json["model_id"]
+
+    if model_name.split("/")[0] == "local":
+        with use_tts(model_folder=model_name.split("/")[1]) as tts:
+            wav = tts.tts(text=text)
+            sample_rate = tts.synthesizer.output_sample_rate
+        return sample_rate, np.asarray(wav, dtype=np.float32)
+
+    language_id = request_json.get("language_id", "none")
+    speaker_id = request_json.get("speaker_id", "none")
+    with use_tts(model_name=model_name) as tts:
+        language = None
+        speaker = None
+        if tts.is_multi_lingual:
+            if language_id == "none":
+                raise ValueError("Requested model "+model_name+" is multi-lingual but no language id provided")
+            language = tts.languages[int(language_id)]
+        if tts.is_multi_speaker:
+            if speaker_id == "none":
+                raise ValueError("Requested model "+model_name+" is multi-speaker but no speaker id provided")
+            speaker = tts.speakers[int(speaker_id)]
+        wav = tts.tts(text=text, speaker=speaker, language=language)
+        sample_rate = tts.synthesizer.output_sample_rate
+    return sample_rate, np.asarray(wav, dtype=np.float32)
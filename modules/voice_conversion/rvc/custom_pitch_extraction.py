@@ -1,5 +1,7 @@
-import gc
+from concurrent.futures import ThreadPoolExecutor
 import os.path
+import threading
+from time import time as ttime
 
 import numpy as np
 import parselmouth
@@ -9,6 +11,73 @@ import torchcrepe
 from scipy import signal
 from torch import Tensor
 
+from modules.model_manager import model_registry
+
+RMVPE_MODEL_PATH = os.path.join('data', 'models', 'rmvpe')
+
+crepe_lock = threading.Lock()  # torchcrepe keeps its current model in module globals
+
+
+def _load_crepe_model(device, model):
+    with crepe_lock:
+        torchcrepe.load.model(device, model)
+        return torchcrepe.infer.model
+
+
+def _unload_crepe_model(crepe_model):
+    with crepe_lock:
+        if getattr(torchcrepe.infer, "model", None) is crepe_model:
+            del torchcrepe.infer.model
+            del torchcrepe.infer.capacity
+
+
+def crepe_predict(audio, sr, hop_length, f0_min, f0_max, model, batch_size, device):
+    """
+    torchcrepe.predict, without reloading the crepe weights from disk.
+
+    torchcrepe holds a single model and reloads it whenever the requested capacity changes,
+    so the loaded model of each capacity/device is kept in the model manager and swapped in.
+    """
+    key = "torchcrepe:%s:%s" % (model, device)
+    with model_registry.use(key, lambda: _load_crepe_model(device, model), unloader=_unload_crepe_model, device=device) as crepe_model:
+        with crepe_lock:
+            torchcrepe.infer.model = crepe_model
+            torchcrepe.infer.capacity = model
+            return torchcrepe.predict(
+                audio,
+                sr,
+                hop_length,
+                f0_min,
+                f0_max,
+                model,
+                batch_size=batch_size,
+                device=device,
+                pad=True
+            )
+
+
+def _load_rmvpe_model(device, is_half):
+    rmvpe_model_file = os.path.join(RMVPE_MODEL_PATH, 'rmvpe.pt')
+    if not os.path.isfile(rmvpe_model_file):
+        import huggingface_hub
+        rmvpe_model_file = huggingface_hub.hf_hub_download('lj1995/VoiceConversionWebUI', 'rmvpe.pt', local_dir=RMVPE_MODEL_PATH, local_dir_use_symlinks=False)
+
+    from modules.voice_conversion.rvc.rmvpe import RMVPE
+    print("loading rmvpe model")
+    return RMVPE(rmvpe_model_file, is_half=is_half, device=device)
+
+
+def use_rmvpe(device=None, is_half=True):
+    """
+    Context manager yielding the RMVPE model for `device`, loaded once and then kept by the model manager.
+    Half precision is only used on CUDA.
+    """
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    is_half = is_half and str(device).startswith("cuda")
+    key = "rmvpe:%s:%s" % (device, "half" if is_half else "float")
+    return model_registry.use(key, lambda: _load_rmvpe_model(device, is_half), device=device)
+
 
 def get_f0_crepe_computation(
         x,
@@ -29,7 +98,7 @@ def get_f0_crepe_computation(
         audio = torch.mean(audio, dim=0, keepdim=True).detach()
     audio = audio.detach()
     # print("Initiating prediction with a crepe_hop_length of: " + str(hop_length))
-    pitch: torch.Tensor = torchcrepe.predict(
+    pitch: torch.Tensor = crepe_predict(
         audio,
         sr,
         hop_length,
@@ -38,7 +107,6 @@ def get_f0_crepe_computation(
         model,
         batch_size=hop_length * 2,
         device=torch_device,
-        pad=True
     )
     p_len = p_len or x.shape[0] // hop_length
     # Resize the pitch for final f0
@@ -76,7 +144,7 @@ def get_mangio_crepe_f0(x, f0_min, f0_max, p_len, sr, crepe_hop_length, model='f
     #     str(crepe_hop_length)
     # )
     # Pitch prediction for pitch extraction
-    pitch: Tensor = torchcrepe.predict(
+    pitch: Tensor = crepe_predict(
         audio,
         sr,
         crepe_hop_length,
@@ -85,7 +153,6 @@ def get_mangio_crepe_f0(x, f0_min, f0_max, p_len, sr, crepe_hop_length, model='f
         model,
         batch_size=crepe_hop_length * 2,
         device=torch_device,
-        pad=True
     )
     p_len = p_len or x.shape[0] // crepe_hop_length
     # Resize the pitch
@@ -99,67 +166,173 @@ def get_mangio_crepe_f0(x, f0_min, f0_max, p_len, sr, crepe_hop_length, model='f
     return np.nan_to_num(target)
 
 
-def pitch_extract(f0_method, x, f0_min, f0_max, p_len, time_step, sr, window, crepe_hop_length, filter_radius=3):
-    f0s = []
+HARVEST_SEGMENT_SECONDS = 15  # harvest over longer audio is split into segments of this length
+HARVEST_OVERLAP_SECONDS = 1  # extra audio analysed on each side of a segment
+
+# Threads, not processes: forking the multithreaded server copies held locks and breaks CUDA in the
+# children, and spawn would re-run the server script in every worker. pyworld and parselmouth do their
+# work in native code without the GIL, so threads still run them in parallel.
+CPU_POOL_MAX_WORKERS = 4
+
+cpu_pool = None  # threads for pyworld/parselmouth, created on first use
+device_pool = None  # single thread running the crepe/rmvpe models
+pools_lock = threading.Lock()
+
+
+def get_pools():
+    global cpu_pool, device_pool
+    with pools_lock:
+        if cpu_pool is None:
+            cpu_pool = ThreadPoolExecutor(max_workers=min(CPU_POOL_MAX_WORKERS, os.cpu_count() or 1), thread_name_prefix="f0-cpu")
+            device_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="f0-device")
+        return cpu_pool, device_pool
+
+
+def f0_pm(x, f0_min, f0_max, p_len, time_step, sr):
+    f0 = (
+        parselmouth.Sound(x, sr)
+        .to_pitch_ac(
+            time_step=time_step / 1000,
+            voicing_threshold=0.6,
+            pitch_floor=f0_min,
+            pitch_ceiling=f0_max,
+        )
+        .selected_array["frequency"]
+    )
+    pad_size = (p_len - len(f0) + 1) // 2
+    if pad_size > 0 or p_len - len(f0) - pad_size > 0:
+        f0 = np.pad(
+            f0, [[pad_size, p_len - len(f0) - pad_size]], mode="constant"
+        )
+    return f0
+
+
+def f0_world(method, x, f0_min, f0_max, sr):
+    if method == 'harvest':
+        f0, t = pyworld.harvest(
+            x.astype(np.double),
+            fs=sr,
+            f0_ceil=f0_max,
+            f0_floor=f0_min,
+            frame_period=10,
+        )
+    elif method == "dio":
+        f0, t = pyworld.dio(
+            x.astype(np.double),
+            fs=sr,
+            f0_ceil=f0_max,
+            f0_floor=f0_min,
+            frame_period=10,
+        )
+    return pyworld.stonemask(x.astype(np.double), f0, t, sr)
+
+
+def harvest_segments(x, sr):
+    """
+    Cut `x` into overlapping segments for parallel harvest.
+    Return [(start sample, end sample, first frame kept, frames kept)], with 10 ms frames.
+    """
+    hop = sr // 100
+    n_frames = int(len(x) / sr * 100) + 1  # frames of harvest over the whole audio
+    segment_frames = HARVEST_SEGMENT_SECONDS * 100
+    overlap = HARVEST_OVERLAP_SECONDS * sr
+    segments = []
+    for first_frame in range(0, n_frames, segment_frames):
+        frames = min(segment_frames, n_frames - first_frame)
+        start = max(0, first_frame * hop - overlap)
+        end = min(len(x), (first_frame + frames) * hop + overlap)
+        segments.append((start, end, first_frame, frames))
+    return segments
+
+
+class SegmentedHarvest:
+    """Harvest over overlapping segments of `x` computed in parallel in `pool`, stitched back by `result`."""
+
+    def __init__(self, pool, x, f0_min, f0_max, sr):
+        self.time_start = ttime()
+        self.sr = sr
+        self.segments = harvest_segments(x, sr)
+        self.futures = [pool.submit(f0_world, "harvest", x[start:end], f0_min, f0_max, sr) for start, end, _, _ in self.segments]
+
+    def result(self):
+        """Return the f0 of the whole audio and the time it took."""
+        f0 = stitch_harvest(self.segments, self.futures, self.sr)
+        return f0, ttime() - self.time_start
+
+
+def stitch_harvest(segments, futures, sr):
+    f0 = np.zeros(segments[-1][2] + segments[-1][3])
+    for (start, _, first_frame, frames), future in zip(segments, futures):
+        f0_segment = future.result()
+        offset = first_frame - start // (sr // 100)
+        f0_segment = f0_segment[offset : offset + frames]
+        f0[first_frame : first_frame + len(f0_segment)] = f0_segment
+    return f0
+
+
+def f0_device(method, x, f0_min, f0_max, p_len, sr, crepe_hop_length, device, is_half):
+    if method == "torchcrepe":
+        return get_f0_crepe_computation(x, f0_min, f0_max, p_len, sr, crepe_hop_length)
+    elif method == "torchcrepe tiny":
+        return get_f0_crepe_computation(x, f0_min, f0_max, p_len, sr, crepe_hop_length, "tiny")
+    elif method == "mangio-crepe":
+        return get_mangio_crepe_f0(x, f0_min, f0_max, p_len, sr, crepe_hop_length)
+    elif method == "mangio-crepe tiny":
+        return get_mangio_crepe_f0(x, f0_min, f0_max, p_len, sr, crepe_hop_length, 'tiny')
+    elif method == "rmvpe":
+        with use_rmvpe(device, is_half) as model_rmvpe:
+            return model_rmvpe.infer_from_audio(x, thred=0.03)
+    return None
+
+
+def timed(function, *args):
+    """Run `function(*args)`, return its result and duration."""
+    time_start = ttime()
+    result = function(*args)
+    return result, ttime() - time_start
+
+
+def pitch_extract(f0_method, x, f0_min, f0_max, p_len, time_step, sr, window, crepe_hop_length, filter_radius=3, device=None, is_half=True, timings=None):
+    """
+    f0 of `x`, the median of the given method(s).
+    Several methods run concurrently: pm/harvest/dio in worker threads, crepe/rmvpe in one thread
+    driving the device. Harvest over long audio is split into overlapping segments computed in parallel.
+    The duration of each method is stored in `timings` (dict) if given.
+    """
+    methods = f0_method if isinstance(f0_method, list) else [f0_method]
     f0 = np.zeros(p_len)
-    for method in f0_method if isinstance(f0_method, list) else [f0_method]:
+    if timings is None:
+        timings = {}
+
+    long_harvest = "harvest" in methods and len(x) > (HARVEST_SEGMENT_SECONDS + HARVEST_OVERLAP_SECONDS) * sr
+    if len(methods) == 1 and not long_harvest:  # nothing to parallelize
+        method = methods[0]
         if method == "pm":
-            f0 = (
-                parselmouth.Sound(x, sr)
-                .to_pitch_ac(
-                    time_step=time_step / 1000,
-                    voicing_threshold=0.6,
-                    pitch_floor=f0_min,
-                    pitch_ceiling=f0_max,
-                )
-                .selected_array["frequency"]
-            )
-            pad_size = (p_len - len(f0) + 1) // 2
-            if pad_size > 0 or p_len - len(f0) - pad_size > 0:
-                f0 = np.pad(
-                    f0, [[pad_size, p_len - len(f0) - pad_size]], mode="constant"
-                )
-        elif method in ['harvest', 'dio']:
-            if method == 'harvest':
-                f0, t = pyworld.harvest(
-                    x.astype(np.double),
-                    fs=sr,
-                    f0_ceil=f0_max,
-                    f0_floor=f0_min,
-                    frame_period=10,
-                )
-            elif method == "dio":
-                f0, t = pyworld.dio(
-                    x.astype(np.double),
-                    fs=sr,
-                    f0_ceil=f0_max,
-                    f0_floor=f0_min,
-                    frame_period=10,
-                )
-            f0 = pyworld.stonemask(x.astype(np.double), f0, t, sr)
-        elif method == "torchcrepe":
-            f0 = get_f0_crepe_computation(x, f0_min, f0_max, p_len, sr, crepe_hop_length)
-        elif method == "torchcrepe tiny":
-            f0 = get_f0_crepe_computation(x, f0_min, f0_max, p_len, sr, crepe_hop_length, "tiny")
-        elif method == "mangio-crepe":
-            f0 = get_mangio_crepe_f0(x, f0_min, f0_max, p_len, sr, crepe_hop_length)
-        elif method == "mangio-crepe tiny":
-            f0 = get_mangio_crepe_f0(x, f0_min, f0_max, p_len, sr, crepe_hop_length, 'tiny')
-        elif method == "rmvpe":
-            rmvpe_model_path = os.path.join('data', 'models', 'rmvpe')
-            rmvpe_model_file = os.path.join(rmvpe_model_path, 'rmvpe.pt')
-            if not os.path.isfile(rmvpe_model_file):
-                import huggingface_hub
-                rmvpe_model_file = huggingface_hub.hf_hub_download('lj1995/VoiceConversionWebUI', 'rmvpe.pt', local_dir=rmvpe_model_path, local_dir_use_symlinks=False)
-
-            from modules.voice_conversion.rvc.rmvpe import RMVPE
-            print("loading rmvpe model")
-            model_rmvpe = RMVPE(rmvpe_model_file, is_half=True, device=None)
-            f0 = model_rmvpe.infer_from_audio(x, thred=0.03)
-            del model_rmvpe
-            torch.cuda.empty_cache()
-            gc.collect()
-        f0s.append(f0)
+            result, timings[method] = timed(f0_pm, x, f0_min, f0_max, p_len, time_step, sr)
+        elif method in ["harvest", "dio"]:
+            result, timings[method] = timed(f0_world, method, x, f0_min, f0_max, sr)
+        else:
+            result, timings[method] = timed(f0_device, method, x, f0_min, f0_max, p_len, sr, crepe_hop_length, device, is_half)
+        f0s = [result] if result is not None else []
+    else:
+        cpu, device_thread = get_pools()
+        futures = {}
+        for method in methods:
+            if method == "pm":
+                futures[method] = cpu.submit(timed, f0_pm, x, f0_min, f0_max, p_len, time_step, sr)
+            elif method == "harvest" and long_harvest:
+                futures[method] = SegmentedHarvest(cpu, x, f0_min, f0_max, sr)
+            elif method in ["harvest", "dio"]:
+                futures[method] = cpu.submit(timed, f0_world, method, x, f0_min, f0_max, sr)
+            else:
+                futures[method] = device_thread.submit(timed, f0_device, method, x, f0_min, f0_max, p_len, sr, crepe_hop_length, device, is_half)
+        f0s = []
+        for method in methods:
+            result, timings[method] = futures[method].result()
+            if result is not None:
+                f0s.append(result)
+
+    print("f0 extraction times:", ", ".join("%s: %.3fs" % (method, duration) for method, duration in timings.items()))
 
     if not f0s:
         f0s = [f0]
@@ -168,11 +341,10 @@ def pitch_extract(f0_method, x, f0_min, f0_max, p_len, time_step, sr, window, cr
     for f0_val in f0s:
         _len = f0_val.shape[0]
         if _len == p_len:
-            f0s_new.append(f0)
+            f0s_new.append(f0_val)
             continue
         if _len > p_len:
-            f0 = f0[:p_len]
-            f0s_new.append(f0)
+            f0s_new.append(f0_val[:p_len])
             continue
         if _len < p_len:
             print('WARNING: len < p_len, skipping this f0')
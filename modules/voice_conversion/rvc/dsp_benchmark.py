@@ -0,0 +1,154 @@
+"""
+Check and benchmark of the vectorized RVC DSP stages against their original loop implementations:
+    - split point search of VC.pipeline (split_points)
+    - RMS envelope mixing (change_rms)
+    - RMVPE salience decoding (RMVPE.to_local_average_cents)
+and of the batched HuBERT features of VC.vc_batch (HubertFeatureModel.extract_features_batch) against
+the features of each segment alone, as VC.vc computes them.
+
+Usage (from the repository root):
+    python -m modules.voice_conversion.rvc.dsp_benchmark
+"""
+from time import perf_counter
+from types import SimpleNamespace
+
+import librosa
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from modules.voice_conversion.rvc.hubert.lean_hubert import DEFAULT_CONFIG, HubertFeatureModel
+from modules.voice_conversion.rvc.rmvpe import RMVPE
+from modules.voice_conversion.rvc.vc_infer_pipeline import change_rms, split_points
+
+
+# --------------------------------------------------------------------------------
+# Original implementations, kept as reference
+
+def split_points_reference(audio, window, t_center, t_query):
+    audio_pad = np.pad(audio, (window // 2, window // 2), mode="reflect")
+    opt_ts = []
+    audio_sum = np.zeros_like(audio)
+    for i in range(window):
+        audio_sum += audio_pad[i : i - window]
+    for t in range(t_center, audio.shape[0], t_center):
+        opt_ts.append(
+            t
+            - t_query
+            + np.where(
+                np.abs(audio_sum[t - t_query : t + t_query])
+                == np.abs(audio_sum[t - t_query : t + t_query]).min()
+            )[0][0]
+        )
+    return opt_ts
+
+
+def change_rms_reference(data1, sr1, data2, sr2, rate):
+    rms1 = librosa.feature.rms(
+        y=data1, frame_length=sr1 // 2 * 2, hop_length=sr1 // 2
+    )
+    rms2 = librosa.feature.rms(y=data2, frame_length=sr2 // 2 * 2, hop_length=sr2 // 2)
+    rms1 = torch.from_numpy(rms1)
+    rms1 = F.interpolate(
+        rms1.unsqueeze(0), size=data2.shape[0], mode="linear"
+    ).squeeze()
+    rms2 = torch.from_numpy(rms2)
+    rms2 = F.interpolate(
+        rms2.unsqueeze(0), size=data2.shape[0], mode="linear"
+    ).squeeze()
+    rms2 = torch.max(rms2, torch.zeros_like(rms2) + 1e-6)
+    data2 *= (
+        torch.pow(rms1, torch.tensor(1 - rate))
+        * torch.pow(rms2, torch.tensor(rate - 1))
+    ).numpy()
+    return data2
+
+
+def to_local_average_cents_reference(cents_mapping, salience, thred=0.05):
+    center = np.argmax(salience, axis=1)
+    salience = np.pad(salience, ((0, 0), (4, 4)))
+    center += 4
+    todo_salience = []
+    todo_cents_mapping = []
+    starts = center - 4
+    ends = center + 5
+    for idx in range(salience.shape[0]):
+        todo_salience.append(salience[:, starts[idx]:ends[idx]][idx])
+        todo_cents_mapping.append(cents_mapping[starts[idx]:ends[idx]])
+    todo_salience = np.array(todo_salience)
+    todo_cents_mapping = np.array(todo_cents_mapping)
+    product_sum = np.sum(todo_salience * todo_cents_mapping, 1)
+    weight_sum = np.sum(todo_salience, 1)
+    devided = product_sum / weight_sum
+    maxx = np.max(salience, axis=1)
+    devided[maxx <= thred] = 0
+    return devided
+
+
+# --------------------------------------------------------------------------------
+
+def timed(function, *args, repeat=3):
+    """Return the result of `function(*args)` and its best time in ms over `repeat` runs."""
+    best = float("inf")
+    for _ in range(repeat):
+        time_start = perf_counter()
+        result = function(*args)
+        best = min(best, perf_counter() - time_start)
+    return result, best * 1000
+
+
+def report(name, reference_ms, vectorized_ms, error):
+    print(f"{name:<24} reference {reference_ms:9.2f} ms   vectorized {vectorized_ms:9.2f} ms   "
+          f"speedup x{reference_ms / vectorized_ms:6.1f}   max abs error {error:.3g}")
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    seconds = 60
+    sr = 16000
+    tgt_sr = 40000
+    audio = rng.standard_normal(sr * seconds) * 0.1
+    audio *= np.sin(np.linspace(0, 40 * np.pi, audio.shape[0])) ** 2  # speech-like pauses
+    converted = (rng.standard_normal(tgt_sr * seconds) * 0.1).astype(np.float32)
+
+    # Split points, with the default Config values of a 6 GB GPU (x_query=10, x_center=60)
+    window, t_query, t_center = 160, sr * 10, sr * 60
+    for length in (seconds * sr * 2, seconds * sr * 3 + 12345):
+        signal_in = np.resize(audio, length)
+        expected, reference_ms = timed(split_points_reference, signal_in, window, t_center, t_query)
+        actual, vectorized_ms = timed(split_points, signal_in, window, t_center, t_query)
+        assert [int(t) for t in actual] == [int(t) for t in expected], (actual, expected)
+        report(f"split_points ({length // sr}s)", reference_ms, vectorized_ms, 0)
+
+    for rate in (0.0, 0.25, 1.0):
+        expected, reference_ms = timed(lambda: change_rms_reference(audio, sr, converted.copy(), tgt_sr, rate))
+        actual, vectorized_ms = timed(lambda: change_rms(audio, sr, converted.copy(), tgt_sr, rate))
+        error = np.abs(actual - expected).max()
+        assert np.allclose(actual, expected, rtol=1e-4, atol=1e-6), error
+        report(f"change_rms (rate {rate})", reference_ms, vectorized_ms, error)
+
+    frames = sr * seconds // 160
+    salience = rng.random((frames, 360)).astype(np.float32) ** 8
+    salience[::7] *= 0.01  # unvoiced frames
+    rmvpe = SimpleNamespace(cents_mapping=np.pad(20 * np.arange(360) + 1997.3794084376191, (4, 4)))
+    expected, reference_ms = timed(to_local_average_cents_reference, rmvpe.cents_mapping, salience, 0.03)
+    actual, vectorized_ms = timed(RMVPE.to_local_average_cents, rmvpe, salience, 0.03)
+    error = np.abs(actual - expected).max()
+    assert np.allclose(actual, expected), error
+    report("to_local_average_cents", reference_ms, vectorized_ms, error)
+
+    # HuBERT features of segments of different lengths, as batched by VC.vc_batch (randomly initialized model)
+    torch.manual_seed(0)
+    hubert = HubertFeatureModel(dict(DEFAULT_CONFIG, encoder_layers=4)).eval()
+    segments = [torch.from_numpy(np.resize(audio, length).astype(np.float32)) for length in (sr * 8, sr * 5 + 777, sr * 2 + 123)]
+    with torch.no_grad():
+        def features_one_by_one():
+            return [hubert.extract_features(segment.unsqueeze(0), output_layer=4)[0][0] for segment in segments]
+        expected, reference_ms = timed(features_one_by_one, repeat=1)
+        (batched, lengths), vectorized_ms = timed(lambda: hubert.extract_features_batch(segments, output_layer=4), repeat=1)
+    assert lengths == [features.shape[0] for features in expected], lengths
+    error = max(float((batched[i, :length] - expected[i]).abs().max()) for i, length in enumerate(lengths))
+    assert error < 1e-4, error
+    report("hubert batch features", reference_ms, vectorized_ms, error)
+
+    print("All vectorized outputs match the reference implementations.")
@@ -0,0 +1,360 @@
+"""
+Lean HuBERT feature extractor for RVC
+
+Loading HuBERT with `fairseq.checkpoint_utils.load_model_ensemble_and_task` imports the whole
+vendored fairseq tree and builds a pretraining task to get one model. This module builds only
+what RVC uses, the feature extractor (`extract_features` and `final_proj`), from the config and
+state dict of the fairseq checkpoint, with the same parameter names and the same outputs.
+Weight norm of the positional convolution is folded into its weight at load time, and the
+attention calls the q/k/v projection modules, so int8 quantization of the Linear layers applies.
+
+The checkpoint can be converted once to safetensors (loaded with mmap, without unpickling):
+    python -m modules.voice_conversion.rvc.hubert.lean_hubert data/models/hubert/hubert_rvc.pt
+`load_hubert` then uses "<name>.safetensors" when it exists next to the checkpoint.
+"""
+import json
+import os
+import pickle
+import sys
+import types
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+DEBUG_PREFIX = "<HuBERT>"
+
+# Defaults of fairseq's HubertConfig, for the values a checkpoint config may omit
+DEFAULT_CONFIG = {
+    "extractor_mode": "default",
+    "conv_feature_layers": "[(512,10,5)] + [(512,3,2)] * 4 + [(512,2,2)] * 2",
+    "conv_bias": False,
+    "encoder_layers": 12,
+    "encoder_embed_dim": 768,
+    "encoder_ffn_embed_dim": 3072,
+    "encoder_attention_heads": 12,
+    "activation_fn": "gelu",
+    "layer_type": "transformer",
+    "layer_norm_first": False,
+    "conv_pos": 128,
+    "conv_pos_groups": 16,
+    "pos_conv_depth": 1,
+    "final_dim": 0,
+    "required_seq_len_multiple": 2,
+}
+# Pretraining parameters of the checkpoint, not used for feature extraction
+TRAINING_KEYS = ("mask_emb", "label_embs_concat")
+
+
+def gelu(x: torch.Tensor) -> torch.Tensor:
+    return F.gelu(x.float()).type_as(x)
+
+
+class TransposeLast(nn.Module):
+    def forward(self, x):
+        return x.transpose(-2, -1)
+
+
+class Fp32GroupNorm(nn.GroupNorm):
+    def forward(self, x):
+        return F.group_norm(x.float(), self.num_groups, self.weight.float(), self.bias.float(), self.eps).type_as(x)
+
+
+class Fp32LayerNorm(nn.LayerNorm):
+    def forward(self, x):
+        return F.layer_norm(x.float(), self.normalized_shape, self.weight.float(), self.bias.float(), self.eps).type_as(x)
+
+
+class SamePad(nn.Module):
+    def __init__(self, kernel_size: int) -> None:
+        super().__init__()
+        self.remove = 1 if kernel_size % 2 == 0 else 0
+
+    def forward(self, x):
+        return x[:, :, : -self.remove] if self.remove > 0 else x
+
+
+class ConvFeatureExtractor(nn.Module):
+    def __init__(self, conv_layers, mode: str, conv_bias: bool) -> None:
+        super().__init__()
+        self.conv_layers = nn.ModuleList()
+        in_d = 1
+        for i, (dim, k, stride) in enumerate(conv_layers):
+            conv = nn.Conv1d(in_d, dim, k, stride=stride, bias=conv_bias)
+            if mode == "layer_norm":
+                block = nn.Sequential(conv, nn.Identity(), nn.Sequential(TransposeLast(), Fp32LayerNorm(dim), TransposeLast()), nn.GELU())
+            elif i == 0:
+                block = nn.Sequential(conv, nn.Identity(), Fp32GroupNorm(dim, dim), nn.GELU())
+            else:
+                block = nn.Sequential(conv, nn.Identity(), nn.GELU())
+            self.conv_layers.append(block)
+            in_d = dim
+
+    def forward(self, x):
+        x = x.unsqueeze(1)
+        for conv in self.conv_layers:
+            x = conv(x)
+        return x
+
+
+class SelfAttention(nn.Module):
+    def __init__(self, embed_dim: int, num_heads: int) -> None:
+        super().__init__()
+        self.num_heads = num_heads
+        self.head_dim = embed_dim // num_heads
+        self.scaling = self.head_dim ** -0.5
+        self.k_proj = nn.Linear(embed_dim, embed_dim)
+        self.v_proj = nn.Linear(embed_dim, embed_dim)
+        self.q_proj = nn.Linear(embed_dim, embed_dim)
+        self.out_proj = nn.Linear(embed_dim, embed_dim)
+
+    def forward(self, x, key_padding_mask=None):
+        # x: T x B x C
+        length, batch_size, embed_dim = x.shape
+
+        def heads(y):
+            return y.view(length, batch_size * self.num_heads, self.head_dim).transpose(0, 1)
+
+        q = heads(self.q_proj(x) * self.scaling)
+        k = heads(self.k_proj(x))
+        v = heads(self.v_proj(x))
+        weights = torch.bmm(q, k.transpose(1, 2))
+        if key_padding_mask is not None:
+            weights = weights.view(batch_size, self.num_heads, length, length)
+            weights = weights.masked_fill(key_padding_mask[:, None, None, :], float("-inf"))
+            weights = weights.view(batch_size * self.num_heads, length, length)
+        weights = torch.softmax(weights, dim=-1)
+        attn = torch.bmm(weights, v).transpose(0, 1).reshape(length, batch_size, embed_dim)
+        return self.out_proj(attn)
+
+
+class EncoderLayer(nn.Module):
+    def __init__(self, embed_dim: int, ffn_dim: int, num_heads: int, layer_norm_first: bool) -> None:
+        super().__init__()
+        self.self_attn = SelfAttention(embed_dim, num_heads)
+        self.self_attn_layer_norm = nn.LayerNorm(embed_dim)
+        self.fc1 = nn.Linear(embed_dim, ffn_dim)
+        self.fc2 = nn.Linear(ffn_dim, embed_dim)
+        self.final_layer_norm = nn.LayerNorm(embed_dim)
+        self.layer_norm_first = layer_norm_first
+
+    def forward(self, x, padding_mask=None):
+        if self.layer_norm_first:
+            x = x + self.self_attn(self.self_attn_layer_norm(x), padding_mask)
+            return x + self.fc2(gelu(self.fc1(self.final_layer_norm(x))))
+        x = self.self_attn_layer_norm(x + self.self_attn(x, padding_mask))
+        return self.final_layer_norm(x + self.fc2(gelu(self.fc1(x))))
+
+
+class TransformerEncoder(nn.Module):
+    def __init__(self, config: Dict[str, Any]) -> None:
+        super().__init__()
+        embed_dim = config["encoder_embed_dim"]
+        self.pos_conv = nn.Sequential(
+            nn.Conv1d(embed_dim, embed_dim, kernel_size=config["conv_pos"], padding=config["conv_pos"] // 2,
+                      groups=config["conv_pos_groups"]),
+            SamePad(config["conv_pos"]),
+            nn.GELU(),
+        )
+        self.layers = nn.ModuleList([
+            EncoderLayer(embed_dim, config["encoder_ffn_embed_dim"], config["encoder_attention_heads"], config["layer_norm_first"])
+            for _ in range(config["encoder_layers"])
+        ])
+        self.layer_norm_first = config["layer_norm_first"]
+        self.layer_norm = nn.LayerNorm(embed_dim)
+        self.required_seq_len_multiple = config["required_seq_len_multiple"]
+
+    def forward(self, x, padding_mask=None, tgt_layer=None):
+        if padding_mask is not None:
+            x = x.masked_fill(padding_mask.unsqueeze(-1), 0)
+        x = x + self.pos_conv(x.transpose(1, 2)).transpose(1, 2)
+        if not self.layer_norm_first:
+            x = self.layer_norm(x)
+
+        # Pad the sequence length to a multiple of required_seq_len_multiple, as fairseq does
+        pad_length = -x.shape[1] % self.required_seq_len_multiple
+        if pad_length > 0:
+            x = F.pad(x, (0, 0, 0, pad_length))
+            if padding_mask is None:
+                padding_mask = torch.zeros(x.shape[:2], dtype=torch.bool, device=x.device)
+                padding_mask[:, -pad_length:] = True
+            else:
+                padding_mask = F.pad(padding_mask, (0, pad_length), value=True)
+
+        x = x.transpose(0, 1)
+        for i, layer in enumerate(self.layers):
+            x = layer(x, padding_mask)
+            if i == tgt_layer:
+                break
+        x = x.transpose(0, 1)
+        if pad_length > 0:
+            x = x[:, :-pad_length]
+        if self.layer_norm_first and tgt_layer is None:
+            x = self.layer_norm(x)
+        return x
+
+
+class HubertFeatureModel(nn.Module):
+    """The inference part of fairseq's HubertModel, with the same parameter names."""
+
+    def __init__(self, config: Dict[str, Any]) -> None:
+        super().__init__()
+        if config["layer_type"] != "transformer" or config["pos_conv_depth"] != 1:
+            raise ValueError("Unsupported HuBERT architecture: layer_type=%s, pos_conv_depth=%s"
+                             % (config["layer_type"], config["pos_conv_depth"]))
+        conv_layers = eval(config["conv_feature_layers"])
+        self.embed = conv_layers[-1][0]
+        embed_dim = config["encoder_embed_dim"]
+        self.feature_extractor = ConvFeatureExtractor(conv_layers, config["extractor_mode"], config["conv_bias"])
+        self.post_extract_proj = nn.Linear(self.embed, embed_dim) if self.embed != embed_dim else None
+        self.encoder = TransformerEncoder(config)
+        self.layer_norm = nn.LayerNorm(self.embed)
+        final_dim = config["final_dim"] if config["final_dim"] > 0 else embed_dim
+        self.final_proj = nn.Linear(embed_dim, final_dim)
+
+    def forward_padding_mask(self, features, padding_mask):
+        extra = padding_mask.size(1) % features.size(1)
+        if extra > 0:
+            padding_mask = padding_mask[:, :-extra]
+        return padding_mask.view(padding_mask.size(0), features.size(1), -1).all(-1)
+
+    def extract_features(self, source, padding_mask=None, mask=False, ret_conv=False,
+                         output_layer: Optional[int] = None) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """Same as fairseq's `HubertModel.extract_features` (without masking). `output_layer` is 1-based."""
+        features = self.feature_extractor(source).transpose(1, 2)
+        features = self.layer_norm(features)
+        if padding_mask is not None:
+            padding_mask = self.forward_padding_mask(features, padding_mask)
+        if self.post_extract_proj is not None:
+            features = self.post_extract_proj(features)
+        if ret_conv:
+            return features, padding_mask
+        x = self.encoder(features, padding_mask, None if output_layer is None else output_layer - 1)
+        return x, padding_mask
+
+    def extract_features_batch(self, sources: List[torch.Tensor],
+                               output_layer: Optional[int] = None) -> Tuple[torch.Tensor, List[int]]:
+        """`extract_features` of several 1-D waveforms of different lengths, with one transformer pass.
+
+        The conv feature extractor runs on each waveform alone: in the "default" extractor mode, its GroupNorm
+        normalizes each channel over the whole time axis, so zero-padding the waveforms would change the features
+        of the shorter ones. Its outputs are padded and masked instead, which gives each waveform the same
+        features as `extract_features` alone.
+
+        Return the features `[batch, frames, dim]` and the number of frames of each waveform.
+        """
+        features = [self.layer_norm(self.feature_extractor(source.unsqueeze(0)).transpose(1, 2))[0] for source in sources]
+        lengths = [f.shape[0] for f in features]
+        padded = features[0].new_zeros(len(features), max(lengths), features[0].shape[1])
+        for i, f in enumerate(features):
+            padded[i, :lengths[i]] = f
+        padding_mask = (torch.arange(max(lengths), device=padded.device)[None, :]
+                        >= torch.tensor(lengths, device=padded.device)[:, None])
+        if self.post_extract_proj is not None:
+            padded = self.post_extract_proj(padded)
+        x = self.encoder(padded, padding_mask, None if output_layer is None else output_layer - 1)
+        return x, lengths
+
+
+class FairseqObject:
+    """Stands in for the fairseq classes (config enums...) pickled in a checkpoint, so that fairseq is not imported."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        self.args = args
+
+    def __setstate__(self, state) -> None:
+        self.state = state
+
+
+class CheckpointUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module == "fairseq" or module.startswith("fairseq."):
+            return FairseqObject
+        return super().find_class(module, name)
+
+
+checkpoint_pickle = types.ModuleType("checkpoint_pickle")
+checkpoint_pickle.Unpickler = CheckpointUnpickler
+checkpoint_pickle.load = pickle.load
+
+
+def load_checkpoint(checkpoint_path: str):
+    return torch.load(checkpoint_path, map_location="cpu", pickle_module=checkpoint_pickle)
+
+
+def model_config(cpt) -> Dict[str, Any]:
+    """Architecture values of a fairseq checkpoint (omegaconf `cfg` or legacy `args`)."""
+    if cpt.get("cfg") is not None:
+        source = cpt["cfg"]["model"]
+    else:
+        source = vars(cpt["args"])
+    config = {}
+    for key, default in DEFAULT_CONFIG.items():
+        value = source.get(key, None)
+        if isinstance(value, FairseqObject):  # enum value: FairseqObject(value)
+            value = value.args[0] if value.args else None
+        config[key] = default if value is None else value
+    return config
+
+
+def inference_state_dict(state_dict) -> Dict[str, torch.Tensor]:
+    """State dict of `HubertFeatureModel`: weight norm folded into the weight, pretraining parameters dropped."""
+    state_dict = {key: value for key, value in state_dict.items() if key not in TRAINING_KEYS}
+    prefix = "encoder.pos_conv.0."
+    if prefix + "weight_g" in state_dict:
+        weight_g = state_dict.pop(prefix + "weight_g")
+        weight_v = state_dict.pop(prefix + "weight_v")
+        norm = weight_v.float().pow(2).sum(dim=(0, 1), keepdim=True).sqrt()  # weight norm over dim 2
+        state_dict[prefix + "weight"] = (weight_v.float() * (weight_g.float() / norm)).to(weight_v.dtype)
+    return state_dict
+
+
+def safetensors_path(checkpoint_path: str) -> str:
+    return os.path.splitext(checkpoint_path)[0] + ".safetensors"
+
+
+def read_checkpoint(checkpoint_path: str):
+    """Return `(config, state_dict)` from the safetensors conversion of the checkpoint if it exists, else from the checkpoint."""
+    converted_path = safetensors_path(checkpoint_path)
+    if os.path.exists(converted_path):
+        from safetensors import safe_open
+        from safetensors.torch import load_file
+
+        with safe_open(converted_path, framework="pt") as f:
+            config = json.loads(f.metadata()["config"])
+        return config, load_file(converted_path)
+    cpt = load_checkpoint(checkpoint_path)
+    return model_config(cpt), inference_state_dict(cpt["model"])
+
+
+def convert_to_safetensors(checkpoint_path: str) -> str:
+    from safetensors.torch import save_file
+
+    cpt = load_checkpoint(checkpoint_path)
+    state_dict = {key: value.contiguous() for key, value in inference_state_dict(cpt["model"]).items()}
+    converted_path = safetensors_path(checkpoint_path)
+    save_file(state_dict, converted_path, metadata={"config": json.dumps(model_config(cpt))})
+    return converted_path
+
+
+def load_hubert(checkpoint_path: str) -> HubertFeatureModel:
+    """HuBERT feature extractor of the fairseq checkpoint `checkpoint_path`, on CPU in eval mode."""
+    config, state_dict = read_checkpoint(checkpoint_path)
+    model = HubertFeatureModel(config)
+    missing, unexpected = model.load_state_dict(state_dict, strict=False)
+    if missing or unexpected:
+        print(DEBUG_PREFIX, "Checkpoint mismatch, missing:", missing, "unexpected:", unexpected)
+    return model.eval()
+
+
+if __name__ == "__main__":
+    checkpoint_path = sys.argv[1]
+    time_start = perf_counter()
+    load_hubert(checkpoint_path)
+    print("Loaded %s in %.2fs" % (checkpoint_path, perf_counter() - time_start))
+    converted_path = convert_to_safetensors(checkpoint_path)
+    time_start = perf_counter()
+    load_hubert(checkpoint_path)
+    print("Converted to %s, loaded in %.2fs" % (converted_path, perf_counter() - time_start))
@@ -0,0 +1,99 @@
+"""
+Cache of RVC retrieval indexes for SillyTavern Extras
+
+`faiss.read_index` and `index.reconstruct_n` of a voice index cost hundreds of MB of disk reads
+and copies for large voices. Loaded indexes and their reconstructed feature matrix (`big_npy`)
+are kept in the model manager, keyed by index path and modification time, and the least
+recently used ones are unloaded when the memory limit of the cache is exceeded.
+
+Optionally, the feature matrix is stored as float16 next to the index file
+("<name>.index" -> "<name>.big_npy.f16.npy") and memory-mapped from there, so that loading
+an index does not need to reconstruct it, and its pages are shared through the OS file cache.
+"""
+from contextlib import contextmanager
+import os
+import threading
+
+import faiss
+import numpy as np
+
+from modules.model_manager import model_registry
+
+DEBUG_PREFIX = "<RVC index cache>"
+INDEX_CACHE_GROUP = "rvc-index"
+MEMMAP_SUFFIX = ".big_npy.f16.npy"
+
+use_memmap = False
+
+# path -> mtime of the cached index, to reload it when the file changes
+index_mtimes = {}
+index_mtimes_lock = threading.Lock()
+
+
+class RetrievalIndex:
+    """A loaded faiss index and its feature matrix. `nbytes` is the approximate memory held."""
+
+    def __init__(self, index, big_npy, nbytes: int) -> None:
+        self.index = index
+        self.big_npy = big_npy
+        self.nbytes = nbytes
+
+
+def set_cache_limit(max_mb=None):
+    model_registry.set_group_limit(INDEX_CACHE_GROUP, max_mb=max_mb)
+
+
+def memmap_path(file_index: str) -> str:
+    return os.path.splitext(file_index)[0] + MEMMAP_SUFFIX
+
+
+def _load_big_npy_memmap(file_index: str, index):
+    """Return the float16 feature matrix memory-mapped from its file, writing it first if missing or stale."""
+    npy_path = memmap_path(file_index)
+    if not os.path.exists(npy_path) or os.path.getmtime(npy_path) < os.path.getmtime(file_index):
+        print(DEBUG_PREFIX, "Writing float16 feature matrix", npy_path)
+        tmp_path = npy_path[:-len(".npy")] + ".tmp.npy"
+        np.save(tmp_path, index.reconstruct_n(0, index.ntotal).astype(np.float16))
+        os.replace(tmp_path, npy_path)
+    return np.load(npy_path, mmap_mode="r")
+
+
+def _load_index(file_index: str) -> RetrievalIndex:
+    index = faiss.read_index(file_index)
+    index_bytes = os.path.getsize(file_index)  # the in-memory size of a faiss index is close to its file size
+    if use_memmap:
+        big_npy = _load_big_npy_memmap(file_index, index)
+        return RetrievalIndex(index, big_npy, index_bytes)  # mapped pages belong to the OS file cache
+    big_npy = index.reconstruct_n(0, index.ntotal)
+    return RetrievalIndex(index, big_npy, index_bytes + big_npy.nbytes)
+
+
+def _index_key(file_index: str) -> str:
+    return "rvc-index:%s" % file_index
+
+
+def is_cached(file_index: str) -> bool:
+    """True if the index file `file_index` is loaded and unchanged on disk."""
+    try:
+        return (model_registry.is_loaded(_index_key(file_index))
+                and index_mtimes.get(file_index) == os.path.getmtime(file_index))
+    except OSError:
+        return False
+
+
+@contextmanager
+def use_index(file_index: str):
+    """Context manager yielding `(index, big_npy)` for the index file `file_index`, from the cache when possible.
+
+    The index is not unloaded while the block runs.
+    """
+    key = _index_key(file_index)
+    mtime = os.path.getmtime(file_index)
+    with index_mtimes_lock:
+        if index_mtimes.get(file_index) != mtime:
+            if file_index in index_mtimes:
+                print(DEBUG_PREFIX, "Index changed on disk, reloading", file_index)
+            model_registry.unregister(key)
+            index_mtimes[file_index] = mtime
+    with model_registry.use(key, lambda: _load_index(file_index), group=INDEX_CACHE_GROUP) as retrieval_index:
+        yield retrieval_index.index, retrieval_index.big_npy
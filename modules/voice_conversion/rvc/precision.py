@@ -0,0 +1,95 @@
+"""
+CPU precision modes of HuBERT and the RVC synthesizer for SillyTavern Extras
+
+On CPU, RVC runs both models in float32 (half precision is for CUDA only). Two faster modes:
+    - bf16: the forward passes run under bfloat16 autocast, used only on CPUs with native
+      bfloat16 instructions (AVX512-BF16 or AMX), where it is faster than float32.
+    - int8: the Linear layers are quantized to int8 with dynamic quantization (activations are
+      quantized on the fly). PyTorch only quantizes Linear (not convolution) layers dynamically,
+      so this mostly speeds up the transformer of HuBERT; the synthesizer is almost all convolutions.
+
+Quality check against float32 (log-mel spectrogram distance and real-time factor):
+    python -m modules.voice_conversion.rvc.precision data/models/rvc/<voice>/<voice>.pth input.wav
+"""
+from contextlib import nullcontext
+import sys
+
+import torch
+from torch import nn
+
+DEBUG_PREFIX = "<RVC precision>"
+CPU_PRECISIONS = ["fp32", "bf16", "int8"]
+
+
+def cpu_supports_bf16() -> bool:
+    """True if the CPU has native bfloat16 instructions (x86 Linux only, False when unknown)."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def resolve_cpu_precision(precision: str) -> str:
+    """Precision actually used for `precision` on this CPU."""
+    if precision == "bf16" and not cpu_supports_bf16():
+        print(DEBUG_PREFIX, "This CPU has no native bfloat16 support, using fp32")
+        return "fp32"
+    return precision
+
+
+def quantize(model: nn.Module, precision: str) -> nn.Module:
+    """Return `model` (in eval mode, on CPU) with its Linear layers quantized to int8 if `precision` is int8."""
+    if precision != "int8":
+        return model
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def autocast(precision: str):
+    """Context of the forward passes for `precision` (bfloat16 autocast for bf16)."""
+    if precision == "bf16":
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return nullcontext()
+
+
+def log_mel_distance(reference, audio, sr: int) -> float:
+    """Mean absolute difference in dB between the log-mel spectrograms of two signals."""
+    import librosa
+    import numpy as np
+
+    length = min(len(reference), len(audio))
+    mels = [librosa.power_to_db(librosa.feature.melspectrogram(y=np.asarray(y[:length], dtype=np.float32), sr=sr),
+                                ref=1.0, top_db=None)
+            for y in (reference, audio)]
+    return float(np.mean(np.abs(np.maximum(mels[0], -80) - np.maximum(mels[1], -80))))
+
+
+if __name__ == "__main__":
+    from time import perf_counter
+
+    import modules.voice_conversion.rvc.rvc as rvc
+
+    model_path, audio_path = sys.argv[1], sys.argv[2]
+    if rvc.config.device != "cpu":
+        print("Precision modes only apply on CPU, run with CUDA_VISIBLE_DEVICES=\"\"")
+        sys.exit(1)
+
+    outputs = {}
+    for precision in CPU_PRECISIONS:
+        rvc.set_cpu_precision(precision)
+        if rvc.config.cpu_precision != precision:
+            continue
+        with rvc.use_rvc(model_path) as rvc_model:
+            for _ in range(2):  # the first run also loads HuBERT and the pitch extractor
+                torch.manual_seed(0)  # same noise in the synthesizer source module
+                time_start = perf_counter()
+                info, (tgt_sr, audio) = rvc.vc_single(rvc_model, 0, audio_path, 0, None, "rmvpe", "", "", 0, 3, 0, 1, 0.33)
+                duration = perf_counter() - time_start
+        if audio is None:
+            print(info)
+            sys.exit(1)
+        outputs[precision] = audio.astype("float32") / 32768
+        distance = log_mel_distance(outputs["fp32"], outputs[precision], tgt_sr)
+        print("%-5s real-time factor %.3f, log-mel distance to fp32 %.2f dB"
+              % (precision, duration / (len(audio) / tgt_sr), distance))
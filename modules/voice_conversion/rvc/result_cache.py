@@ -0,0 +1,119 @@
+"""
+On-disk cache of RVC conversion results for SillyTavern Extras
+
+Swipes, regenerations and repeated greetings send the same TTS audio to be converted again.
+Converted audio files are stored under a content-addressed name: the hash of the input audio
+bytes, the voice files (path and modification time) and every conversion parameter, with the
+extension of the output format. The least recently used files are deleted when the cache exceeds
+its size limit.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+DEBUG_PREFIX = "<RVC result cache>"
+RESULT_CACHE_PATH = "data/tmp/rvc_cache/"
+EXTENSIONS = {"wav": ".wav", "flac": ".flac", "ogg-opus": ".ogg", "mp3": ".mp3"}  # output format -> file extension
+
+
+class ResultCache:
+    def __init__(self, folder: str, max_mb: float) -> None:
+        self.folder = folder
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(folder, exist_ok=True)
+        # file name -> (last access time, size), rebuilt from the files of previous runs
+        self.entries = {}
+        for file_name in os.listdir(folder):
+            if os.path.splitext(file_name)[1] in EXTENSIONS.values():
+                stat = os.stat(os.path.join(folder, file_name))
+                self.entries[file_name] = (stat.st_mtime, stat.st_size)
+        self.size = sum(size for _, size in self.entries.values())
+        self._evict()
+
+    @staticmethod
+    def key(audio: bytes, model_path: str, index_path: Optional[str], parameters: Dict[str, Any]) -> str:
+        digest = hashlib.sha256(audio)
+        voice_files = [(path, os.path.getmtime(path)) for path in (model_path, index_path) if path and os.path.exists(path)]
+        digest.update(json.dumps({"voice": voice_files, "parameters": parameters}, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def file_name(key: str, audio_format: str) -> str:
+        return key + EXTENSIONS[audio_format]
+
+    def path(self, file_name: str) -> str:
+        return os.path.join(self.folder, file_name)
+
+    def get(self, key: str, audio_format: str = "wav") -> Optional[bytes]:
+        """Cached audio file for `key` in `audio_format`, or None."""
+        file_name = self.file_name(key, audio_format)
+        with self.lock:
+            if file_name not in self.entries or not os.path.exists(self.path(file_name)):
+                if file_name in self.entries:
+                    self.size -= self.entries.pop(file_name)[1]
+                self.misses += 1
+                return None
+            self.hits += 1
+            _, size = self.entries[file_name]
+            now = time.time()
+            os.utime(self.path(file_name), (now, now))  # keep the access order across restarts
+            self.entries[file_name] = (now, size)
+            with open(self.path(file_name), "rb") as f:
+                return f.read()
+
+    def put(self, key: str, audio: bytes, audio_format: str = "wav") -> None:
+        if len(audio) > self.max_bytes:
+            return
+        file_name = self.file_name(key, audio_format)
+        tmp_path = "%s.%d.tmp" % (self.path(file_name), threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            f.write(audio)
+        with self.lock:
+            os.replace(tmp_path, self.path(file_name))
+            if file_name in self.entries:
+                self.size -= self.entries[file_name][1]
+            self.entries[file_name] = (time.time(), len(audio))
+            self.size += len(audio)
+            self._evict()
+
+    def _evict(self) -> None:
+        """Delete the least recently used results until the cache fits in its size limit."""
+        while self.size > self.max_bytes and self.entries:
+            file_name = min(self.entries, key=lambda k: self.entries[k][0])
+            _, size = self.entries.pop(file_name)
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(file_name))
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "size_mb": round(self.size / 1024 / 1024, 1),
+                "max_mb": round(self.max_bytes / 1024 / 1024, 1),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "evictions": self.evictions,
+            }
+
+
+result_cache = None
+
+
+def enable(max_mb: float, folder: str = RESULT_CACHE_PATH) -> None:
+    global result_cache
+    result_cache = ResultCache(folder, max_mb)
+    print(DEBUG_PREFIX, "Caching conversion results in", folder, "up to", max_mb, "MB,",
+          len(result_cache.entries), "results found")
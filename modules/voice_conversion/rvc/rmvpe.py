@@ -299,17 +299,11 @@ class RMVPE:
         center = np.argmax(salience, axis=1)  # 帧长#index
         salience = np.pad(salience, ((0, 0), (4, 4)))  # 帧长,368
         # t1 = ttime()
-        center += 4
-        todo_salience = []
-        todo_cents_mapping = []
-        starts = center - 4
-        ends = center + 5
-        for idx in range(salience.shape[0]):
-            todo_salience.append(salience[:, starts[idx]:ends[idx]][idx])
-            todo_cents_mapping.append(self.cents_mapping[starts[idx]:ends[idx]])
+        # 9 bins around each frame's peak, in padded coordinates (center + 4 - 4 ... center + 4 + 4)
+        bins = center[:, None] + np.arange(9)[None, :]
         # t2 = ttime()
-        todo_salience = np.array(todo_salience)  # 帧长，9
-        todo_cents_mapping = np.array(todo_cents_mapping)  # 帧长，9
+        todo_salience = np.take_along_axis(salience, bins, axis=1)  # 帧长，9
+        todo_cents_mapping = self.cents_mapping[bins]  # 帧长，9
         product_sum = np.sum(todo_salience * todo_cents_mapping, 1)
         weight_sum = np.sum(todo_salience, 1)  # 帧长
         devided = product_sum / weight_sum  # 帧长
@@ -4,20 +4,28 @@ Copyright: RVC-Project
 License: MIT
 """
 
-import gc
+import math
 import os
 import traceback
+from contextlib import contextmanager
+from time import time as ttime
 
 import ffmpeg
 import numpy as np
+import soundfile
+from scipy import signal
 import torch.cuda
 import argparse
 import torch
 import io
 from multiprocessing import cpu_count
-from fairseq import checkpoint_utils
 
+from modules.model_manager import estimate_size, model_registry
 from modules.voice_conversion.rvc.hubert.hubert_manager import HuBERTManager
+from modules.voice_conversion.rvc.hubert.lean_hubert import load_hubert as load_hubert_checkpoint
+from modules.voice_conversion.rvc.precision import quantize, resolve_cpu_precision
+from modules.voice_conversion.rvc.synth_optimize import optimize_for_inference
+from modules.voice_conversion.rvc.timings import ConversionTrace
 from modules.voice_conversion.rvc.vc_infer_pipeline import VC
 
 from modules.voice_conversion.rvc.infer_pack.models import (
@@ -53,6 +61,9 @@ class Config:
         self.n_cpu = 0
         self.gpu_name = None
         self.gpu_mem = None
+        self.batch_seconds = 0  # seconds of padded audio per batched forward pass over segments, 0 = no batching
+        self.synth_compile = "none"  # compilation of the synthesizer generator: none, jit or compile
+        self.cpu_precision = "fp32"  # precision of HuBERT and the synthesizer on CPU: fp32, bf16 or int8
         self.x_pad, self.x_query, self.x_center, self.x_max = self.device_config()
 
     def device_config(self) -> tuple:
@@ -118,24 +129,89 @@ class Config:
 
         return x_pad, x_query, x_center, x_max
 
+    def precision(self) -> str:
+        if self.device == "cpu":
+            return self.cpu_precision
+        return "fp16" if self.is_half else "fp32"
+
 
 config = Config()
 
 
-def load_hubert():
+HUBERT_KEY = "rvc-hubert"
+
+
+def _load_hubert_model():
     global hubert_model
-    if not hubert_model:
-        models, _, _ = checkpoint_utils.load_model_ensemble_and_task(
-            [HuBERTManager.make_sure_hubert_rvc_installed()],
-            suffix="",
-        )
-        hubert_model = models[0]
-        hubert_model = hubert_model.to(config.device)
-        if config.is_half:
-            hubert_model = hubert_model.half()
-        else:
-            hubert_model = hubert_model.float()
-        hubert_model.eval()
+    hubert_model = load_hubert_checkpoint(HuBERTManager.make_sure_hubert_rvc_installed())
+    hubert_model = hubert_model.to(config.device)
+    if config.is_half:
+        hubert_model = hubert_model.half()
+    else:
+        hubert_model = hubert_model.float()
+    hubert_model.eval()
+    if config.device == "cpu":
+        hubert_model = quantize(hubert_model, config.cpu_precision)
+    return hubert_model
+
+
+def _unload_hubert_model(model):
+    global hubert_model
+    if hubert_model is model:
+        hubert_model = None
+
+
+model_registry.register(HUBERT_KEY, _load_hubert_model, unloader=_unload_hubert_model, device=config.device)
+
+
+def use_hubert():
+    """Context manager yielding the HuBERT model, loading it if needed. It is not unloaded while the block runs."""
+    return model_registry.use(HUBERT_KEY)
+
+
+def decode_audio_soundfile(audio_source, sr):
+    """
+    Decode WAV/FLAC/OGG in-process with libsndfile, mix down to mono and resample to `sr`.
+    Raise RuntimeError for formats libsndfile cannot read.
+    """
+    if isinstance(audio_source, str):
+        audio_source = audio_source.strip(" ").strip('"').strip("\n").strip('"')
+    elif isinstance(audio_source, io.BytesIO):
+        audio_source.seek(0)
+    else:
+        raise ValueError("Invalid audio source")
+
+    audio, source_sr = soundfile.read(audio_source, dtype="float32", always_2d=True)
+    return resample_waveform(audio, source_sr, sr)
+
+
+def resample_waveform(audio, source_sr, sr):
+    """
+    Mix down a waveform already in memory (float, samples or samples x channels) to mono float32 at `sr`.
+    """
+    audio = np.asarray(audio, dtype=np.float32)
+    if audio.ndim > 1:
+        audio = audio.mean(axis=1)
+    if source_sr != sr:
+        gcd = math.gcd(source_sr, sr)
+        audio = signal.resample_poly(audio, sr // gcd, source_sr // gcd)
+    return np.ascontiguousarray(audio, dtype=np.float32)
+
+
+def decode_audio(audio_source, sr):
+    """
+    Return the audio of `audio_source` (a file path, BytesIO, or a (sample rate, waveform) tuple already
+    in memory) as mono float32 at `sr`, and the name of the decoder that was used: "soundfile",
+    "ffmpeg" for the formats it cannot handle, or "memory".
+    """
+    if isinstance(audio_source, tuple):
+        source_sr, audio = audio_source
+        return resample_waveform(audio, source_sr, sr), "memory"
+    try:
+        return decode_audio_soundfile(audio_source, sr), "soundfile"
+    except RuntimeError as e:  # soundfile.LibsndfileError
+        print("soundfile cannot decode the audio, falling back to ffmpeg:", e)
+    return load_audio(audio_source, sr), "ffmpeg"
 
 
 def load_audio(audio_source, sr):
@@ -163,30 +239,111 @@ def load_audio(audio_source, sr):
     return np.frombuffer(out, np.float32).flatten()
 
 
-vc = None
-rvc_model_name = None
-maximum = 0
+RVC_CACHE_GROUP = "rvc"
 
 
-def unload_rvc():
-    global vc, rvc_model_name
-    rvc_model_name = None
-    vc = None
-    gc.collect()
-    torch.cuda.empty_cache()
+def build_synthesizer(cpt, device, is_half):
+    """Synthesizer of the checkpoint `cpt`, in eval mode on `device`."""
+    cpt["config"][-3] = cpt["weight"]["emb_g.weight"].shape[0]  # n_spk
+    if_f0 = cpt.get("f0", 1)
+    version = cpt.get("version", "v1")
+    if version == "v1":
+        if if_f0 == 1:
+            net_g = SynthesizerTrnMs256NSFsid(*cpt["config"], is_half=is_half)
+        else:
+            net_g = SynthesizerTrnMs256NSFsid_nono(*cpt["config"])
+    elif version == "v2":
+        if if_f0 == 1:
+            net_g = SynthesizerTrnMs768NSFsid(*cpt["config"], is_half=is_half)
+        else:
+            net_g = SynthesizerTrnMs768NSFsid_nono(*cpt["config"])
+
+    del net_g.enc_q
+    print(net_g.load_state_dict(cpt["weight"], strict=False))
+    net_g.eval().to(device)
+    if is_half:
+        net_g = net_g.half()
+    else:
+        net_g = net_g.float()
+    return net_g
+
+
+class RVCModel:
+    """A loaded RVC voice: its synthesizer (optimized for inference), inference pipeline and checkpoint metadata."""
+
+    def __init__(self, model_path):
+        print("loading %s" % model_path)
+        cpt = torch.load(model_path, map_location="cpu")
+        self.model_path = model_path
+        self.tgt_sr = cpt["config"][-1]
+        self.if_f0 = cpt.get("f0", 1)
+        self.version = cpt.get("version", "v1")
+        self.net_g = build_synthesizer(cpt, config.device, config.is_half)
+        if config.device == "cpu":
+            self.net_g = quantize(self.net_g, config.cpu_precision)
+        print("synthesizer optimized:", optimize_for_inference(self.net_g, config.synth_compile))
+        self.vc = VC(self.tgt_sr, config)
+        self.n_spk = cpt["config"][-3]
+
+    @property
+    def nbytes(self):
+        return estimate_size(self.net_g)
+
+
+def set_cpu_precision(precision):
+    """Precision of HuBERT and the voices on CPU (fp32, bf16 or int8). Loaded models are unloaded to apply it."""
+    if config.device != "cpu":
+        return
+    config.cpu_precision = resolve_cpu_precision(precision)
+    model_registry.unload(HUBERT_KEY)
+    unload_rvc()
+
+
+def set_cache_size(max_models):
+    """Number of RVC voices kept loaded, the least recently used one is unloaded first."""
+    model_registry.set_group_limit(RVC_CACHE_GROUP, max_models=max_models)
+
+
+def _rvc_key(model):
+    return "rvc:%s" % model
+
+
+def unload_rvc(model=None):
+    """Unload the RVC voice `model`, or all of them."""
+    if model is not None:
+        model_registry.unload(_rvc_key(model))
+        return
+    for entry in model_registry.loaded_models()["models"]:
+        if entry["group"] == RVC_CACHE_GROUP:
+            model_registry.unload(entry["key"])
+
+
+@contextmanager
+def use_model(key, trace=None, name=None, **register_kwargs):
+    """`model_registry.use`, recording in `trace` whether the model was cached and how long loading it took."""
+    hit = model_registry.is_loaded(key)
+    time_start = ttime()
+    with model_registry.use(key, **register_kwargs) as model:
+        if trace is not None:
+            trace.cache_result(name, hit)
+            if not hit:
+                trace.add(name + "_load", ttime() - time_start)
+        yield model
+
+
+def use_rvc(model, trace=None):
+    """Context manager yielding the RVCModel of the pth file `model`, loading it if needed."""
+    return use_model(_rvc_key(model), trace, "model", loader=lambda: RVCModel(model), device=config.device,
+                     group=RVC_CACHE_GROUP)
 
 
 def load_rvc(model):
-    global vc, rvc_model_name, maximum
-    if model != rvc_model_name:
-        unload_rvc()
-        rvc_model_name = model # correct for ST
-        # Load rvc
-        maximum = get_vc(model)['maximum']
-    return maximum
+    with use_rvc(model) as rvc_model:
+        return rvc_model.n_spk
 
 
 def vc_single(
+    rvc_model,
     sid,
     input_audio_path,
     f0_up_key,
@@ -200,21 +357,22 @@ def vc_single(
     resample_sr,
     rms_mix_rate,
     protect,
-    crepe_hop_length=128
+    crepe_hop_length=128,
+    trace=None
 ):  # spk_item, input_audio0, vc_transform0,f0_file,f0method0
-    global tgt_sr, net_g, vc, hubert_model, version
     if input_audio_path is None:
         return "You need to upload an audio", None
     f0_up_key = int(f0_up_key)
+    times = trace if trace is not None else ConversionTrace()
     try:
-        audio = load_audio(input_audio_path, 16000)
+        with times.measure("decode"):
+            audio, decoder = decode_audio(input_audio_path, 16000)
+        times.info["decoder"] = decoder
+        times.info["precision"] = config.precision()
         audio_max = np.abs(audio).max() / 0.95
         if audio_max > 1:
-            audio /= audio_max
-        times = [0, 0, 0]
-        if hubert_model is None:
-            load_hubert()
-        if_f0 = cpt.get("f0", 1)
+            audio = audio / audio_max  # not in place: in-memory input may be the caller's array
+        tgt_sr = rvc_model.tgt_sr
         file_index = (
             (
                 file_index.strip(" ")
@@ -230,28 +388,29 @@ def vc_single(
         # file_big_npy = (
         #     file_big_npy.strip(" ").strip('"').strip("\n").strip('"').strip(" ")
         # )
-        audio_opt = vc.pipeline(
-            hubert_model,
-            net_g,
-            sid,
-            audio,
-            input_audio_path,
-            times,
-            f0_up_key,
-            f0_method,
-            file_index,
-            # file_big_npy,
-            index_rate,
-            if_f0,
-            filter_radius,
-            tgt_sr,
-            resample_sr,
-            rms_mix_rate,
-            version,
-            protect,
-            f0_file=f0_file,
-            crepe_hop_length=crepe_hop_length
-        )
+        with use_model(HUBERT_KEY, times, "hubert") as hubert_model:
+            audio_opt = rvc_model.vc.pipeline(
+                hubert_model,
+                rvc_model.net_g,
+                sid,
+                audio,
+                input_audio_path,
+                times,
+                f0_up_key,
+                f0_method,
+                file_index,
+                # file_big_npy,
+                index_rate,
+                rvc_model.if_f0,
+                filter_radius,
+                tgt_sr,
+                resample_sr,
+                rms_mix_rate,
+                rvc_model.version,
+                protect,
+                f0_file=f0_file,
+                crepe_hop_length=crepe_hop_length
+            )
         if resample_sr >= 16000 and tgt_sr != resample_sr:
             tgt_sr = resample_sr
         index_info = (
@@ -259,82 +418,13 @@ def vc_single(
             if os.path.exists(file_index)
             else "Index not used."
         )
-        return "Success.\n %s\nTime:\n npy:%ss, f0:%ss, infer:%ss" % (
-            index_info,
-            times[0],
-            times[1],
-            times[2],
-        ), (tgt_sr, audio_opt)
+        return "Success.\n %s\nTime:\n %s" % (index_info, times.summary()), (tgt_sr, audio_opt)
     except:
         info = traceback.format_exc()
         print(info)
         return info, (None, None)
 
 
-# 一个选项卡全局只能有一个音色
-def get_vc(sid):
-    global n_spk, tgt_sr, net_g, vc, cpt, version
-    if sid == "" or sid == []:
-        global hubert_model
-        if hubert_model is not None:  # 考虑到轮询, 需要加个判断看是否 sid 是由有模型切换到无模型的
-            print("clean_empty_cache")
-            del net_g, n_spk, vc, hubert_model, tgt_sr  # ,cpt
-            hubert_model = net_g = n_spk = vc = hubert_model = tgt_sr = None
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            ###楼下不这么折腾清理不干净
-            if_f0 = cpt.get("f0", 1)
-            version = cpt.get("version", "v1")
-            if version == "v1":
-                if if_f0 == 1:
-                    net_g = SynthesizerTrnMs256NSFsid(
-                        *cpt["config"], is_half=config.is_half
-                    )
-                else:
-                    net_g = SynthesizerTrnMs256NSFsid_nono(*cpt["config"])
-            elif version == "v2":
-                if if_f0 == 1:
-                    net_g = SynthesizerTrnMs768NSFsid(
-                        *cpt["config"], is_half=config.is_half
-                    )
-                else:
-                    net_g = SynthesizerTrnMs768NSFsid_nono(*cpt["config"])
-            del net_g, cpt
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            cpt = None
-        return {"visible": False, "__type__": "update"}
-    #person = "%s/%s" % (weight_root, sid) # ST HACK
-    person = sid
-    print("loading %s" % person)
-    cpt = torch.load(person, map_location="cpu")
-    tgt_sr = cpt["config"][-1]
-    cpt["config"][-3] = cpt["weight"]["emb_g.weight"].shape[0]  # n_spk
-    if_f0 = cpt.get("f0", 1)
-    version = cpt.get("version", "v1")
-    if version == "v1":
-        if if_f0 == 1:
-            net_g = SynthesizerTrnMs256NSFsid(*cpt["config"], is_half=config.is_half)
-        else:
-            net_g = SynthesizerTrnMs256NSFsid_nono(*cpt["config"])
-    elif version == "v2":
-        if if_f0 == 1:
-            net_g = SynthesizerTrnMs768NSFsid(*cpt["config"], is_half=config.is_half)
-        else:
-            net_g = SynthesizerTrnMs768NSFsid_nono(*cpt["config"])
-
-    del net_g.enc_q
-    print(net_g.load_state_dict(cpt["weight"], strict=False))
-    net_g.eval().to(config.device)
-    if config.is_half:
-        net_g = net_g.half()
-    else:
-        net_g = net_g.float()
-    vc = VC(tgt_sr, config)
-    n_spk = cpt["config"][-3]
-    return {"visible": True, "maximum": n_spk, "__type__": "update"}
-
-
 def change_info(path, info, name):
     try:
         ckpt = torch.load(path, map_location="cpu")
@@ -0,0 +1,233 @@
+"""
+Streaming RVC conversion for SillyTavern Extras
+
+Converts audio block by block as it arrives, so that playback can start after the first block
+instead of after the whole file. Each block is converted with `VC.vc` together with some past
+audio (context, for HuBERT and pitch extraction) and some future audio (look-ahead). Consecutive
+output blocks overlap by a short crossfade to hide the seams.
+
+Each block is converted by calling `run(convert)`, which by default just calls it; the endpoint runs
+the blocks on the worker of the RVC device instead, so that streams share the device with the other
+conversions one job at a time.
+
+Kept across blocks:
+    - the loaded models (HuBERT, synthesizer, index), pinned in the model manager for the whole stream
+    - the pitch of already converted frames, reused for the context of the next block so that pitch
+      extraction and its median filter do not jump at block boundaries
+    - the tail of the previous output block, crossfaded into the next one
+"""
+import math
+from time import time as ttime
+from typing import Callable, Optional
+
+import numpy as np
+import torch
+from scipy import signal
+
+from modules.voice_conversion.rvc.timings import ConversionTrace
+from modules.voice_conversion.rvc.vc_infer_pipeline import ah, bh, change_rms
+
+SR = 16000  # HuBERT input sample rate
+WINDOW = 160  # samples per frame at 16 kHz
+MIN_LOOKAHEAD = 4 * WINDOW  # HuBERT yields ~2 frames less than the input length, keep a margin
+
+
+def to_frames(seconds: float) -> int:
+    """Number of 16 kHz samples in `seconds`, rounded to whole frames."""
+    return max(1, int(round(seconds * SR / WINDOW))) * WINDOW
+
+
+class StreamResampler:
+    """Resample a stream of mono float32 blocks from `sr_in` to `sr_out`, without seams between blocks."""
+
+    MARGIN_BLOCKS = 8  # filter margin, in multiples of `down` input samples
+
+    def __init__(self, sr_in: int, sr_out: int) -> None:
+        gcd = math.gcd(sr_in, sr_out)
+        self.up = sr_out // gcd
+        self.down = sr_in // gcd
+        self.margin = self.down * max(self.MARGIN_BLOCKS, int(math.ceil(64 / self.down)))
+        self.buffer = np.zeros(self.margin, dtype=np.float32)  # silence before the stream
+        self.position = self.margin  # next input sample (in `buffer`) to resample
+
+    def push(self, audio: np.ndarray, final: bool = False) -> np.ndarray:
+        if self.up == self.down:
+            return audio
+        self.buffer = np.concatenate((self.buffer, audio))
+        input_end = len(self.buffer)
+        if final:
+            self.buffer = np.concatenate((self.buffer, np.zeros(self.margin + self.down, dtype=np.float32)))
+        end = self.position + (len(self.buffer) - self.margin - self.position) // self.down * self.down
+        if end <= self.position:
+            return np.zeros(0, dtype=np.float32)
+        resampled = signal.resample_poly(self.buffer[self.position - self.margin : end + self.margin], self.up, self.down)
+        skip = self.margin * self.up // self.down
+        length = (end - self.position) * self.up // self.down
+        if final:  # do not output the silence padding
+            length = min(length, (input_end - self.position) * self.up // self.down)
+        output = resampled[skip : skip + length]
+        # Keep only what the next call needs
+        self.buffer = self.buffer[end - self.margin :]
+        self.position = self.margin
+        return output.astype(np.float32)
+
+
+class RVCStream:
+    """
+    Incremental voice conversion of a mono audio stream.
+
+    `push` takes float32 audio at `input_sr` and returns the float32 output at `tgt_sr` that became
+    available; `flush` returns the rest at the end of the stream.
+
+    `block`: seconds of input converted per step (latency/overhead trade-off)
+    `lookahead`: seconds of future input used to convert a block (adds latency)
+    `context`: seconds of past input used to convert a block
+    `crossfade`: seconds of overlap between consecutive output blocks, taken from the look-ahead
+    `run`: called with the block conversion function, returns its result (default: call it directly)
+    """
+
+    def __init__(self, rvc_model, hubert_model, index, big_npy, input_sr: int = SR, sid: int = 0,
+                 f0_up_key: int = 0, f0_method: str = "rmvpe", index_rate: float = 0.75, filter_radius: int = 3,
+                 rms_mix_rate: float = 1.0, protect: float = 0.33, crepe_hop_length: int = 128,
+                 block: float = 0.5, lookahead: float = 0.2, context: float = 1.0, crossfade: float = 0.05,
+                 run: Optional[Callable[[Callable[[], np.ndarray]], np.ndarray]] = None) -> None:
+        self.rvc_model = rvc_model
+        self.vc = rvc_model.vc
+        self.hubert_model = hubert_model
+        self.index = index
+        self.big_npy = big_npy
+        self.sid = torch.tensor(sid, device=self.vc.device).unsqueeze(0).long()
+        self.f0_up_key = f0_up_key
+        self.f0_method = f0_method
+        self.index_rate = index_rate
+        self.filter_radius = filter_radius
+        self.rms_mix_rate = rms_mix_rate
+        self.protect = protect
+        self.crepe_hop_length = crepe_hop_length
+        self.run = run if run is not None else (lambda convert: convert())
+
+        self.tgt_sr = rvc_model.tgt_sr
+        self.samples_per_frame = self.tgt_sr // 100
+        self.block = to_frames(block)
+        self.crossfade = min(to_frames(crossfade), self.block)
+        self.lookahead = max(to_frames(lookahead), self.crossfade + MIN_LOOKAHEAD)
+        self.context = to_frames(context)
+
+        crossfade_samples = self.crossfade // WINDOW * self.samples_per_frame
+        self.fade_in = np.sin(0.5 * np.pi * np.linspace(0, 1, crossfade_samples, endpoint=False)) ** 2
+        self.fade_out = 1 - self.fade_in
+
+        self.resampler = StreamResampler(input_sr, SR)
+        self.buffer = np.zeros(self.context, dtype=np.float32)  # 16 kHz input, starting with silence as context
+        self.buffer_start = -self.context  # absolute position (16 kHz samples) of buffer[0]
+        self.position = 0  # absolute position of the next input sample to convert
+        self.input_length = 0  # 16 kHz samples received so far
+        self.previous_tail = None  # output crossfade tail of the previous block
+        self.f0_cache = None  # (first absolute frame, coarse pitch, f0) of the previous window
+
+        self.times = ConversionTrace()  # stage durations summed over the blocks
+        self.blocks = 0
+
+    def push(self, audio: np.ndarray) -> np.ndarray:
+        """Add input audio. Return the output audio that could be converted."""
+        audio = self.resampler.push(audio)
+        self.buffer = np.concatenate((self.buffer, audio))
+        self.input_length += len(audio)
+
+        output = []
+        while self.input_length - self.position >= self.block + self.lookahead:
+            output.append(self.run(self._convert_block))
+        return np.concatenate(output) if output else np.zeros(0, dtype=np.float32)
+
+    def flush(self) -> np.ndarray:
+        """End of the input stream: convert what is left and return the rest of the output."""
+        audio = self.resampler.push(np.zeros(0, dtype=np.float32), final=True)
+        self.buffer = np.concatenate((self.buffer, audio))
+        self.input_length += len(audio)
+        end = self.input_length
+        self.buffer = np.concatenate((self.buffer, np.zeros(self.block + self.lookahead, dtype=np.float32)))
+
+        output = []
+        while self.position < end:
+            output.append(self.run(self._convert_block))
+        if not output:
+            return np.zeros(0, dtype=np.float32)
+        # The last block was padded with silence, cut the output at the end of the input
+        output = np.concatenate(output)
+        extra = (self.position - end) // WINDOW * self.samples_per_frame
+        return output[: len(output) - extra] if extra > 0 else output
+
+    def _convert_block(self) -> np.ndarray:
+        window_start = self.position - self.context
+        window_end = self.position + self.block + self.lookahead
+        x = self.buffer[window_start - self.buffer_start : window_end - self.buffer_start].astype(np.float64)
+        x = signal.filtfilt(bh, ah, x)
+
+        p_len = len(x) // WINDOW
+        pitch = pitchf = None
+        if self.rvc_model.if_f0 == 1:
+            pitch, pitchf = self._get_f0(x, p_len, window_start // WINDOW)
+            pitch = torch.tensor(pitch, device=self.vc.device).unsqueeze(0).long()
+            pitchf = torch.tensor(pitchf, device=self.vc.device).unsqueeze(0).float()
+
+        audio1 = self.vc.vc(
+            self.hubert_model,
+            self.rvc_model.net_g,
+            self.sid,
+            x,
+            pitch,
+            pitchf,
+            self.times,
+            self.index,
+            self.big_npy,
+            self.index_rate,
+            self.rvc_model.version,
+            self.protect,
+        )
+        if self.rms_mix_rate != 1:
+            with self.times.measure("rms_mix"):
+                audio1 = change_rms(x, SR, audio1, self.tgt_sr, self.rms_mix_rate)
+
+        offset = self.context // WINDOW * self.samples_per_frame
+        block_samples = self.block // WINDOW * self.samples_per_frame
+        crossfade_samples = len(self.fade_in)
+        output = audio1[offset : offset + block_samples + crossfade_samples].copy()
+
+        if self.previous_tail is not None and crossfade_samples:
+            output[:crossfade_samples] = self.previous_tail * self.fade_out + output[:crossfade_samples] * self.fade_in
+        self.previous_tail = output[block_samples:]
+        output = output[:block_samples]
+
+        self.position += self.block
+        self.blocks += 1
+        # Forget the input that no future window needs
+        keep_from = self.position - self.context
+        if keep_from > self.buffer_start:
+            self.buffer = self.buffer[keep_from - self.buffer_start :]
+            self.buffer_start = keep_from
+        return output
+
+    def _get_f0(self, x, p_len, first_frame):
+        """Pitch of the window, reusing the pitch of the frames already converted by the previous block."""
+        time_start = ttime()
+        pitch, pitchf = self.vc.get_f0(
+            None,
+            x,
+            p_len,
+            self.f0_up_key,
+            self.f0_method,
+            self.filter_radius,
+            crepe_hop_length=self.crepe_hop_length,
+        )
+        pitch, pitchf = pitch[:p_len], pitchf[:p_len]
+        converted_frames = self.position // WINDOW - first_frame  # frames of the window before the current block
+        if self.f0_cache is not None and converted_frames > 0:
+            cache_first, cache_pitch, cache_pitchf = self.f0_cache
+            start = first_frame - cache_first
+            count = min(converted_frames, len(cache_pitch) - start)
+            if start >= 0 and count > 0:
+                pitch[:count] = cache_pitch[start : start + count]
+                pitchf[:count] = cache_pitchf[start : start + count]
+        self.f0_cache = (first_frame, pitch.copy(), pitchf.copy())
+        self.times.add("f0", ttime() - time_start)
+        return pitch, pitchf
@@ -0,0 +1,134 @@
+"""
+Inference optimizations of the RVC synthesizer for SillyTavern Extras
+
+Applied once when a voice is loaded; the optimized synthesizer is kept with its `RVCModel`
+in the model manager, so each voice is optimized once per load and not per conversion.
+    - weight norm removal: the weight-normalized convolutions of the generator (`dec`) and the
+      flow recompute their kernel from `weight_g`/`weight_v` at every forward pass, removing
+      the parametrization computes it once. Outputs are unchanged.
+    - BatchNorm folding into the preceding convolution, where a model has this pattern
+      (the RVC v1/v2 synthesizers use LayerNorm only, so this is a no-op for them).
+    - optional compilation of the generator with `torch.jit.script` or `torch.compile`,
+      falling back to eager mode if the generator cannot be compiled.
+
+Benchmark (real-time factor before/after):
+    python -m modules.voice_conversion.rvc.synth_optimize data/models/rvc/<voice>/<voice>.pth
+"""
+import sys
+from time import perf_counter
+
+import torch
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+DEBUG_PREFIX = "<RVC synthesizer>"
+COMPILE_MODES = ["none", "jit", "compile"]
+
+
+def remove_weight_norm(net_g: nn.Module) -> None:
+    # The posterior encoder (enc_q) is only used for training and is deleted at load time
+    net_g.dec.remove_weight_norm()
+    net_g.flow.remove_weight_norm()
+
+
+def fold_batch_norm(module: nn.Module) -> int:
+    """Fold each BatchNorm directly following a convolution in a Sequential into the convolution. Return the count."""
+    folded = 0
+    for child in module.children():
+        folded += fold_batch_norm(child)
+    if isinstance(module, nn.Sequential):
+        for i in range(len(module) - 1):
+            conv, norm = module[i], module[i + 1]
+            if (isinstance(conv, (nn.Conv1d, nn.Conv2d)) and isinstance(norm, (nn.BatchNorm1d, nn.BatchNorm2d))
+                    and not conv.training and not norm.training):
+                module[i] = fuse_conv_bn_eval(conv, norm)
+                module[i + 1] = nn.Identity()
+                folded += 1
+    return folded
+
+
+class EagerFallback(nn.Module):
+    """Run `compiled`, and `eager` from the first call that fails (torch.compile only fails when first called)."""
+
+    def __init__(self, compiled: nn.Module, eager: nn.Module) -> None:
+        super().__init__()
+        self.compiled = compiled
+        self.eager = eager
+        self.failed = False
+
+    def forward(self, *args, **kwargs):
+        if not self.failed:
+            try:
+                return self.compiled(*args, **kwargs)
+            except Exception as e:
+                print(DEBUG_PREFIX, "Compiled generator failed, falling back to eager mode:", e)
+                self.failed = True
+        return self.eager(*args, **kwargs)
+
+
+def compile_generator(net_g: nn.Module, mode: str) -> str:
+    """Compile the generator of `net_g` in place. Return the mode actually used."""
+    if mode == "jit":
+        try:
+            net_g.dec = torch.jit.script(net_g.dec)
+            return "jit"
+        except Exception as e:
+            print(DEBUG_PREFIX, "torch.jit.script failed on the generator, using eager mode:", e)
+    elif mode == "compile":
+        if hasattr(torch, "compile"):
+            net_g.dec = EagerFallback(torch.compile(net_g.dec, dynamic=True), net_g.dec)
+            return "compile"
+        print(DEBUG_PREFIX, "torch.compile needs torch 2, using eager mode")
+    return "none"
+
+
+def optimize_for_inference(net_g: nn.Module, compile_mode: str = "none") -> str:
+    """Optimize the synthesizer `net_g`, already in eval mode on its device. Return a description of what was done."""
+    remove_weight_norm(net_g)
+    steps = ["weight norm removed"]
+    folded = fold_batch_norm(net_g)
+    if folded:
+        steps.append("%d BatchNorm folded" % folded)
+    if compile_mode != "none":
+        steps.append("compile: %s" % compile_generator(net_g, compile_mode))
+    return ", ".join(steps)
+
+
+def real_time_factor(net_g: nn.Module, if_f0: int, feature_size: int, seconds: float = 10, repeat: int = 3) -> float:
+    """Best synthesis time of `seconds` of random features, divided by `seconds`."""
+    frames = int(seconds * 100)
+    feats = torch.randn(1, frames, feature_size)
+    p_len = torch.tensor([frames]).long()
+    sid = torch.tensor([0]).long()
+    pitchf = torch.full((1, frames), 200.0)
+    pitch = torch.full((1, frames), 100).long()
+    best = float("inf")
+    with torch.no_grad():
+        for _ in range(repeat):
+            time_start = perf_counter()
+            if if_f0 == 1:
+                net_g.infer(feats, p_len, pitch, pitchf, sid)
+            else:
+                net_g.infer(feats, p_len, sid)
+            best = min(best, perf_counter() - time_start)
+    return best / seconds
+
+
+if __name__ == "__main__":
+    from modules.voice_conversion.rvc.rvc import build_synthesizer
+
+    torch.manual_seed(0)
+    cpt = torch.load(sys.argv[1], map_location="cpu")
+    if_f0 = cpt.get("f0", 1)
+    feature_size = 256 if cpt.get("version", "v1") == "v1" else 768
+
+    baseline = build_synthesizer(cpt, "cpu", is_half=False)
+    print("CPU real-time factor (lower is faster), %d threads" % torch.get_num_threads())
+    reference = real_time_factor(baseline, if_f0, feature_size)
+    print("  %-32s %.3f" % ("original", reference))
+    for mode in COMPILE_MODES:
+        net_g = build_synthesizer(cpt, "cpu", is_half=False)
+        description = optimize_for_inference(net_g, mode)
+        real_time_factor(net_g, if_f0, feature_size, seconds=1, repeat=1)  # warm-up / compilation
+        rtf = real_time_factor(net_g, if_f0, feature_size)
+        print("  %-32s %.3f (x%.2f)" % (description, rtf, reference / rtf))
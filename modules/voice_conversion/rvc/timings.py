@@ -0,0 +1,89 @@
+"""
+Per-stage timings of RVC conversions
+
+Each conversion fills a `ConversionTrace` with the time spent in each stage (decode, hubert,
+index search, f0, synthesis, rms mix, wav encode...) and whether the models came from the cache.
+Traces are returned to the client in the `Server-Timing` and `X-RVC-Cache` response headers,
+and recorded in `stats`, which keeps the most recent conversions for percentile statistics.
+"""
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import threading
+from time import time as ttime
+from typing import Any, Dict
+
+import numpy as np
+
+STATS_WINDOW = 500  # number of recent conversions kept for statistics
+
+
+class ConversionTrace:
+    def __init__(self) -> None:
+        self.stages = defaultdict(float)  # stage -> seconds, in first-recorded order
+        self.cache = {}  # cache name -> "hit" / "miss"
+        self.info = {}  # other facts about the conversion (decoder used, ...)
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.stages[stage] += seconds
+
+    @contextmanager
+    def measure(self, stage: str):
+        time_start = ttime()
+        try:
+            yield
+        finally:
+            self.add(stage, ttime() - time_start)
+
+    def cache_result(self, name: str, hit: bool) -> None:
+        self.cache[name] = "hit" if hit else "miss"
+
+    def total(self) -> float:
+        return sum(self.stages.values())
+
+    def server_timing(self) -> str:
+        """Value of a `Server-Timing` header (durations in milliseconds)."""
+        entries = ["%s;dur=%.1f" % (stage.replace(" ", "-"), seconds * 1000) for stage, seconds in self.stages.items()]
+        entries.append("total;dur=%.1f" % (self.total() * 1000))
+        return ", ".join(entries)
+
+    def cache_header(self) -> str:
+        return ", ".join("%s=%s" % (name, result) for name, result in self.cache.items())
+
+    def summary(self) -> str:
+        stages = ", ".join("%s: %.3fs" % (stage, seconds) for stage, seconds in self.stages.items())
+        extra = ", ".join("%s: %s" % item for item in list(self.info.items()) + list(self.cache.items()))
+        return stages + (" (" + extra + ")" if extra else "")
+
+
+class RollingStats:
+    """Percentiles of the stage timings and cache hit rates over the last `window` conversions."""
+
+    def __init__(self, window: int = STATS_WINDOW) -> None:
+        self.window = window
+        self.conversions = 0
+        self._stages = defaultdict(lambda: deque(maxlen=self.window))
+        self._cache = defaultdict(lambda: deque(maxlen=self.window))
+        self._lock = threading.Lock()
+
+    def record(self, trace: ConversionTrace) -> None:
+        with self._lock:
+            self.conversions += 1
+            for stage, seconds in trace.stages.items():
+                self._stages[stage].append(seconds)
+            self._stages["total"].append(trace.total())
+            for name, result in trace.cache.items():
+                self._cache[name].append(result == "hit")
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            stages = {stage: {"count": len(values),
+                              "p50_ms": round(float(np.percentile(values, 50)) * 1000, 1),
+                              "p95_ms": round(float(np.percentile(values, 95)) * 1000, 1),
+                              "mean_ms": round(float(np.mean(values)) * 1000, 1)}
+                      for stage, values in self._stages.items() if values}
+            cache = {name: {"count": len(values), "hit_rate": round(sum(values) / len(values), 3)}
+                     for name, values in self._cache.items() if values}
+            return {"conversions": self.conversions, "window": self.window, "stages": stages, "cache": cache}
+
+
+stats = RollingStats()
@@ -10,8 +10,12 @@ import torch.nn.functional as F
 import scipy.signal as signal
 import pyworld, os, traceback, faiss, librosa, torchcrepe
 from scipy import signal
+from contextlib import ExitStack
 from functools import lru_cache
 
+from modules.voice_conversion.rvc import index_cache
+from modules.voice_conversion.rvc.precision import autocast
+
 bh, ah = signal.butter(N=5, Wn=48, btype="high", fs=16000)
 
 input_audio_path2wav = {}
@@ -31,28 +35,56 @@ def cache_harvest_f0(input_audio_path, fs, f0max, f0min, frame_period):
     return f0
 
 
+def frame_rms(y, frame_length, hop_length):
+    """
+    Same as librosa.feature.rms(y=y, frame_length=frame_length, hop_length=hop_length)[0]
+    (centered frames, zero padding), from a cumulative sum of squares.
+    """
+    y_pad = np.pad(y.astype(np.float64), frame_length // 2)
+    n_frames = 1 + (y_pad.shape[0] - frame_length) // hop_length
+    power_cumsum = np.concatenate(([0.0], np.cumsum(np.square(y_pad))))
+    starts = np.arange(n_frames) * hop_length
+    power = (power_cumsum[starts + frame_length] - power_cumsum[starts]) / frame_length
+    return np.sqrt(np.maximum(power, 0.0))
+
+
+def interpolate_linear(values, size):
+    """Same as F.interpolate(..., size=size, mode="linear") (align_corners=False) on a 1D array."""
+    scale = values.shape[0] / size
+    x = np.maximum((np.arange(size) + 0.5) * scale - 0.5, 0.0)
+    return np.interp(x, np.arange(values.shape[0]), values)
+
+
 def change_rms(data1, sr1, data2, sr2, rate):  # 1是输入音频，2是输出音频,rate是2的占比
     # print(data1.max(),data2.max())
-    rms1 = librosa.feature.rms(
-        y=data1, frame_length=sr1 // 2 * 2, hop_length=sr1 // 2
-    )  # 每半秒一个点
-    rms2 = librosa.feature.rms(y=data2, frame_length=sr2 // 2 * 2, hop_length=sr2 // 2)
-    rms1 = torch.from_numpy(rms1)
-    rms1 = F.interpolate(
-        rms1.unsqueeze(0), size=data2.shape[0], mode="linear"
-    ).squeeze()
-    rms2 = torch.from_numpy(rms2)
-    rms2 = F.interpolate(
-        rms2.unsqueeze(0), size=data2.shape[0], mode="linear"
-    ).squeeze()
-    rms2 = torch.max(rms2, torch.zeros_like(rms2) + 1e-6)
-    data2 *= (
-        torch.pow(rms1, torch.tensor(1 - rate))
-        * torch.pow(rms2, torch.tensor(rate - 1))
-    ).numpy()
+    rms1 = frame_rms(data1, sr1 // 2 * 2, sr1 // 2)  # 每半秒一个点
+    rms2 = frame_rms(data2, sr2 // 2 * 2, sr2 // 2)
+    rms1 = interpolate_linear(rms1, data2.shape[0])
+    rms2 = interpolate_linear(rms2, data2.shape[0])
+    rms2 = np.maximum(rms2, 1e-6)
+    data2 *= np.power(rms1, 1 - rate) * np.power(rms2, rate - 1)
     return data2
 
 
+def split_points(audio, window, t_center, t_query):
+    """
+    Cut points for processing long audio in segments: around every `t_center` samples, the position
+    within +-`t_query` where the sum of the `window` surrounding samples has the smallest magnitude.
+    """
+    audio_pad = np.pad(audio, (window // 2, window // 2), mode="reflect")
+    cumsum = np.concatenate(([0.0], np.cumsum(audio_pad)))
+    audio_sum = np.abs(cumsum[window : window + audio.shape[0]] - cumsum[: audio.shape[0]])
+
+    centers = np.arange(t_center, audio.shape[0], t_center)
+    if centers.shape[0] == 0:
+        return []
+    # Search windows of the last cut point may run past the end of the audio
+    overflow = max(0, centers[-1] + t_query - audio.shape[0])
+    audio_sum = np.pad(audio_sum, (0, overflow), constant_values=np.inf)
+    windows = np.lib.stride_tricks.sliding_window_view(audio_sum, 2 * t_query)[centers - t_query]
+    return list(centers - t_query + np.argmin(windows, axis=1))
+
+
 class VC(object):
     def __init__(self, tgt_sr, config):
         self.x_pad, self.x_query, self.x_center, self.x_max, self.is_half = (
@@ -71,6 +103,9 @@ class VC(object):
         self.t_center = self.sr * self.x_center  # 查询切点位置
         self.t_max = self.sr * self.x_max  # 免查询时长阈值
         self.device = config.device
+        self.cpu_precision = config.cpu_precision if self.device == "cpu" else "fp32"
+        # Segments of long audio are run together, up to this many (padded) input samples per forward pass. 0 = one at a time
+        self.batch_samples = int(config.batch_seconds * self.sr)
 
     def get_f0(
         self,
@@ -91,7 +126,8 @@ class VC(object):
         f0_mel_max = 1127 * np.log(1 + f0_max / 700)
 
         import modules.voice_conversion.rvc.custom_pitch_extraction as cpe
-        f0 = cpe.pitch_extract(f0_method, x, f0_min, f0_max, p_len, time_step, self.sr, self.window, crepe_hop_length, filter_radius)
+        f0 = cpe.pitch_extract(f0_method, x, f0_min, f0_max, p_len, time_step, self.sr, self.window, crepe_hop_length, filter_radius,
+                               device=self.device, is_half=self.is_half)
 
         f0 *= pow(2, f0_up_key / 12)
         # with open("test.txt","w")as f:f.write("\n".join([str(i)for i in f0.tolist()]))
@@ -150,11 +186,14 @@ class VC(object):
             "output_layer": 9 if version == "v1" else 12,
         }
         t0 = ttime()
-        with torch.no_grad():
+        with torch.no_grad(), autocast(self.cpu_precision):
             logits = model.extract_features(**inputs)
             feats = model.final_proj(logits[0]) if version == "v1" else logits[0]
+        if feats.dtype == torch.bfloat16:
+            feats = feats.float()
         if protect < 0.5:
             feats0 = feats.clone()
+        t_hubert = ttime()
         if (
             isinstance(index, type(None)) == False
             and isinstance(big_npy, type(None)) == False
@@ -200,7 +239,7 @@ class VC(object):
             feats = feats * pitchff + feats0 * (1 - pitchff)
             feats = feats.to(feats0.dtype)
         p_len = torch.tensor([p_len], device=self.device).long()
-        with torch.no_grad():
+        with torch.no_grad(), autocast(self.cpu_precision):
             if pitch != None and pitchf != None:
                 audio1 = (
                     (net_g.infer(feats, p_len, pitch, pitchf, sid)[0][0, 0])
@@ -216,10 +255,127 @@ class VC(object):
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
         t2 = ttime()
-        times[0] += t1 - t0
-        times[2] += t2 - t1
+        times.add("hubert", t_hubert - t0)
+        times.add("index_search", t1 - t_hubert)
+        times.add("synthesis", t2 - t1)
         return audio1
 
+    def vc_batch(
+        self,
+        model,
+        net_g,
+        sid,
+        audios,
+        pitches,
+        pitchfs,
+        times,
+        index,
+        big_npy,
+        index_rate,
+        version,
+        protect,
+    ):
+        """
+        Same as `vc`, for several segments in one HuBERT transformer and one synthesizer forward pass.
+        HuBERT runs its conv feature extractor on each segment alone (see `extract_features_batch`), the
+        features are padded to the longest segment, and each output is trimmed back to the length `vc` would give.
+        """
+        batch_size = len(audios)
+        lengths = [audio0.shape[0] for audio0 in audios]
+        sources = [torch.from_numpy(audio0).to(self.device) for audio0 in audios]
+        sources = [source.half() if self.is_half else source.float() for source in sources]
+
+        t0 = ttime()
+        with torch.no_grad(), autocast(self.cpu_precision):
+            logits = model.extract_features_batch(sources, output_layer=9 if version == "v1" else 12)
+            feats = model.final_proj(logits[0]) if version == "v1" else logits[0]
+        if feats.dtype == torch.bfloat16:
+            feats = feats.float()
+        if protect < 0.5:
+            feats0 = feats.clone()
+        t_hubert = ttime()
+        if (
+            isinstance(index, type(None)) == False
+            and isinstance(big_npy, type(None)) == False
+            and index_rate != 0
+        ):
+            npy = feats.reshape(-1, feats.shape[-1]).cpu().numpy()
+            if self.is_half:
+                npy = npy.astype("float32")
+
+            score, ix = index.search(npy, k=8)
+            weight = np.square(1 / score)
+            weight /= weight.sum(axis=1, keepdims=True)
+            npy = np.sum(big_npy[ix] * np.expand_dims(weight, axis=2), axis=1)
+
+            if self.is_half:
+                npy = npy.astype("float16")
+            feats = (
+                torch.from_numpy(npy).reshape(feats.shape).to(self.device) * index_rate
+                + (1 - index_rate) * feats
+            )
+
+        feats = F.interpolate(feats.permute(0, 2, 1), scale_factor=2).permute(0, 2, 1)
+        if protect < 0.5:
+            feats0 = F.interpolate(feats0.permute(0, 2, 1), scale_factor=2).permute(
+                0, 2, 1
+            )
+        t1 = ttime()
+        # Number of frames `vc` would synthesize for each segment alone (HuBERT: 400 samples window, 320 hop)
+        p_lens = [
+            min(length // self.window, 2 * ((length - 400) // 320 + 1))
+            for length in lengths
+        ]
+        if pitches is not None:
+            p_lens = [min(p_len, pitch0.shape[1]) for p_len, pitch0 in zip(p_lens, pitches)]
+        max_p_len = max(p_lens)
+        feats = feats[:, :max_p_len]
+        if protect < 0.5:
+            feats0 = feats0[:, :max_p_len]
+
+        if pitches is not None:
+            pitch = torch.zeros(batch_size, max_p_len, dtype=torch.long, device=self.device)
+            pitchf = torch.zeros(batch_size, max_p_len, device=self.device)
+            for i in range(batch_size):
+                pitch[i, : p_lens[i]] = pitches[i][0, : p_lens[i]]
+                pitchf[i, : p_lens[i]] = pitchfs[i][0, : p_lens[i]]
+
+        if protect < 0.5 and pitches is not None:
+            pitchff = pitchf.clone()
+            pitchff[pitchf > 0] = 1
+            pitchff[pitchf < 1] = protect
+            pitchff = pitchff.unsqueeze(-1)
+            feats = feats * pitchff + feats0 * (1 - pitchff)
+            feats = feats.to(feats0.dtype)
+        p_len = torch.tensor(p_lens, device=self.device).long()
+        sids = sid.expand(batch_size)
+        with torch.no_grad(), autocast(self.cpu_precision):
+            if pitches is not None:
+                audio1 = net_g.infer(feats, p_len, pitch, pitchf, sids)[0][:, 0]
+            else:
+                audio1 = net_g.infer(feats, p_len, sids)[0][:, 0]
+            audio1 = audio1.data.cpu().float().numpy()
+        samples_per_frame = audio1.shape[1] // max_p_len
+        del feats, p_len
+        t2 = ttime()
+        times.add("hubert", t_hubert - t0)
+        times.add("index_search", t1 - t_hubert)
+        times.add("synthesis", t2 - t1)
+        return [audio1[i, : p_lens[i] * samples_per_frame] for i in range(batch_size)]
+
+    def batch_segments(self, segments):
+        """Group consecutive segments so that each group, padded to its longest segment, fits in `batch_samples`."""
+        batches = []
+        batch = []
+        for segment in segments:
+            longest = max([segment[0].shape[0]] + [other[0].shape[0] for other in batch])
+            if batch and longest * (len(batch) + 1) > self.batch_samples:
+                batches.append(batch)
+                batch = []
+            batch.append(segment)
+        batches.append(batch)
+        return batches
+
     def pipeline(
         self,
         model,
@@ -243,6 +399,7 @@ class VC(object):
         f0_file=None,
         crepe_hop_length=128
     ):
+        index_pin = ExitStack()  # keeps the index loaded until the conversion is done
         if (
             file_index != ""
             # and file_big_npy != ""
@@ -251,152 +408,132 @@ class VC(object):
             and index_rate != 0
         ):
             try:
-                index = faiss.read_index(file_index)
                 # big_npy = np.load(file_big_npy)
-                big_npy = index.reconstruct_n(0, index.ntotal)
+                times.cache_result("index", index_cache.is_cached(file_index))
+                with times.measure("index_load"):
+                    index, big_npy = index_pin.enter_context(index_cache.use_index(file_index))
             except:
                 traceback.print_exc()
                 index = big_npy = None
         else:
             index = big_npy = None
-        audio = signal.filtfilt(bh, ah, audio)
-        audio_pad = np.pad(audio, (self.window // 2, self.window // 2), mode="reflect")
-        opt_ts = []
-        if audio_pad.shape[0] > self.t_max:
-            audio_sum = np.zeros_like(audio)
-            for i in range(self.window):
-                audio_sum += audio_pad[i : i - self.window]
-            for t in range(self.t_center, audio.shape[0], self.t_center):
-                opt_ts.append(
-                    t
-                    - self.t_query
-                    + np.where(
-                        np.abs(audio_sum[t - self.t_query : t + self.t_query])
-                        == np.abs(audio_sum[t - self.t_query : t + self.t_query]).min()
-                    )[0][0]
-                )
-        s = 0
-        audio_opt = []
-        t = None
-        t1 = ttime()
-        audio_pad = np.pad(audio, (self.t_pad, self.t_pad), mode="reflect")
-        p_len = audio_pad.shape[0] // self.window
-        inp_f0 = None
-        if hasattr(f0_file, "name") == True:
-            try:
-                with open(f0_file.name, "r") as f:
-                    lines = f.read().strip("\n").split("\n")
-                inp_f0 = []
-                for line in lines:
-                    inp_f0.append([float(i) for i in line.split(",")])
-                inp_f0 = np.array(inp_f0, dtype="float32")
-            except:
-                traceback.print_exc()
-        sid = torch.tensor(sid, device=self.device).unsqueeze(0).long()
-        pitch, pitchf = None, None
-        if if_f0 == 1:
-            pitch, pitchf = self.get_f0(
-                input_audio_path,
-                audio_pad,
-                p_len,
-                f0_up_key,
-                f0_method,
-                filter_radius,
-                inp_f0,
-                crepe_hop_length=crepe_hop_length
-            )
-            pitch = pitch[:p_len]
-            pitchf = pitchf[:p_len]
-            if self.device == "mps":
-                pitchf = pitchf.astype(np.float32)
-            pitch = torch.tensor(pitch, device=self.device).unsqueeze(0).long()
-            pitchf = torch.tensor(pitchf, device=self.device).unsqueeze(0).float()
-        t2 = ttime()
-        times[1] += t2 - t1
-        for t in opt_ts:
-            t = t // self.window * self.window
+        with index_pin:
+            audio = signal.filtfilt(bh, ah, audio)
+            opt_ts = []
+            if audio.shape[0] + self.window > self.t_max:
+                opt_ts = split_points(audio, self.window, self.t_center, self.t_query)
+            s = 0
+            audio_opt = []
+            t = None
+            t1 = ttime()
+            audio_pad = np.pad(audio, (self.t_pad, self.t_pad), mode="reflect")
+            p_len = audio_pad.shape[0] // self.window
+            inp_f0 = None
+            if hasattr(f0_file, "name") == True:
+                try:
+                    with open(f0_file.name, "r") as f:
+                        lines = f.read().strip("\n").split("\n")
+                    inp_f0 = []
+                    for line in lines:
+                        inp_f0.append([float(i) for i in line.split(",")])
+                    inp_f0 = np.array(inp_f0, dtype="float32")
+                except:
+                    traceback.print_exc()
+            sid = torch.tensor(sid, device=self.device).unsqueeze(0).long()
+            pitch, pitchf = None, None
             if if_f0 == 1:
-                audio_opt.append(
-                    self.vc(
-                        model,
-                        net_g,
-                        sid,
+                pitch, pitchf = self.get_f0(
+                    input_audio_path,
+                    audio_pad,
+                    p_len,
+                    f0_up_key,
+                    f0_method,
+                    filter_radius,
+                    inp_f0,
+                    crepe_hop_length=crepe_hop_length
+                )
+                pitch = pitch[:p_len]
+                pitchf = pitchf[:p_len]
+                if self.device == "mps":
+                    pitchf = pitchf.astype(np.float32)
+                pitch = torch.tensor(pitch, device=self.device).unsqueeze(0).long()
+                pitchf = torch.tensor(pitchf, device=self.device).unsqueeze(0).float()
+            t2 = ttime()
+            times.add("f0", t2 - t1)
+            # Segments: (audio, pitch, pitchf) cut at the split points, each with t_pad of context on both sides
+            segments = []
+            for t in opt_ts:
+                t = t // self.window * self.window
+                if if_f0 == 1:
+                    segments.append((
                         audio_pad[s : t + self.t_pad2 + self.window],
                         pitch[:, s // self.window : (t + self.t_pad2) // self.window],
                         pitchf[:, s // self.window : (t + self.t_pad2) // self.window],
-                        times,
-                        index,
-                        big_npy,
-                        index_rate,
-                        version,
-                        protect,
-                    )[self.t_pad_tgt : -self.t_pad_tgt]
-                )
-            else:
-                audio_opt.append(
-                    self.vc(
-                        model,
-                        net_g,
-                        sid,
-                        audio_pad[s : t + self.t_pad2 + self.window],
-                        None,
-                        None,
-                        times,
-                        index,
-                        big_npy,
-                        index_rate,
-                        version,
-                        protect,
-                    )[self.t_pad_tgt : -self.t_pad_tgt]
-                )
-            s = t
-        if if_f0 == 1:
-            audio_opt.append(
-                self.vc(
-                    model,
-                    net_g,
-                    sid,
+                    ))
+                else:
+                    segments.append((audio_pad[s : t + self.t_pad2 + self.window], None, None))
+                s = t
+            if if_f0 == 1:
+                segments.append((
                     audio_pad[t:],
                     pitch[:, t // self.window :] if t is not None else pitch,
                     pitchf[:, t // self.window :] if t is not None else pitchf,
-                    times,
-                    index,
-                    big_npy,
-                    index_rate,
-                    version,
-                    protect,
-                )[self.t_pad_tgt : -self.t_pad_tgt]
-            )
-        else:
-            audio_opt.append(
-                self.vc(
-                    model,
-                    net_g,
-                    sid,
-                    audio_pad[t:],
-                    None,
-                    None,
-                    times,
-                    index,
-                    big_npy,
-                    index_rate,
-                    version,
-                    protect,
-                )[self.t_pad_tgt : -self.t_pad_tgt]
-            )
-        audio_opt = np.concatenate(audio_opt)
-        if rms_mix_rate != 1:
-            audio_opt = change_rms(audio, 16000, audio_opt, tgt_sr, rms_mix_rate)
-        if resample_sr >= 16000 and tgt_sr != resample_sr:
-            audio_opt = librosa.resample(
-                audio_opt, orig_sr=tgt_sr, target_sr=resample_sr
-            )
-        audio_max = np.abs(audio_opt).max() / 0.99
-        max_int16 = 32768
-        if audio_max > 1:
-            max_int16 /= audio_max
-        audio_opt = (audio_opt * max_int16).astype(np.int16)
-        del pitch, pitchf, sid
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        return audio_opt
+                ))
+            else:
+                segments.append((audio_pad[t:], None, None))
+
+            if self.batch_samples > 0 and len(segments) > 1:
+                for batch in self.batch_segments(segments):
+                    audio_opt.extend(
+                        audio1[self.t_pad_tgt : -self.t_pad_tgt]
+                        for audio1 in self.vc_batch(
+                            model,
+                            net_g,
+                            sid,
+                            [segment[0] for segment in batch],
+                            [segment[1] for segment in batch] if if_f0 == 1 else None,
+                            [segment[2] for segment in batch] if if_f0 == 1 else None,
+                            times,
+                            index,
+                            big_npy,
+                            index_rate,
+                            version,
+                            protect,
+                        )
+                    )
+            else:
+                for audio0, pitch0, pitchf0 in segments:
+                    audio_opt.append(
+                        self.vc(
+                            model,
+                            net_g,
+                            sid,
+                            audio0,
+                            pitch0,
+                            pitchf0,
+                            times,
+                            index,
+                            big_npy,
+                            index_rate,
+                            version,
+                            protect,
+                        )[self.t_pad_tgt : -self.t_pad_tgt]
+                    )
+            audio_opt = np.concatenate(audio_opt)
+            if rms_mix_rate != 1:
+                with times.measure("rms_mix"):
+                    audio_opt = change_rms(audio, 16000, audio_opt, tgt_sr, rms_mix_rate)
+            if resample_sr >= 16000 and tgt_sr != resample_sr:
+                with times.measure("resample"):
+                    audio_opt = librosa.resample(
+                        audio_opt, orig_sr=tgt_sr, target_sr=resample_sr
+                    )
+            audio_max = np.abs(audio_opt).max() / 0.99
+            max_int16 = 32768
+            if audio_max > 1:
+                max_int16 /= audio_max
+            audio_opt = (audio_opt * max_int16).astype(np.int16)
+            del pitch, pitchf, sid
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            return audio_opt
@@ -12,15 +12,25 @@ References:
         - RVC-webui: https://github.com/RVC-Project/Retrieval-based-Voice-Conversion-WebUI
         - Audio-webui: https://github.com/gitmylo/audio-webui
 """
-from flask import abort, request, send_file, jsonify
+from flask import abort, request, send_file, jsonify, Response, stream_with_context
+from contextlib import ExitStack
 import json
 from scipy.io import wavfile
+import numpy as np
 import os
 import io
 import shutil
+import struct
+import threading
+import time
 from py7zr import pack_7zarchive, unpack_7zarchive
 
 import modules.voice_conversion.rvc.rvc as rvc
+from modules.voice_conversion.rvc import index_cache, result_cache
+from modules.voice_conversion.rvc.stream import RVCStream
+from modules.voice_conversion.rvc.timings import ConversionTrace, stats as conversion_stats
+from modules.model_manager import model_registry
+from modules import audio_encoding, job_queue
 import modules.classify.classify_module as classify_module
 
 DEBUG_PREFIX = "<RVC module>"
@@ -32,8 +42,21 @@ TEMP_FOLDER_PATH = "data/tmp/"
 RVC_INPUT_PATH = "data/tmp/rvc_input.wav"
 RVC_OUTPUT_PATH ="data/tmp/rvc_output.wav"
 
+STREAM_READ_SIZE = 8192  # bytes read at a time from a streamed request body
+
+EMOTIONS = ["anger","fear", "joy","love","sadness","surprise"]  # labels of the emotion classifier, and model file names
+
 save_file = False
 classification_mode = False
+rvc_queue = None  # conversion jobs, run one at a time on the worker of the RVC device
+
+# TTS backends of the chained text to RVC endpoint, registered by the server for the enabled TTS modules:
+# name -> function(tts parameters) returning a (sample rate, waveform) tuple or a BytesIO of an audio file
+tts_backends = {}
+
+# Character folders whose emotion models are being preloaded
+preloading_folders = set()
+preloading_lock = threading.Lock()
 
 # register file format at first.
 shutil.register_archive_format('7zip', pack_7zarchive, description='7zip archive')
@@ -137,107 +160,227 @@ def rvc_upload_models():
         print(e)
         abort(500, DEBUG_PREFIX + " Exception occurs while uploading models.")
 
-def rvc_process_audio():
+def find_model_files(folder_path):
     """
-    Process request audio file with the loaded RVC model
-    Expected request format:
-        modelName: string,
-        pitchExtraction: string,
-        pitchOffset: int,
-        indexRate: float [0,1],
-        filterRadius: int [0,7],
-        rmsMixRate: rmsMixRate,
-        protect: float [0,1]
-        text: string
+    Return the pth file of the model folder and its index file ("" if none)
     """
-    global save_file
-    global classification_mode
-
-    try:
-        file = request.files.get('AudioFile')
-        print(DEBUG_PREFIX, "received:", file)
-        
-        # Create new instances of io.BytesIO() for each request
-        input_audio_path = io.BytesIO()
-        output_audio_path = io.BytesIO()
-
-        if save_file:
-            input_audio_path = RVC_INPUT_PATH
-            output_audio_path = RVC_OUTPUT_PATH
-        
-        file.save(input_audio_path)
-        
-        if not save_file:
-            input_audio_path.seek(0)
-        
-        parameters = json.loads(request.form["json"])
-        
-        print(DEBUG_PREFIX, "Received audio conversion request with model", parameters)
-
-        folder_path = RVC_MODELS_PATH+parameters["modelName"]+"/"
-        model_path = None
-        index_path = None
-
-        # HACK: emotion mode EXPERIMENTAL
-        if classification_mode:
-            print(DEBUG_PREFIX,"EXPERIMENT MODE: emotions")
-
-            print("> Searching overide code ($emotion$)")
-            emotion = None
-            for code in ["anger","fear", "joy","love","sadness","surprise"]:
-                if "$"+code+"$" in parameters["text"]:
-                    print(" > Overide detected:",code)
-                    emotion = code
-                    parameters["text"] = parameters["text"].replace("$"+code+"$","")
-                    print(parameters["text"])
-                    break
-            
-            if emotion is None: 
-                print("> calling text classification pipeline")
-                emotions_score = classify_module.classify_text_emotion(parameters["text"])
+    model_path = None
+    index_path = None
+
+    print(DEBUG_PREFIX, "Check for pth file in ", folder_path)
+    for file_name in os.listdir(folder_path):
+        if file_name.endswith(".pth"):
+            print(" > set pth as ",file_name)
+            model_path = folder_path+file_name
+            break
+
+    if model_path is None:
+        abort(500, DEBUG_PREFIX + " No pth file found.")
+    
+    print(DEBUG_PREFIX, "Check for index file", folder_path)
+    for file_name in os.listdir(folder_path):
+        if file_name.endswith(".index"):
+            print(" > set index as ",file_name)
+            index_path = folder_path+file_name
+            break
 
-                print(" > ",emotions_score)
-                emotion = emotions_score[0]["label"]
-                print(" > Selected:", emotion)
+    if index_path is None:
+        index_path = ""
+        print(DEBUG_PREFIX, "no index file found, proceeding without index")
 
-            model_path = folder_path+emotion+".pth"
-            index_path = folder_path+emotion+".index"
+    return model_path, index_path
 
-            if not os.path.exists(model_path):
-                print("  > WARNING emotion model pth not found:",model_path," will try loading default")
-                model_path = None
+def streaming_wav_header(sample_rate):
+    """
+    Header of a 16 bit mono WAV of unknown length, players read it until the stream ends
+    """
+    data_size = 0xFFFFFFFF - 36
+    return (b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVE"
+            + b"fmt " + struct.pack("<IHHIIHH", 16, 1, 1, sample_rate, sample_rate * 2, 2, 16)
+            + b"data" + struct.pack("<I", data_size))
 
-            if not os.path.exists(index_path):
-                print("  > WARNING emotion model index not found:",index_path)
-                index_path = None
+def to_pcm16(audio):
+    return (np.clip(audio, -0.99, 0.99) * 32768).astype("<i2").tobytes()
 
-        if model_path is None:
-            print(DEBUG_PREFIX, "Check for pth file in ", folder_path)
-            for file_name in os.listdir(folder_path):
-                if file_name.endswith(".pth"):
-                    print(" > set pth as ",file_name)
-                    model_path = folder_path+file_name
+def rvc_process_stream():
+    """
+    Convert a stream of raw mono PCM audio with an RVC model, streaming the converted audio back
+    as it is produced (chunked transfer encoding both ways). Each block is converted on the RVC worker;
+    answers 429 when its queue is full.
+    Expected request:
+        - body: raw PCM samples, signed 16 bit little-endian (or 32 bit float with inputFormat=f32le)
+        - query string parameters:
+            modelName: string,
+            pitchExtraction: string,
+            pitchOffset: int,
+            indexRate: float [0,1],
+            filterRadius: int [0,7],
+            rmsMixRate: float [0,1],
+            protect: float [0,1],
+            sampleRate: int, sample rate of the input (default 16000)
+            inputFormat: s16le or f32le (default s16le)
+            outputFormat: wav or pcm (default wav), 16 bit mono at the model sample rate (X-Sample-Rate header)
+            blockSize, lookahead, crossfade: seconds (default 0.5, 0.2, 0.05)
+    """
+    parameters = request.args
+    print(DEBUG_PREFIX, "Received audio stream conversion request", dict(parameters))
+
+    folder_path = RVC_MODELS_PATH+parameters["modelName"]+"/"
+    if not os.path.isdir(folder_path):
+        abort(400, DEBUG_PREFIX + " Unknown model " + parameters["modelName"])
+    model_path, index_path = find_model_files(folder_path)
+
+    input_dtype = np.float32 if parameters.get("inputFormat", "s16le") == "f32le" else np.int16
+    sample_size = np.dtype(input_dtype).itemsize
+    output_wav = parameters.get("outputFormat", "wav") == "wav"
+    index_rate = float(parameters.get("indexRate", 0.75))
+
+    def load_models():
+        with rvc.use_rvc(model_path) as rvc_model, model_registry.use(rvc.HUBERT_KEY):
+            if index_path != "" and index_rate != 0:
+                with index_cache.use_index(index_path):
+                    pass
+            return rvc_model.tgt_sr
+
+    # Load the models now on the device worker, to report errors and the sample rate before streaming.
+    # New streams are rejected when the worker queue is full; accepted streams then wait for their turn for each block.
+    try:
+        tgt_sr = rvc_queue.submit(load_models)
+    except job_queue.QueueFull as e:
+        print(DEBUG_PREFIX, "Rejecting stream conversion request:", e)
+        abort(Response(DEBUG_PREFIX + " Too many conversions waiting, retry later.", status=429, headers={"Retry-After": "1"}))
+
+    def generate():
+        with rvc.use_rvc(model_path) as rvc_model, model_registry.use(rvc.HUBERT_KEY) as hubert_model, ExitStack() as index_pin:
+            index = big_npy = None
+            if index_path != "" and index_rate != 0:
+                index, big_npy = index_pin.enter_context(index_cache.use_index(index_path))
+
+            stream = RVCStream(
+                rvc_model, hubert_model, index, big_npy,
+                input_sr=int(parameters.get("sampleRate", 16000)),
+                f0_up_key=int(parameters.get("pitchOffset", 0)),
+                f0_method=parameters.get("pitchExtraction", "rmvpe"),
+                index_rate=index_rate,
+                filter_radius=int(parameters.get("filterRadius", 3)) // 2 * 2 + 1, # Need to be odd number
+                rms_mix_rate=float(parameters.get("rmsMixRate", 1.0)),
+                protect=float(parameters.get("protect", 0.33)),
+                block=float(parameters.get("blockSize", 0.5)),
+                lookahead=float(parameters.get("lookahead", 0.2)),
+                crossfade=float(parameters.get("crossfade", 0.05)),
+                run=rvc_queue.submit_wait)  # one block at a time on the device worker, between the other conversions
+
+            if output_wav:
+                yield streaming_wav_header(stream.tgt_sr)
+
+            remainder = b""
+            while True:
+                data = request.stream.read(STREAM_READ_SIZE)
+                if not data:
                     break
+                data = remainder + data
+                usable = len(data) // sample_size * sample_size
+                remainder = data[usable:]
+                audio = np.frombuffer(data[:usable], dtype=input_dtype).astype(np.float32)
+                if input_dtype == np.int16:
+                    audio /= 32768
+                output = stream.push(audio)
+                if len(output):
+                    yield to_pcm16(output)
+
+            output = stream.flush()
+            if len(output):
+                yield to_pcm16(output)
+            print(DEBUG_PREFIX, "Audio stream converted using RVC model:", model_path, "in", stream.blocks, "blocks",
+                  "(%s)" % stream.times.summary())
+
+    response = Response(stream_with_context(generate()), mimetype="audio/x-wav" if output_wav else "application/octet-stream")
+    response.headers["X-Sample-Rate"] = str(tgt_sr)
+    return response
+
+def preload_emotion_models(folder_path):
+    """
+    Emotion mode: load all the emotion models of a character folder (and their indexes) in the background,
+    so that switching emotion between lines does not load a model. They share the RVC model cache.
+    """
+    to_load = [(folder_path+emotion+".pth", folder_path+emotion+".index") for emotion in EMOTIONS
+               if os.path.exists(folder_path+emotion+".pth")
+               and not model_registry.is_loaded(rvc._rvc_key(folder_path+emotion+".pth"))]
+    with preloading_lock:
+        if not to_load or folder_path in preloading_folders:
+            return
+        preloading_folders.add(folder_path)
+
+    def preload():
+        try:
+            print(DEBUG_PREFIX, "Preloading", len(to_load), "emotion models of", folder_path)
+            for model_path, index_path in to_load:
+                rvc.load_rvc(model_path)
+                if os.path.exists(index_path):
+                    with index_cache.use_index(index_path):  # just load it into the cache
+                        pass
+        except Exception as e:
+            print(DEBUG_PREFIX, "Failed to preload emotion models of", folder_path, e)
+        finally:
+            with preloading_lock:
+                preloading_folders.discard(folder_path)
+
+    threading.Thread(target=preload, name="rvc-emotion-preload", daemon=True).start()
+
+def start_worker(max_depth):
+    """
+    Create the conversion worker of the RVC device, with up to max_depth requests waiting
+    """
+    global rvc_queue
+    rvc_queue = job_queue.get_queue("rvc:%s" % rvc.config.device, max_depth=max_depth)
 
-            if model_path is None:
-                abort(500, DEBUG_PREFIX + " No pth file found.")
-            
-            print(DEBUG_PREFIX, "Check for index file", folder_path)
-            for file_name in os.listdir(folder_path):
-                if file_name.endswith(".index"):
-                    print(" > set index as ",file_name)
-                    index_path = folder_path+file_name
-                    break
+def audio_bytes(audio_path):
+    """
+    Content of an audio file given as a path or a BytesIO
+    """
+    if isinstance(audio_path, io.BytesIO):
+        return audio_path.getvalue()
+    with open(audio_path, "rb") as f:
+        return f.read()
 
-            if index_path is None:
-                index_path = ""
-                print(DEBUG_PREFIX, "no index file found, proceeding without index")
-        
-        
-        print(DEBUG_PREFIX, "loading", model_path)
-        rvc.load_rvc(model_path)
-        
+def rvc_get_stats():
+    """
+    Return the p50/p95 duration of each conversion stage and the model cache hit rates
+    over the last conversions, and the state of the conversion worker
+    """
+    summary = conversion_stats.summary()
+    if result_cache.result_cache is not None:
+        summary["result_cache"] = result_cache.result_cache.stats()
+    summary["worker"] = rvc_queue.stats()
+    return jsonify(summary)
+
+def convert_audio(input_audio, model_path, index_path, parameters, audio_format="wav", sample_rate=None):
+    """
+    Conversion job, run by the RVC worker of the device. Return the encoded audio and the timings.
+    `input_audio` is the bytes of an audio file, or a (sample rate, waveform) tuple already in memory.
+    With save_file, the input/output files of the job get their own names, and replace
+    RVC_INPUT_PATH/RVC_OUTPUT_PATH once the conversion is done.
+    """
+    in_memory = isinstance(input_audio, tuple)
+    input_audio_path = input_audio if in_memory else io.BytesIO(input_audio)
+    output_audio_path = io.BytesIO()
+
+    if save_file:
+        job_id = rvc_queue.next_job_id()
+        saved_input_path = RVC_INPUT_PATH[:-len(".wav")] + "_%d.wav" % job_id
+        output_audio_path = RVC_OUTPUT_PATH[:-len(".wav")] + "_%d.wav" % job_id
+        if in_memory:
+            wavfile.write(saved_input_path, input_audio[0], np.asarray(input_audio[1], dtype=np.float32))
+        else:
+            with open(saved_input_path, "wb") as f:
+                f.write(input_audio)
+            input_audio_path = saved_input_path
+
+    print(DEBUG_PREFIX, "loading", model_path)
+    trace = ConversionTrace()
+    with rvc.use_rvc(model_path, trace) as rvc_model:
         info, (tgt_sr, wav_opt) = rvc.vc_single(
+            rvc_model=rvc_model,
             sid=0,
             input_audio_path=input_audio_path,
             f0_up_key=int(parameters["pitchOffset"]),
@@ -247,29 +390,224 @@ def rvc_process_audio():
             file_index2="",
             index_rate=float(parameters["indexRate"]),
             filter_radius=int(parameters["filterRadius"]) // 2 * 2 + 1, # Need to be odd number
-            resample_sr=0,
+            resample_sr=sample_rate or 0, # rates below 16000 are left to the encoder
             rms_mix_rate=float(parameters["rmsMixRate"]),
             protect=float(parameters["protect"]),
-            crepe_hop_length=128)
-        
-        #print(info) # DBG
+            crepe_hop_length=128,
+            trace=trace)
+
+    print(DEBUG_PREFIX, info)
+
+    #out_path = os.path.join("data/", "rvc_output.wav")
+    if audio_format == "wav" and sample_rate is None:
+        with trace.measure("wav_encode"):
+            wavfile.write(output_audio_path, tgt_sr, wav_opt)
+        output_audio = audio_bytes(output_audio_path)
+    else:
+        with trace.measure(audio_format + "_encode"):
+            output_audio = audio_encoding.encode(wav_opt, tgt_sr, audio_format, sample_rate)
+        if save_file:
+            with open(output_audio_path, "wb") as f:
+                f.write(output_audio)
+
+    if save_file:
+        os.replace(saved_input_path, RVC_INPUT_PATH)
+        os.replace(output_audio_path, RVC_OUTPUT_PATH)
+
+    print(DEBUG_PREFIX, "Audio converted using RVC model:", model_path)
+    return output_audio, trace
 
-        #out_path = os.path.join("data/", "rvc_output.wav")
-        wavfile.write(output_audio_path, tgt_sr, wav_opt)
+def strip_emotion_codes(text):
+    """
+    Remove the emotion override codes ($emotion$) from `text` in classification mode, so they are not spoken
+    """
+    if classification_mode:
+        for code in EMOTIONS:
+            text = text.replace("$"+code+"$", "")
+    return text
+
+def select_model_files(parameters):
+    """
+    Return the pth and index files of the requested voice folder, or of the emotion of
+    parameters["text"] in classification mode.
+    """
+    folder_path = RVC_MODELS_PATH+parameters["modelName"]+"/"
+    model_path = None
+    index_path = None
+
+    # HACK: emotion mode EXPERIMENTAL
+    if classification_mode:
+        print(DEBUG_PREFIX,"EXPERIMENT MODE: emotions")
+
+        print("> Searching overide code ($emotion$)")
+        emotion = None
+        for code in EMOTIONS:
+            if "$"+code+"$" in parameters["text"]:
+                print(" > Overide detected:",code)
+                emotion = code
+                parameters["text"] = parameters["text"].replace("$"+code+"$","")
+                print(parameters["text"])
+                break
+
+        if emotion is None: 
+            print("> calling text classification pipeline")
+            emotions_score = classify_module.classify_text_emotion(parameters["text"])
+
+            print(" > ",emotions_score)
+            emotion = emotions_score[0]["label"]
+            print(" > Selected:", emotion)
+
+        preload_emotion_models(folder_path)
+        model_path = folder_path+emotion+".pth"
+        index_path = folder_path+emotion+".index"
+
+        if not os.path.exists(model_path):
+            print("  > WARNING emotion model pth not found:",model_path," will try loading default")
+            model_path = None
+
+        if not os.path.exists(index_path):
+            print("  > WARNING emotion model index not found:",index_path)
+            index_path = None
+
+    if model_path is None:
+        model_path, index_path = find_model_files(folder_path)
+
+    return model_path, index_path
+
+def convert_response(input_audio, cache_input, parameters, audio_format, sample_rate):
+    """
+    Convert `input_audio` (bytes of an audio file, a (sample rate, waveform) tuple, or a function
+    returning one of them, called only when the result is not cached) on the RVC worker and return
+    the response. `cache_input` (bytes) identifies the input in the result cache.
+    """
+    model_path, index_path = select_model_files(parameters)
+
+    cache_key = None
+    if result_cache.result_cache is not None:
+        cache_parameters = {name: parameters[name] for name in
+                            ["pitchOffset", "pitchExtraction", "indexRate", "filterRadius", "rmsMixRate", "protect"]}
+        cache_parameters["precision"] = rvc.config.precision()
+        cache_parameters["format"] = audio_format
+        cache_parameters["sample_rate"] = sample_rate
+        cache_key = result_cache.ResultCache.key(cache_input, model_path, index_path, cache_parameters)
+        trace = ConversionTrace()
+        with trace.measure("result_cache"):
+            cached_audio = result_cache.result_cache.get(cache_key, audio_format)
+        if cached_audio is not None:
+            print(DEBUG_PREFIX, "Serving cached conversion", cache_key)
+            trace.cache_result("result", True)
+            conversion_stats.record(trace)
+            response = send_file(io.BytesIO(cached_audio), mimetype=audio_encoding.mimetype(audio_format))
+            response.headers["Server-Timing"] = trace.server_timing()
+            response.headers["X-RVC-Cache"] = trace.cache_header()
+            return response
+
+    if callable(input_audio):
+        time_start = time.perf_counter()
+        input_audio = input_audio()
+        tts_time = time.perf_counter() - time_start
+    else:
+        tts_time = None
+    output_audio, trace = rvc_queue.submit(convert_audio, input_audio, model_path, index_path, parameters,
+                                           audio_format, sample_rate)
+    if cache_key is not None:
+        trace.cache_result("result", False)
+        result_cache.result_cache.put(cache_key, output_audio, audio_format)
+    if tts_time is not None:
+        trace.add("tts", tts_time)
+    conversion_stats.record(trace)
+
+    # Return the output_audio_path object as a response
+    response = send_file(io.BytesIO(output_audio), mimetype=audio_encoding.mimetype(audio_format))
+    response.headers["Server-Timing"] = trace.server_timing()
+    response.headers["X-RVC-Cache"] = trace.cache_header()
+    response.headers["X-RVC-Precision"] = trace.info.get("precision", "")
+    return response
 
-        if not save_file:
-            output_audio_path.seek(0)  # Reset cursor position
+def rvc_process_audio():
+    """
+    Process request audio file with the loaded RVC model
+    Expected request format:
+        modelName: string,
+        pitchExtraction: string,
+        pitchOffset: int,
+        indexRate: float [0,1],
+        filterRadius: int [0,7],
+        rmsMixRate: rmsMixRate,
+        protect: float [0,1]
+        text: string
+        format: string, optional (wav, flac, ogg-opus or mp3)
+        sample_rate: int, optional
+    The conversion runs on the RVC worker of the device; when its queue is full the request
+    is answered with 429 Too Many Requests.
+    """
+    try:
+        file = request.files.get('AudioFile')
+        print(DEBUG_PREFIX, "received:", file)
         
-        print(DEBUG_PREFIX, "Audio converted using RVC model:", rvc.rvc_model_name)
+        input_audio = file.read()
         
-        # Return the output_audio_path object as a response
-        response = send_file(output_audio_path, mimetype="audio/x-wav")
-        return response
+        parameters = json.loads(request.form["json"])
+        
+        print(DEBUG_PREFIX, "Received audio conversion request with model", parameters)
 
+        try:
+            audio_format, sample_rate = audio_encoding.read_options(parameters)
+        except ValueError as e:
+            return Response(DEBUG_PREFIX + " " + str(e), status=400)
+
+        return convert_response(input_audio, input_audio, parameters, audio_format, sample_rate)
+
+    except job_queue.QueueFull as e:
+        print(DEBUG_PREFIX, "Rejecting conversion request:", e)
+        abort(Response(DEBUG_PREFIX + " Too many conversions waiting, retry later.", status=429, headers={"Retry-After": "1"}))
     except Exception as e:
         print(e)
         abort(500, DEBUG_PREFIX + " Exception occurs while processing audio.")
 
+def rvc_process_text():
+    """
+    Synthesize text with a TTS module and convert it with RVC in one request. The synthesized
+    waveform is passed to the RVC pipeline in memory, and resampled once to the HuBERT rate.
+    Expected request format (json):
+        text: string
+        tts: {backend: string (one of tts_backends), and the fields of the backend TTS request}
+        rvc: {the fields of process-audio, without text}
+        format: string, optional (wav, flac, ogg-opus or mp3)
+        sample_rate: int, optional
+    """
+    try:
+        request_json = request.get_json()
+        print(DEBUG_PREFIX, "Received text conversion request", request_json)
+
+        try:
+            audio_format, sample_rate = audio_encoding.read_options(request_json)
+        except ValueError as e:
+            return Response(DEBUG_PREFIX + " " + str(e), status=400)
+
+        tts_parameters = dict(request_json["tts"])
+        backend = tts_parameters.pop("backend", None)
+        if backend not in tts_backends:
+            return Response(DEBUG_PREFIX + " Unknown TTS backend %s, expected one of %s"
+                            % (backend, ", ".join(tts_backends)), status=400)
+        text = request_json["text"].replace("*", "")
+        tts_parameters["text"] = strip_emotion_codes(text)
+        parameters = dict(request_json["rvc"])
+        parameters["text"] = text  # with the override codes, for the emotion model selection
+
+        # Same text and TTS voice, same conversion: the result cache is keyed on the request, before synthesis
+        cache_input = json.dumps({"backend": backend, "tts": tts_parameters}, sort_keys=True).encode()
+        synthesize = lambda: tts_backends[backend](tts_parameters)
+
+        return convert_response(synthesize, cache_input, parameters, audio_format, sample_rate)
+
+    except job_queue.QueueFull as e:
+        print(DEBUG_PREFIX, "Rejecting conversion request:", e)
+        abort(Response(DEBUG_PREFIX + " Too many conversions waiting, retry later.", status=429, headers={"Retry-After": "1"}))
+    except Exception as e:
+        print(e)
+        abort(500, DEBUG_PREFIX + " Exception occurs while processing text.")
+
 def fix_model_install():
     """
     Fix RVC model organisation, move found pth/index file into 
@@ -36,13 +36,19 @@ from flask_cors import CORS
 from flask_compress import Compress
 import webuiapi
 
+from modules import audio_encoding, batching
+from modules.model_manager import model_registry
+
 from constants import (DEFAULT_SUMMARIZATION_MODEL,
                        DEFAULT_CLASSIFICATION_MODEL,
                        DEFAULT_CAPTIONING_MODEL,
                        DEFAULT_EMBEDDING_MODEL,
                        DEFAULT_SD_MODEL, DEFAULT_REMOTE_SD_HOST, DEFAULT_REMOTE_SD_PORT, PROMPT_PREFIX, NEGATIVE_PROMPT,
                        DEFAULT_CUDA_DEVICE,
-                       DEFAULT_CHROMA_PORT)
+                       DEFAULT_CHROMA_PORT,
+                       DEFAULT_BATCH_MAX_SIZE, DEFAULT_BATCH_MAX_WAIT_MS,
+                       DEFAULT_COQUI_CACHE_SIZE, DEFAULT_RVC_CACHE_SIZE, DEFAULT_RVC_INDEX_CACHE_MB,
+                       DEFAULT_RVC_QUEUE_SIZE)
 
 # --------------------------------------------------------------------------------
 # Inits that must run before we proceed any further
@@ -152,9 +158,14 @@ def get_extensions():
 # ----------------------------------------
 # caption
 
-captioning_pipeline = None  # populated when the module is loaded
+caption_batcher = None  # populated when the module is loaded
+def _caption_images(images: List[Image.Image]) -> List[str]:
+    with model_registry.use("caption") as captioning_pipeline:
+        outputs = captioning_pipeline(images, batch_size=len(images))
+    return [output[0]['generated_text'] for output in outputs]
+
 def _caption_image(raw_image: Image) -> str:
-    return captioning_pipeline(raw_image.convert("RGB"))[0]['generated_text']
+    return caption_batcher.submit(raw_image.convert("RGB"))
 
 @app.route("/api/caption", methods=["POST"])
 @require_module("caption")
@@ -176,10 +187,14 @@ def api_caption():
 # ----------------------------------------
 # summarize
 
-summarization_pipeline = None  # populated when the module is loaded
+summarize_batcher = None  # populated when the module is loaded
+def _summarize_batch(texts: List[str]) -> List[str]:
+    with model_registry.use("summarize") as summarization_pipeline:
+        outputs = summarization_pipeline(texts, batch_size=len(texts))
+    return [normalize_string(output['summary_text']) for output in outputs]
+
 def _summarize(text: str) -> str:
-    summary = normalize_string(summarization_pipeline(text)[0]['summary_text'])
-    return summary
+    return summarize_batcher.submit(text)
 
 def _summarize_chunks(text: str) -> str:
     """Summarize `text`, chunking it if necessary."""
@@ -348,14 +363,22 @@ def api_talkinghead_set_emotion():
 @app.route('/api/talkinghead/result_feed')
 @require_module("talkinghead")
 def api_talkinghead_result_feed():
-    """Live character output. Stream of video frames, each as a PNG encoded image."""
-    return talkinghead.result_feed()
+    """Live character output. Stream of video frames, each as a PNG encoded image.
+
+    Another frame codec can be requested with the query parameter `codec`, e.g. `?codec=webp`.
+    For the available codecs, see `talkinghead/tha3/app/frame_codecs.py`.
+    """
+    codec = request.args.get("codec", "png")
+    if codec not in talkinghead.CODECS:
+        abort(400, f"Unknown codec '{codec}'; valid: {', '.join(talkinghead.CODECS)}")
+    if codec == "raw" and request.remote_addr not in ("127.0.0.1", "::1"):
+        abort(400, 'The "raw" codec is only available on localhost')
+    return talkinghead.result_feed(codec)
 
 # ----------------------------------------
 # sd
 
 sd_use_remote = None  # populated when the module is loaded
-sd_pipe = None
 sd_remote = None
 sd_model = None
 sd_vae = None
@@ -385,14 +408,15 @@ def _generate_image(data: dict) -> Image:
             do_not_save_samples=False,
         ).image
     else:
-        image = sd_pipe(
-            prompt=prompt,
-            negative_prompt=data["negative_prompt"],
-            num_inference_steps=data["steps"],
-            guidance_scale=data["scale"],
-            width=data["width"],
-            height=data["height"],
-        ).images[0]
+        with model_registry.use("sd") as sd_pipe:
+            image = sd_pipe(
+                prompt=prompt,
+                negative_prompt=data["negative_prompt"],
+                num_inference_steps=data["steps"],
+                guidance_scale=data["scale"],
+                width=data["width"],
+                height=data["height"],
+            ).images[0]
 
     image.save("./debug.png")
     return image
@@ -518,6 +542,10 @@ def api_tts_generate():
         abort(400, '"text" is required')
     if "speaker" not in voice or not isinstance(voice["speaker"], str):
         abort(400, '"speaker" is required')
+    try:
+        audio_format, sample_rate = audio_encoding.read_options(voice)
+    except ValueError as e:
+        abort(400, str(e))
     # Remove asterisks
     voice["text"] = voice["text"].replace("*", "")
     try:
@@ -529,11 +557,27 @@ def api_tts_generate():
         audio_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.basename(audio))
 
         os.rename(audio, audio_file_path)
-        return send_file(audio_file_path, mimetype="audio/x-wav")
+        if audio_format == "wav" and sample_rate is None:
+            return send_file(audio_file_path, mimetype="audio/x-wav")
+        output_audio = audio_encoding.encode_file(audio_file_path, audio_format, sample_rate)
+        return send_file(BytesIO(output_audio), mimetype=audio_encoding.mimetype(audio_format))
     except Exception as e:
         print(e)
         abort(500, voice["speaker"])
 
+def silero_synthesize(parameters):
+    """Silero TTS for the chained text to RVC endpoint: return (sample rate, waveform)."""
+    import soundfile
+
+    if os.path.exists('test.wav'):
+        os.remove('test.wav')
+    audio_path = tts_service.generate(parameters["speaker"], parameters["text"])
+    try:
+        audio, sample_rate = soundfile.read(audio_path, dtype="float32")
+    finally:
+        os.remove(audio_path)
+    return sample_rate, audio
+
 @app.route("/api/tts/sample/<speaker>", methods=["GET"])
 @require_module("silero-tts")
 def api_tts_play_sample(speaker: str):
@@ -571,10 +615,32 @@ def api_edge_tts_generate():
         print(e)
         abort(500, data["voice"])
 
+def edge_synthesize(parameters):
+    """Edge TTS for the chained text to RVC endpoint: return the MP3 audio."""
+    rate = parameters["rate"] if isinstance(parameters.get("rate"), int) else 0
+    return BytesIO(edge.generate_audio(text=parameters["text"], voice=parameters["voice"], rate=rate))
+
 # ----------------------------------------
 # embeddings
 
-sentence_embedder = None  # populated when the module is loaded
+embeddings_batcher = None  # populated when the module is loaded
+
+def _embed_batch(requests: List[List[str]]) -> List[np.ndarray]:
+    """Encode the sentences of several requests in one pass, then split the vectors back per request."""
+    sentences = [sentence for sentences in requests for sentence in sentences]
+    if not sentences:  # `encode([])` returns a list, not an array
+        return [np.empty((0, 0), dtype=np.float32) for _ in requests]
+    with model_registry.use("embeddings") as sentence_embedder:
+        vectors = sentence_embedder.encode(sentences,  # split into forward passes of the default batch size (32)
+                                           show_progress_bar=True,  # on ST-extras console
+                                           convert_to_numpy=True,
+                                           normalize_embeddings=True)
+    results = []
+    start = 0
+    for sentences in requests:
+        results.append(vectors[start:start + len(sentences)])
+        start += len(sentences)
+    return results
 
 @app.route("/api/embeddings/compute", methods=["POST"])
 @require_module("embeddings")
@@ -614,16 +680,24 @@ def api_embeddings_compute():
     else:
         nitems = len(sentences)
     print(f"Computing vector embedding for {nitems} item{'s' if nitems != 1 else ''}")
-    vectors: Union[np.array, List[np.array]] = sentence_embedder.encode(sentences,
-                                                                        show_progress_bar=True,  # on ST-extras console
-                                                                        convert_to_numpy=True,
-                                                                        normalize_embeddings=True)
+    vectors: np.ndarray = embeddings_batcher.submit([sentences] if isinstance(sentences, str) else sentences)
+    if isinstance(sentences, str):
+        vectors = vectors[0]
     # NumPy arrays are not JSON serializable, so convert to Python lists
-    if isinstance(vectors, np.ndarray):
-        vectors = vectors.tolist()
-    else:  # isinstance(vectors, list) and all(isinstance(x, np.ndarray) for x in vectors)
-        vectors = [x.tolist() for x in vectors]
-    return jsonify({"embedding": vectors})
+    return jsonify({"embedding": vectors.tolist()})
+
+# ----------------------------------------
+# model manager, batching
+
+@app.route("/api/models/loaded", methods=["GET"])
+def api_models_loaded():
+    """List the models known to the model manager, whether they are loaded, and how much memory they use."""
+    return jsonify(model_registry.loaded_models())
+
+@app.route("/api/batching/stats", methods=["GET"])
+def api_batching_stats():
+    """Return queue depth and batch size statistics of the micro-batching schedulers, keyed by module."""
+    return jsonify(batching.get_stats())
 
 # ----------------------------------------
 # chromadb
@@ -928,12 +1002,39 @@ parser.add_argument(
     type=str, help="If THA3 models are not yet installed, use the given HuggingFace repository to install them. Defaults to OktayAlpk/talking-head-anime-3.",
     default="OktayAlpk/talking-head-anime-3"
 )
+parser.add_argument(
+    "--talkinghead-backpressure", type=str, help="With several viewers of the talkinghead result feed, render at the pace of the first connected one ('primary', default; slower viewers drop frames) or of the slowest one ('slowest').",
+    required=False, default="primary",
+    choices=["primary", "slowest"],
+)
+parser.add_argument(
+    "--talkinghead-encoder-threads", type=int, help="Number of threads encoding talkinghead frames in parallel (default 2).",
+    required=False, default=2,
+)
 
 parser.add_argument("--coqui-gpu", action="store_true", help="Run the voice models on the GPU (CPU is default)")
 parser.add_argument("--coqui-models", help="Install given Coqui-api TTS model at launch (comma separated list, last one will be loaded at start)")
+parser.add_argument("--coqui-cache-size", type=int, help="Number of Coqui TTS models kept loaded (default: %d)" % DEFAULT_COQUI_CACHE_SIZE)
+parser.add_argument("--coqui-cache-memory", type=float, help="Megabytes that loaded Coqui TTS models may use in total (default: unlimited)")
+
+parser.add_argument("--batch-max-size", type=int, help=f"Maximum number of requests run together in one forward pass by classify, embeddings, summarize and caption (1 disables batching, default {DEFAULT_BATCH_MAX_SIZE})")
+parser.add_argument("--batch-max-wait", type=float, help=f"Milliseconds to wait for more requests to join a batch (default {DEFAULT_BATCH_MAX_WAIT_MS})")
+
+parser.add_argument("--model-ram-budget", type=float, help="RAM in MB that loaded models may use; least recently used models are unloaded beyond it (default: unlimited)")
+parser.add_argument("--model-vram-budget", type=float, help="VRAM in MB that loaded models may use; least recently used models are unloaded beyond it (default: unlimited)")
+parser.add_argument("--model-idle-ttl", type=float, help="Unload models not used for this many seconds (default: never)")
+parser.add_argument("--preload-models", action="store_true", help="Load all models of the enabled modules at startup instead of on first use")
 
 parser.add_argument("--max-content-length", help="Set the max")
 parser.add_argument("--rvc-save-file", action="store_true", help="Save the last rvc input/output audio file into data/tmp/ folder (for research)")
+parser.add_argument("--rvc-cache-size", type=int, help="Number of RVC voice models kept loaded (default: %d)" % DEFAULT_RVC_CACHE_SIZE)
+parser.add_argument("--rvc-batch-seconds", type=float, help="Convert the segments of long RVC inputs in batches of up to this many seconds of (padded) audio per forward pass (default: 0, one segment at a time)")
+parser.add_argument("--rvc-compile", choices=["none", "jit", "compile"], help="Compile the RVC voice generator with torch.jit.script or torch.compile when a voice is loaded (default: none)")
+parser.add_argument("--rvc-cpu-precision", choices=["fp32", "bf16", "int8"], help="Precision of HuBERT and the RVC voices when running on CPU: bf16 autocast (CPUs with native bfloat16 only) or int8 dynamic quantization (default: fp32)")
+parser.add_argument("--rvc-result-cache-size", type=float, help="Megabytes of converted audio cached on disk in data/tmp/rvc_cache/, to answer identical RVC conversion requests without converting again (default: disabled)")
+parser.add_argument("--rvc-queue-size", type=int, help="Number of RVC conversion requests that may wait for the conversion worker, more are answered with 429 (default: %d)" % DEFAULT_RVC_QUEUE_SIZE)
+parser.add_argument("--rvc-index-cache-memory", type=float, help="Megabytes of loaded RVC voice indexes kept in memory (default: %d)" % DEFAULT_RVC_INDEX_CACHE_MB)
+parser.add_argument("--rvc-index-memmap", action="store_true", help="Store RVC index features as float16 next to the .index file and memory-map them")
 
 parser.add_argument("--stt-vosk-model-path", help="Load a custom vosk speech-to-text model")
 parser.add_argument("--stt-whisper-model-path", help="Load a custom vosk speech-to-text model")
@@ -982,6 +1083,8 @@ summarization_model = args.summarization_model if args.summarization_model else
 classification_model = args.classification_model if args.classification_model else DEFAULT_CLASSIFICATION_MODEL
 captioning_model = args.captioning_model if args.captioning_model else DEFAULT_CAPTIONING_MODEL
 embedding_model = args.embedding_model if args.embedding_model else DEFAULT_EMBEDDING_MODEL
+batch_max_size = args.batch_max_size if args.batch_max_size is not None else DEFAULT_BATCH_MAX_SIZE
+batch_max_wait = (args.batch_max_wait if args.batch_max_wait is not None else DEFAULT_BATCH_MAX_WAIT_MS) / 1000
 
 sd_use_remote = False if args.sd_model else True
 sd_model = args.sd_model if args.sd_model else DEFAULT_SD_MODEL
@@ -1009,6 +1112,10 @@ if max_content_length is not None:
 # ----------------------------------------
 # Modules init
 
+model_registry.configure(ram_budget_mb=args.model_ram_budget,
+                         vram_budget_mb=args.model_vram_budget,
+                         idle_ttl=args.model_idle_ttl)
+
 cuda_device = DEFAULT_CUDA_DEVICE if not args.cuda_device else args.cuda_device
 device_string = cuda_device if torch.cuda.is_available() and not args.cpu else 'mps' if torch.backends.mps.is_available() and not args.cpu else 'cpu'
 device = torch.device(device_string)
@@ -1043,38 +1150,49 @@ if "talkinghead" in modules:
         import talkinghead.tha3.app.app as talkinghead
         # mode: choices='The device to use for PyTorch ("cuda" for GPU, "cpu" for CPU).'
         # model: choices=['standard_float', 'separable_float', 'standard_half', 'separable_half'],
-        talkinghead.launch(mode, model)
+        talkinghead.launch(mode, model, backpressure=args.talkinghead_backpressure, encoder_workers=args.talkinghead_encoder_threads)
 
     except ModuleNotFoundError:
         print("Error: Could not import the 'talkinghead' module.")
 
 if "caption" in modules:
-    print("Initializing an image captioning model...")
-    captioning_pipeline = pipeline('image-to-text', model=captioning_model, device=device_string, torch_dtype=torch_dtype)
+    print("Registering an image captioning model...")
+    model_registry.register("caption",
+                            lambda: pipeline('image-to-text', model=captioning_model, device=device_string, torch_dtype=torch_dtype),
+                            device=device_string)
+    caption_batcher = batching.MicroBatcher("caption", _caption_images, max_batch_size=batch_max_size, max_wait=batch_max_wait)
 
 if "summarize" in modules:
-    print("Initializing a text summarization model...")
-    summarization_pipeline = pipeline('summarization', model=summarization_model, device=device_string, torch_dtype=torch_dtype)
+    print("Registering a text summarization model...")
+    model_registry.register("summarize",
+                            lambda: pipeline('summarization', model=summarization_model, device=device_string, torch_dtype=torch_dtype),
+                            device=device_string)
+    summarize_batcher = batching.MicroBatcher("summarize", _summarize_batch, max_batch_size=batch_max_size, max_wait=batch_max_wait)
 
 if "sd" in modules and not sd_use_remote:
     from diffusers import DiffusionPipeline
     from diffusers import EulerDiscreteScheduler
     from diffusers import AutoencoderKL
 
-    print("Initializing Stable Diffusion pipeline...")
+    print("Registering Stable Diffusion pipeline...")
     sd_device_string = cuda_device if torch.cuda.is_available() else 'mps' if torch.backends.mps.is_available() else 'cpu'
     sd_device = torch.device(sd_device_string)
     sd_torch_dtype = torch.float32 if sd_device_string != cuda_device else torch.float16
-    if args.sd_vae :
-        vae = AutoencoderKL.from_pretrained(sd_vae,torch_dtype=torch.float16)
-        print("Loading With Custom Vae")
-        sd_pipe = DiffusionPipeline.from_pretrained(sd_model, vae=vae, custom_pipeline="AlanB/lpw_stable_diffusion_update", torch_dtype=sd_torch_dtype, use_safetensors=True).to(sd_device)
-    else :
-        sd_pipe = DiffusionPipeline.from_pretrained(sd_model, custom_pipeline="AlanB/lpw_stable_diffusion_update", torch_dtype=sd_torch_dtype, use_safetensors=True).to(sd_device)
-    sd_pipe.safety_checker = lambda images, clip_input: (images, False)
-    sd_pipe.enable_attention_slicing()
-    # pipe.scheduler = KarrasVeScheduler.from_config(pipe.scheduler.config)
-    sd_pipe.scheduler = EulerDiscreteScheduler.from_config(sd_pipe.scheduler.config)
+
+    def _load_sd_pipeline():
+        if args.sd_vae :
+            vae = AutoencoderKL.from_pretrained(sd_vae,torch_dtype=torch.float16)
+            print("Loading With Custom Vae")
+            sd_pipe = DiffusionPipeline.from_pretrained(sd_model, vae=vae, custom_pipeline="AlanB/lpw_stable_diffusion_update", torch_dtype=sd_torch_dtype, use_safetensors=True).to(sd_device)
+        else :
+            sd_pipe = DiffusionPipeline.from_pretrained(sd_model, custom_pipeline="AlanB/lpw_stable_diffusion_update", torch_dtype=sd_torch_dtype, use_safetensors=True).to(sd_device)
+        sd_pipe.safety_checker = lambda images, clip_input: (images, False)
+        sd_pipe.enable_attention_slicing()
+        # pipe.scheduler = KarrasVeScheduler.from_config(pipe.scheduler.config)
+        sd_pipe.scheduler = EulerDiscreteScheduler.from_config(sd_pipe.scheduler.config)
+        return sd_pipe
+
+    model_registry.register("sd", _load_sd_pipeline, device=sd_device_string)
 elif "sd" in modules and sd_use_remote:
     print("Initializing Stable Diffusion connection")
     try:
@@ -1114,9 +1232,10 @@ if "edge-tts" in modules:
     import tts_edge as edge
 
 if "embeddings" in modules:
-    print("Initializing embeddings")
+    print("Registering embeddings model")
     from sentence_transformers import SentenceTransformer
-    sentence_embedder = SentenceTransformer(embedding_model, device=device_string)
+    model_registry.register("embeddings", lambda: SentenceTransformer(embedding_model, device=device_string), device=device_string)
+    embeddings_batcher = batching.MicroBatcher("embeddings", _embed_batch, max_batch_size=batch_max_size, max_wait=batch_max_wait)
 
 if "chromadb" in modules:
     print("Initializing ChromaDB")
@@ -1151,7 +1270,8 @@ if "chromadb" in modules:
 
 if "classify" in modules:
     import modules.classify.classify_module as classify_module
-    classify_module.init_text_emotion_classifier(classification_model, device, torch_dtype)
+    classify_module.init_text_emotion_classifier(classification_model, device, torch_dtype,
+                                                 max_batch_size=batch_max_size, max_wait=batch_max_wait)
 
 if "vosk-stt" in modules:
     print("Initializing Vosk speech-recognition (from ST request file)")
@@ -1203,15 +1323,37 @@ if "rvc" in modules:
     sys.path.insert(0, 'modules/voice_conversion')
 
     import modules.voice_conversion.rvc_module as rvc_module
+    import modules.voice_conversion.rvc.index_cache as rvc_index_cache
+    import modules.voice_conversion.rvc.result_cache as rvc_result_cache
     rvc_module.save_file = rvc_save_file
 
+    if args.rvc_batch_seconds:
+        rvc_module.rvc.config.batch_seconds = args.rvc_batch_seconds
+    if args.rvc_compile:
+        rvc_module.rvc.config.synth_compile = args.rvc_compile
+    if args.rvc_cpu_precision:
+        rvc_module.rvc.set_cpu_precision(args.rvc_cpu_precision)
+    rvc_module.rvc.set_cache_size(args.rvc_cache_size if args.rvc_cache_size is not None else DEFAULT_RVC_CACHE_SIZE)
+    rvc_module.start_worker(args.rvc_queue_size if args.rvc_queue_size is not None else DEFAULT_RVC_QUEUE_SIZE)
+    rvc_index_cache.use_memmap = args.rvc_index_memmap
+    if args.rvc_result_cache_size:
+        rvc_result_cache.enable(args.rvc_result_cache_size)
+    rvc_index_cache.set_cache_limit(args.rvc_index_cache_memory if args.rvc_index_cache_memory is not None else DEFAULT_RVC_INDEX_CACHE_MB)
+
     if "classify" in modules:
         rvc_module.classification_mode = True
+        # Keep the emotion models of a character loaded together, plus the default model
+        emotion_set_size = len(rvc_module.EMOTIONS) + 1
+        if (args.rvc_cache_size if args.rvc_cache_size is not None else DEFAULT_RVC_CACHE_SIZE) < emotion_set_size:
+            print("RVC emotion mode: keeping up to", emotion_set_size, "RVC models loaded")
+            rvc_module.rvc.set_cache_size(emotion_set_size)
 
     rvc_module.fix_model_install()
     app.add_url_rule("/api/voice-conversion/rvc/get-models-list", view_func=rvc_module.rvc_get_models_list, methods=["POST"])
     app.add_url_rule("/api/voice-conversion/rvc/upload-models", view_func=rvc_module.rvc_upload_models, methods=["POST"])
     app.add_url_rule("/api/voice-conversion/rvc/process-audio", view_func=rvc_module.rvc_process_audio, methods=["POST"])
+    app.add_url_rule("/api/voice-conversion/rvc/process-stream", view_func=rvc_module.rvc_process_stream, methods=["POST"])
+    app.add_url_rule("/api/voice-conversion/rvc/stats", view_func=rvc_module.rvc_get_stats, methods=["GET"])
 
 if "coqui-tts" in modules:
     mode = "GPU" if args.coqui_gpu else "CPU"
@@ -1221,6 +1363,10 @@ if "coqui-tts" in modules:
     if mode == "GPU":
         coqui_module.gpu_mode = True
 
+    coqui_module.set_cache_limit(
+        max_models=args.coqui_cache_size if args.coqui_cache_size is not None else DEFAULT_COQUI_CACHE_SIZE,
+        max_mb=args.coqui_cache_memory)
+
     coqui_models = (
         args.coqui_models
         if args.coqui_models
@@ -1243,6 +1389,20 @@ if "coqui-tts" in modules:
     # Handle both coqui-api/users models
     app.add_url_rule("/api/text-to-speech/coqui/generate-tts", view_func=coqui_module.coqui_generate_tts, methods=["POST"])
 
+if "rvc" in modules:
+    # Chained text to RVC conversion, with the enabled TTS modules
+    if "silero-tts" in modules:
+        rvc_module.tts_backends["silero"] = silero_synthesize
+    if "coqui-tts" in modules:
+        rvc_module.tts_backends["coqui"] = coqui_module.synthesize
+    if "edge-tts" in modules:
+        rvc_module.tts_backends["edge"] = edge_synthesize
+    app.add_url_rule("/api/voice-conversion/rvc/process-text", view_func=rvc_module.rvc_process_text, methods=["POST"])
+
+if args.preload_models:
+    print("Preloading models...")
+    model_registry.preload()
+
 # Read an API key from an already existing file. If that file doesn't exist, create it.
 if args.secure:
     try:
@@ -14,6 +14,8 @@ __all__ = ["set_emotion_from_classification", "set_emotion",
            "launch"]
 
 import atexit
+import collections
+import concurrent.futures
 import io
 import json
 import logging
@@ -24,7 +26,7 @@ import sys
 import time
 import numpy as np
 import threading
-from typing import Any, Dict, List, NoReturn, Optional, Union
+from typing import Any, Dict, List, NoReturn, Optional, Tuple, Union
 
 import PIL
 
@@ -37,6 +39,8 @@ from tha3.poser.modes.load_poser import load_poser
 from tha3.poser.poser import Poser
 from tha3.util import (torch_linear_to_srgb, resize_PIL_image,
                        extract_PIL_image_from_filelike, extract_pytorch_image_from_PIL_image)
+from tha3.app.frame_codecs import CODECS, DEFAULT_CODEC
+from tha3.app.frame_hub import BACKPRESSURE_MODES, FrameHub
 from tha3.app.postprocessor import Postprocessor
 from tha3.app.util import posedict_keys, posedict_key_to_index, load_emotion_presets, posedict_to_pose, to_talkinghead_image, RunningAverage
 
@@ -78,14 +82,19 @@ animator_defaults = {"target_fps": 25,  # Desired output frames per second. Note
 
                      "breathing_cycle_duration": 4.0,  # seconds, for a full breathing cycle.
 
+                     "idle_pose_threshold": 0.01,  # max abs change of any morph (except breathing) from the last rendered frame, below which
+                                                   # the pose counts as unchanged, and no new frame is rendered. 0 disables idle throttling.
+                                                   # See `Animator.is_idle`.
+
                      "postprocessor_chain": []}  # Pixel-space glitch artistry settings; see `postprocessor.py`.
 
 talkinghead_basedir = "talkinghead"
 
 global_animator_instance = None
-_animator_output_lock = threading.Lock()  # protect from concurrent access to `result_image` and the `new_frame_available` flag.
+# Protect `result_image` and the `new_frame_available` flag; notified when a frame is published or consumed.
+_animator_output_condition = threading.Condition()
 global_encoder_instance = None
-global_latest_frame_sent = None
+global_frame_hub = FrameHub()  # fan-out of encoded frames to the result feed viewers; outlives relaunches of the encoder
 
 # These need to be written to by the API functions.
 #
@@ -198,80 +207,105 @@ def stop_talking() -> str:
 #   - At startup:
 #     - The animator renders the first frame on its own.
 #     - The encoder waits for the animator to publish a frame, and then starts normal operation.
-#     - The network thread waits for the encoder to publish a frame, and then starts normal operation.
+#     - Each network thread (one per viewer of the result feed) waits for the encoder to publish a frame, and then starts normal operation.
 #   - In normal operation (after startup):
 #     - The animator waits until the encoder has consumed the previous published frame. Then it proceeds to render and publish a new frame.
-#       - This communication is handled through the flag `animator.new_frame_available`.
-#     - The network thread does its own thing on a regular schedule, based on the desired target FPS.
-#       - However, the network thread publishes metadata on which frame is the latest that has been sent over the network at least once.
-#         This is stored as an `id` (i.e. memory address) in `global_latest_frame_sent`.
+#       - This communication is handled through the flag `animator.new_frame_available`, guarded by `_animator_output_condition`.
+#         Each side blocks on the condition variable, and is woken up as soon as the other side flips the flag.
+#     - The encoder publishes each encoded frame once, to `global_frame_hub`, which gives a copy to the slot of each viewer.
+#       A viewer that falls behind drops its oldest frames (see `frame_hub.py`).
+#     - Each network thread does its own thing on a regular schedule, based on the desired target FPS.
+#       - However, each network thread reports to the hub which frame is the latest that it has sent over the network at least once.
 #       - If the target FPS is too high for the animator and/or encoder to keep up with, the network thread re-sends
-#         the latest frame published by the encoder as many times as necessary, to keep the network output at the target FPS
+#         the latest frame it got from the hub as many times as necessary, to keep the network output at the target FPS
 #         regardless of render/encode speed. This handles the case of hardware slower than the target FPS.
 #       - On localhost, the network send is very fast, under 0.15 ms.
-#     - The encoder uses the metadata to wait until the latest encoded frame has been sent at least once before publishing a new frame.
+#     - The hub makes the encoder wait until the latest encoded frame has been sent at least once before publishing a new frame:
+#       by the primary viewer (the one connected first), or by every viewer, depending on the back-pressure mode set at launch.
 #       This ensures that no more frames are generated than are actually sent, and syncs also the animator (because the animator is
 #       rate-limited by the encoder consuming its frames). This handles the case of hardware faster than the target FPS.
 #     - When the animator and encoder are fast enough to keep up with the target FPS, generally when frame N is being sent,
 #       frame N+1 is being encoded (or is already encoded, and waiting for frame N to be sent), and frame N+2 is being rendered.
 #
-def result_feed() -> Response:
-    """Return a Flask `Response` that repeatedly yields the current image as 'image/png'."""
+def result_feed(codec: str = DEFAULT_CODEC) -> Response:
+    """Return a Flask `Response` that repeatedly yields the current image, encoded with `codec`.
+
+    For the available codecs, see `talkinghead/tha3/app/frame_codecs.py`. The default is PNG ('image/png').
+    """
+    if codec not in CODECS:
+        raise ValueError(f"result_feed: unknown codec '{codec}'; valid: {list(CODECS.keys())}")
+    content_type = CODECS[codec].content_type.encode()
+
     def generate():
-        global global_latest_frame_sent
+        subscriber = global_frame_hub.subscribe(codec)
+        try:
+            yield from send_frames(subscriber)
+        finally:  # the client disconnected
+            global_frame_hub.unsubscribe(subscriber)
 
+    def send_frames(subscriber):
         last_frame_send_complete_time = None
         last_report_time = None
         send_duration_sec = 0.0
         send_duration_statistics = RunningAverage()
+        latency_statistics = RunningAverage()  # render start -> first network send of each frame
+        last_frame_number = None
 
         while True:
-            # Send the latest available animation frame.
-            # Important: grab reference to `image_bytes` only once, since it will be atomically updated without a lock.
-            image_bytes = global_encoder_instance.image_bytes
-            if image_bytes is not None:
-                # How often should we send?
-                #  - Excessive spamming can DoS the SillyTavern GUI, so there needs to be a rate limit.
-                #  - OTOH, we must constantly send something, or the GUI will lock up waiting.
-                # Therefore, send at a target FPS that yields a nice-looking animation.
-                frame_duration_target_sec = 1 / target_fps
-                if last_frame_send_complete_time is not None:
-                    time_now = time.time_ns()
-                    this_frame_elapsed_sec = (time_now - last_frame_send_complete_time) / 10**9
-                    # The 2* is a fudge factor. It doesn't matter if the frame is a bit too early, but we don't want it to be late.
-                    time_until_frame_deadline = frame_duration_target_sec - this_frame_elapsed_sec - 2 * send_duration_sec
-                else:
-                    time_until_frame_deadline = 0.0  # nothing rendered yet
-
-                if time_until_frame_deadline <= 0.0:
-                    time_now = time.time_ns()
-                    yield (b"--frame\r\n"
-                           b"Content-Type: image/png\r\n\r\n" + image_bytes + b"\r\n")
-                    global_latest_frame_sent = id(image_bytes)  # atomic update, no need for lock
-                    send_duration_sec = (time.time_ns() - time_now) / 10**9  # about 0.12 ms on localhost (compress_level=1 or 6, doesn't matter)
-                    # print(f"send {send_duration_sec:0.6g}s")  # DEBUG
-
-                    # Update the FPS counter, measuring the time between network sends.
-                    time_now = time.time_ns()
-                    if last_frame_send_complete_time is not None:
-                        this_frame_elapsed_sec = (time_now - last_frame_send_complete_time) / 10**9
-                        send_duration_statistics.add_datapoint(this_frame_elapsed_sec)
-                    last_frame_send_complete_time = time_now
-                else:
-                    time.sleep(time_until_frame_deadline)
+            # Send the next animation frame for this viewer (or re-send the current one).
+            # At startup, this blocks until the encoder publishes the first frame.
+            frame = subscriber.get()
+            image_bytes = frame.data[codec]
+
+            # How often should we send?
+            #  - Excessive spamming can DoS the SillyTavern GUI, so there needs to be a rate limit.
+            #  - OTOH, we must constantly send something, or the GUI will lock up waiting.
+            # Therefore, send at a target FPS that yields a nice-looking animation.
+            frame_duration_target_sec = 1 / target_fps
+            if last_frame_send_complete_time is not None:
+                time_now = time.time_ns()
+                this_frame_elapsed_sec = (time_now - last_frame_send_complete_time) / 10**9
+                # The 2* is a fudge factor. It doesn't matter if the frame is a bit too early, but we don't want it to be late.
+                time_until_frame_deadline = frame_duration_target_sec - this_frame_elapsed_sec - 2 * send_duration_sec
+            else:
+                time_until_frame_deadline = 0.0  # nothing rendered yet
 
-                # Log the FPS counter in 5-second intervals.
+            if time_until_frame_deadline <= 0.0:
                 time_now = time.time_ns()
-                if animation_running and (last_report_time is None or time_now - last_report_time > 5e9):
-                    avg_send_sec = send_duration_statistics.average()
-                    msec = round(1000 * avg_send_sec, 1)
-                    target_msec = round(1000 * frame_duration_target_sec, 1)
-                    fps = round(1 / avg_send_sec, 1) if avg_send_sec > 0.0 else 0.0
-                    logger.info(f"output: {msec:.1f}ms [{fps:.1f} FPS]; target {target_msec:.1f}ms [{target_fps:.1f} FPS]")
-                    last_report_time = time_now
+                yield (b"--frame\r\n"
+                       b"Content-Type: " + content_type + b"\r\n"
+                       b"X-Frame-Size: %dx%d\r\n\r\n" % frame.size + image_bytes + b"\r\n")
+                subscriber.mark_sent(frame)  # wake up the encoder, if waiting for this frame to be sent
+                send_duration_sec = (time.time_ns() - time_now) / 10**9  # about 0.12 ms on localhost (compress_level=1 or 6, doesn't matter)
+                # print(f"send {send_duration_sec:0.6g}s")  # DEBUG
+
+                # Update the latency counter, measuring from render start until the first send of each frame.
+                if frame.number != last_frame_number:
+                    if frame.timestamp is not None:
+                        latency_statistics.add_datapoint((time.time_ns() - frame.timestamp) / 10**9)
+                    last_frame_number = frame.number
+
+                # Update the FPS counter, measuring the time between network sends.
+                time_now = time.time_ns()
+                if last_frame_send_complete_time is not None:
+                    this_frame_elapsed_sec = (time_now - last_frame_send_complete_time) / 10**9
+                    send_duration_statistics.add_datapoint(this_frame_elapsed_sec)
+                last_frame_send_complete_time = time_now
+            else:
+                time.sleep(time_until_frame_deadline)
 
-            else:  # first frame not yet available
-                time.sleep(0.1)
+            # Log the FPS counter in 5-second intervals.
+            time_now = time.time_ns()
+            if animation_running and (last_report_time is None or time_now - last_report_time > 5e9):
+                avg_send_sec = send_duration_statistics.average()
+                msec = round(1000 * avg_send_sec, 1)
+                target_msec = round(1000 * frame_duration_target_sec, 1)
+                fps = round(1 / avg_send_sec, 1) if avg_send_sec > 0.0 else 0.0
+                latency_msec = round(1000 * latency_statistics.average(), 1)
+                logger.info(f"output #{subscriber.subscriber_id}: {msec:.1f}ms [{fps:.1f} FPS]; target {target_msec:.1f}ms [{target_fps:.1f} FPS]; render-to-send latency {latency_msec:.1f}ms")
+                if subscriber is global_frame_hub.subscribers[0]:  # report the whole hub only once
+                    logger.info(f"output: {global_frame_hub.report()}")
+                last_report_time = time_now
 
     return Response(generate(), mimetype="multipart/x-mixed-replace; boundary=frame")
 
@@ -296,13 +330,18 @@ def talkinghead_load_file(stream) -> str:
         animation_running = True
     return "OK"
 
-def launch(device: str, model: str) -> Union[None, NoReturn]:
+def launch(device: str, model: str, backpressure: str = "primary", encoder_workers: int = 2) -> Union[None, NoReturn]:
     """Launch the talking head plugin (live mode).
 
     If the plugin fails to load, the process exits.
 
     device: "cpu" or "cuda"
     model: one of the folder names inside "talkinghead/tha3/models/"
+    backpressure: which result feed viewers the renderer waits for, when there are several
+                  (e.g. another browser tab, or OBS capture):
+                  "primary": the first connected viewer; slower viewers drop frames.
+                  "slowest": every viewer; all viewers get every frame, at the rate of the slowest one.
+    encoder_workers: number of threads encoding frames in parallel.
     """
     global global_animator_instance
     global global_encoder_instance
@@ -316,10 +355,14 @@ def launch(device: str, model: str) -> Union[None, NoReturn]:
             global_encoder_instance.exit()
             global_encoder_instance = None
 
+        if backpressure not in BACKPRESSURE_MODES:
+            raise RuntimeError(f"launch: unknown back-pressure mode '{backpressure}'; valid: {BACKPRESSURE_MODES}")
+        global_frame_hub.backpressure = backpressure
+
         logger.info("launch: loading the THA3 posing engine")
         poser = load_poser(model, device, modelsdir=os.path.join(talkinghead_basedir, "tha3", "models"))
         global_animator_instance = Animator(poser, device)
-        global_encoder_instance = Encoder()
+        global_encoder_instance = Encoder(encoder_workers)
 
         # Load initial blank character image
         full_path = os.path.join(os.getcwd(), os.path.join(talkinghead_basedir, "tha3", "images", "inital.png"))
@@ -350,12 +393,15 @@ class Animator:
 
         self.postprocessor = Postprocessor(device)
         self.render_duration_statistics = RunningAverage()
+        self.wait_duration_statistics = RunningAverage()  # time spent waiting for the encoder to consume the previous frame
         self.animator_thread = None
 
         self.source_image: Optional[torch.tensor] = None
         self.result_image: Optional[np.array] = None
+        self.result_timestamp: Optional[int] = None  # `time.time_ns()` at render start of `result_image`, for latency measurement
         self.new_frame_available = False
         self.last_report_time = None
+        self.idle_duration_sec = 0.0  # time spent idle since the last report
 
         self.reset_animation_state()
         self.load_emotion_templates()
@@ -369,12 +415,22 @@ class Animator:
         self._terminated = False
         def animator_update():
             while not self._terminated:
+                # Sleep until the encoder has consumed the previous frame.
+                time_wait_start = time.time_ns()
+                with _animator_output_condition:
+                    _animator_output_condition.wait_for(lambda: not self.new_frame_available or self._terminated)
+                if self._terminated:
+                    break
+                self.wait_duration_statistics.add_datapoint((time.time_ns() - time_wait_start) / 10**9)
+
                 try:
-                    self.render_animation_frame()
+                    rendered = self.render_animation_frame()
                 except Exception as exc:
                     logger.error(exc)
                     raise  # let the animator stop so we won't spam the log
-                time.sleep(0.01)  # rate-limit the renderer to 100 FPS maximum (this could be adjusted later)
+                if not rendered:  # paused, no character loaded, or idle
+                    # When idle, keep running the animation drivers at the target FPS, to notice the next change quickly.
+                    time.sleep(1 / target_fps if self.idle_since is not None else 0.1)
         self.animator_thread = threading.Thread(target=animator_update, daemon=True)
         self.animator_thread.start()
         atexit.register(self.exit)
@@ -385,6 +441,8 @@ class Animator:
         Called automatically when the process exits.
         """
         self._terminated = True
+        with _animator_output_condition:
+            _animator_output_condition.notify_all()
         self.animator_thread.join()
         self.animator_thread = None
 
@@ -409,6 +467,9 @@ class Animator:
 
         self.breathing_epoch = time.time_ns()
 
+        self.last_rendered_pose = None  # for idle detection; `None` forces the next frame to be rendered
+        self.idle_since = None  # `time.time_ns()` when the animator went idle, or `None` when not idle
+
     def load_emotion_templates(self, emotions: Optional[Dict[str, Dict[str, float]]] = None) -> None:
         """Load emotion templates.
 
@@ -518,6 +579,8 @@ class Animator:
         logger.debug("load_animator_settings: Sending new effect chain to postprocessor")
         self.postprocessor.chain = settings.pop("postprocessor_chain")  # ...and that's where the postprocessor reads its filter settings from.
 
+        self.last_rendered_pose = None  # the new settings (e.g. crop, postprocessor chain) may change the output even for the same pose
+
         # The rest of the settings we can just store in an attribute, and let the animation drivers read them from there.
         self._settings = settings
 
@@ -559,6 +622,7 @@ class Animator:
 
         finally:
             global_reload_image = None
+            self.last_rendered_pose = None  # new character; render it even if the pose stays the same
 
     # --------------------------------------------------------------------------------
     # Animation drivers
@@ -1036,22 +1100,54 @@ class Animator:
     # --------------------------------------------------------------------------------
     # Animation logic
 
-    def render_animation_frame(self) -> None:
+    def is_idle(self, pose: List[float]) -> bool:
+        """Return whether rendering `pose` can be skipped, because the output would look the same as the last rendered frame.
+
+        Relevant `self._settings` keys:
+
+        `"idle_pose_threshold"`: float. Max abs change of any morph from the last rendered pose, below which the change
+                                 is considered imperceptible. Breathing is not compared; it pauses while idle.
+                                 0 disables idle detection.
+
+        The animator is never idle while talking, when the emotion changes, or when the postprocessor chain
+        contains a [dynamic] filter (which animates even a stationary image). Blinking changes the pose a lot,
+        so a frame with a blink in progress is always rendered.
+        """
+        threshold = self._settings["idle_pose_threshold"]
+        if threshold <= 0 or self.last_rendered_pose is None:
+            return False
+        if is_talking or current_emotion != self.last_emotion:
+            return False
+        if self.postprocessor.has_dynamic_filters():
+            return False
+        if global_frame_hub.needs_frame():  # e.g. a viewer just connected with a codec not encoded yet
+            return False
+        breathing_idx = posedict_key_to_index["breathing_index"]
+        return all(abs(value - rendered_value) < threshold
+                   for idx, (value, rendered_value) in enumerate(zip(pose, self.last_rendered_pose))
+                   if idx != breathing_idx)
+
+    def render_animation_frame(self) -> bool:
         """Render an animation frame.
 
         If the previous rendered frame has not been retrieved yet, do nothing.
+
+        If the pose has not changed perceptibly since the last rendered frame (see `is_idle`), update the animation
+        state, but skip the render. The result feed then keeps re-sending the last encoded frame.
+
+        Return whether a new frame was rendered.
         """
         if not animation_running:
-            return
+            return False
 
         # If no one has retrieved the latest rendered frame yet, do not render a new one.
         if self.new_frame_available:
-            return
+            return False
 
         if global_reload_image is not None:
             self.load_image()
         if self.source_image is None:
-            return
+            return False
 
         time_render_start = time.time_ns()
 
@@ -1068,6 +1164,20 @@ class Animator:
         self.current_pose = self.interpolate_pose(self.current_pose, target_pose)
         self.current_pose = self.animate_blinking(self.current_pose)
         self.current_pose = self.animate_talking(self.current_pose, target_pose)
+
+        if self.is_idle(self.current_pose):
+            if self.idle_since is None:
+                self.idle_since = time_render_start
+                logger.debug("render: pose converged, idling")
+            self.last_emotion = current_emotion
+            return False
+        if self.idle_since is not None:
+            idle_elapsed_ns = time_render_start - self.idle_since
+            self.breathing_epoch += idle_elapsed_ns  # resume breathing where it paused, without a jump
+            self.idle_duration_sec += idle_elapsed_ns / 10**9
+            self.idle_since = None
+            logger.debug("render: pose changed, resuming rendering")
+
         self.current_pose = self.animate_breathing(self.current_pose)
 
         # Update this last so that animation drivers have access to the old emotion, too.
@@ -1090,9 +1200,9 @@ class Animator:
             output_image = output_image[:, y1:y2, x1:x2]
 
             # [-1, 1] -> [0, 1]
-            # output_image = (output_image + 1.0) / 2.0
-            output_image.add_(1.0)
-            output_image.mul_(0.5)
+            # Not in-place: the poser output may be a tensor held by its stage cache, which must stay untouched.
+            # This also gives the postprocessor (which mutates its input) a fresh tensor to work on.
+            output_image = (output_image + 1.0) * 0.5
 
             self.postprocessor.render_into(output_image)  # apply pixel-space glitch artistry
             output_image = convert_linear_to_srgb(output_image)  # apply gamma correction
@@ -1114,109 +1224,137 @@ class Animator:
             # remove the average per-frame postprocessing time, to measure render time only
             render_elapsed_sec -= self.postprocessor.render_duration_statistics.average()
             self.render_duration_statistics.add_datapoint(render_elapsed_sec)
+        self.last_rendered_pose = list(self.current_pose)
 
         # Set the new rendered frame as the output image, and mark the frame as ready for consumption.
-        with _animator_output_lock:
+        with _animator_output_condition:
             self.result_image = output_image_numpy  # atomic replace
+            self.result_timestamp = time_render_start
             self.new_frame_available = True
+            _animator_output_condition.notify_all()  # wake up the encoder
 
         # Log the FPS counter in 5-second intervals.
         if animation_running and (self.last_report_time is None or time_now - self.last_report_time > 5e9):
             avg_render_sec = self.render_duration_statistics.average()
             msec = round(1000 * avg_render_sec, 1)
             fps = round(1 / avg_render_sec, 1) if avg_render_sec > 0.0 else 0.0
-            logger.info(f"render: {msec:.1f}ms [{fps} FPS available]")
+            wait_msec = round(1000 * self.wait_duration_statistics.average(), 1)
+            idle_percent = min(100.0, 100 * self.idle_duration_sec / ((time_now - self.last_report_time) / 10**9)) if self.last_report_time is not None else 0.0
+            logger.info(f"render: {msec:.1f}ms [{fps} FPS available]; encoder sync wait {wait_msec:.1f}ms; idle {idle_percent:.0f}% of the time")
+            cache_statistics = self.poser.get_cache_statistics()
+            if cache_statistics:
+                hit_rates = ", ".join(f"{stage.removesuffix('_outputs')} {100 * hit_rate:.0f}%" for stage, hit_rate in cache_statistics.items())
+                logger.info(f"render: stage cache hit rates: {hit_rates}")
             self.last_report_time = time_now
+            self.idle_duration_sec = 0.0
+
+        return True
 
 
 class Encoder:
     """Network transport encoder.
 
-    We read each frame from the animator as it becomes ready, and keep it available in `self.image_bytes`
-    until the next frame arrives. The `self.image_bytes` buffer is replaced atomically, so this needs no lock
-    (you always get the latest available frame at the time you access `image_bytes`).
+    We read each frame from the animator as it becomes ready, encode it with the codecs used by the viewers
+    (see `frame_codecs.py`), and publish it to `global_frame_hub`, which hands it out to the viewers of the
+    result feed. The latest published frame is `global_frame_hub.latest`.
+
+    Frames are encoded on a pool of `workers` threads, so that consecutive frames can be encoded in parallel
+    (Pillow's encoders release the GIL). Encoded frames are published in the order they were rendered.
     """
 
-    def __init__(self) -> None:
-        self.image_bytes = None
+    def __init__(self, workers: int = 2) -> None:
+        self.workers = max(1, workers)
         self.encoder_thread = None
+        self.executor = None
 
     def start(self) -> None:
         """Start the output encoder thread."""
         self._terminated = False
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="talkinghead-encoder")
+
+        def have_new_frame() -> bool:
+            return global_animator_instance is not None and global_animator_instance.new_frame_available
+
+        def encode(image_rgba: np.ndarray, codecs: List[str]) -> Tuple[Dict[str, bytes], Dict[str, float]]:
+            """Encode a frame with each of `codecs`. Return the encoded bytes, and the encode durations in seconds."""
+            encoded = {}
+            durations = {}
+            for codec in codecs:
+                time_encode_start = time.time_ns()
+                encoded[codec] = CODECS[codec].encode(image_rgba)
+                durations[codec] = (time.time_ns() - time_encode_start) / 10**9
+            return encoded, durations
+
+        def notify_encoded(future: concurrent.futures.Future) -> None:
+            with _animator_output_condition:
+                _animator_output_condition.notify_all()  # wake up the encoder thread, to publish the frame
+
         def encoder_update():
             last_report_time = None
-            encode_duration_statistics = RunningAverage()
+            encode_duration_statistics = {codec: RunningAverage() for codec in CODECS}
+            encode_size_statistics = {codec: RunningAverage() for codec in CODECS}
+            input_wait_duration_statistics = RunningAverage()
             wait_duration_statistics = RunningAverage()
+            pending = collections.deque()  # (future, frame size, render start timestamp), in render order
+
+            def can_take_frame() -> bool:
+                return have_new_frame() and len(pending) < self.workers
 
             while not self._terminated:
-                # Retrieve a new frame from the animator if available.
-                have_new_frame = False
-                time_encode_start = time.time_ns()
-                with _animator_output_lock:
-                    if global_animator_instance.new_frame_available:
+                # Sleep until the animator publishes a new frame (and a worker is free), or the oldest pending frame is encoded.
+                time_input_wait_start = time.time_ns()
+                with _animator_output_condition:
+                    _animator_output_condition.wait_for(lambda: can_take_frame() or (pending and pending[0][0].done()) or self._terminated)
+                    if self._terminated:
+                        break
+                    new_frame = can_take_frame()
+                    if new_frame:
                         image_rgba = global_animator_instance.result_image
+                        frame_timestamp = global_animator_instance.result_timestamp
                         global_animator_instance.new_frame_available = False  # animation frame consumed; start rendering the next one
-                        have_new_frame = True  # This flag is needed so we can release the animator lock as early as possible.
-
-                # If a new frame arrived, pack it for sending (only once for each new frame).
-                if have_new_frame:
+                        _animator_output_condition.notify_all()  # wake up the animator
+
+                # Pack the new frame for sending (only once for each new frame and codec).
+                if new_frame:
+                    input_wait_duration_statistics.add_datapoint((time.time_ns() - time_input_wait_start) / 10**9)
+                    h, w = image_rgba.shape[:2]
+                    future = self.executor.submit(encode, image_rgba, sorted(global_frame_hub.codecs()))
+                    future.add_done_callback(notify_encoded)
+                    pending.append((future, (w, h), frame_timestamp))
+
+                # Publish the encoded frames, in order.
+                while pending and pending[0][0].done() and not self._terminated:
+                    future, frame_size, frame_timestamp = pending.popleft()
                     try:
-                        pil_image = PIL.Image.fromarray(np.uint8(image_rgba[:, :, :3]))
-                        if image_rgba.shape[2] == 4:
-                            alpha_channel = image_rgba[:, :, 3]
-                            pil_image.putalpha(PIL.Image.fromarray(np.uint8(alpha_channel)))
-
-                        # Save as PNG with RGBA mode. Use the fastest compression level available.
-                        #
-                        # On an i7-12700H @ 2.3 GHz (laptop optimized for low fan noise):
-                        #  - `compress_level=1` (fastest), about 20 ms
-                        #  - `compress_level=6` (default), about 40 ms (!) - too slow!
-                        #  - `compress_level=9` (smallest size), about 120 ms
-                        #
-                        # time_now = time.time_ns()
-                        buffer = io.BytesIO()
-                        pil_image.save(buffer, format="PNG", compress_level=1)
-                        image_bytes = buffer.getvalue()
-                        # pack_duration_sec = (time.time_ns() - time_now) / 10**9
-
-                        # We now have a new encoded frame; but first, sync with network send.
-                        # This prevents from rendering/encoding more frames than are actually sent.
-                        previous_frame = self.image_bytes
-                        if previous_frame is not None:
-                            time_wait_start = time.time_ns()
-                            # Wait in 1ms increments until the previous encoded frame has been sent
-                            while global_latest_frame_sent != id(previous_frame) and not self._terminated:
-                                time.sleep(0.001)
-                            time_now = time.time_ns()
-                            wait_elapsed_sec = (time_now - time_wait_start) / 10**9
-                        else:
-                            wait_elapsed_sec = 0.0
-
-                        self.image_bytes = image_bytes  # atomic replace so no need for a lock
+                        encoded, durations = future.result()
                     except Exception as exc:
                         logger.error(exc)
                         raise  # let the encoder stop so we won't spam the log
+                    for codec, duration in durations.items():
+                        encode_duration_statistics[codec].add_datapoint(duration)
+                        encode_size_statistics[codec].add_datapoint(len(encoded[codec]))
 
-                    # Update FPS counter.
-                    time_now = time.time_ns()
-                    walltime_elapsed_sec = (time_now - time_encode_start) / 10**9
-                    encode_elapsed_sec = walltime_elapsed_sec - wait_elapsed_sec
-                    encode_duration_statistics.add_datapoint(encode_elapsed_sec)
-                    wait_duration_statistics.add_datapoint(wait_elapsed_sec)
+                    # We now have a new encoded frame; but first, sync with network send.
+                    # This prevents from rendering/encoding more frames than are actually sent.
+                    # The hub sleeps until the previous encoded frame has been sent.
+                    time_wait_start = time.time_ns()
+                    global_frame_hub.publish(encoded, frame_size, frame_timestamp, cancelled=lambda: self._terminated)
+                    wait_duration_statistics.add_datapoint((time.time_ns() - time_wait_start) / 10**9)
 
                 # Log the FPS counter in 5-second intervals.
                 time_now = time.time_ns()
                 if animation_running and (last_report_time is None or time_now - last_report_time > 5e9):
-                    avg_encode_sec = encode_duration_statistics.average()
-                    msec = round(1000 * avg_encode_sec, 1)
-                    avg_wait_sec = wait_duration_statistics.average()
-                    wait_msec = round(1000 * avg_wait_sec, 1)
-                    fps = round(1 / avg_encode_sec, 1) if avg_encode_sec > 0.0 else 0.0
-                    logger.info(f"encode: {msec:.1f}ms [{fps} FPS available]; send sync wait {wait_msec:.1f}ms")
+                    wait_msec = round(1000 * wait_duration_statistics.average(), 1)
+                    input_wait_msec = round(1000 * input_wait_duration_statistics.average(), 1)
+                    for codec in sorted(global_frame_hub.codecs()):
+                        avg_encode_sec = encode_duration_statistics[codec].average()
+                        msec = round(1000 * avg_encode_sec, 1)
+                        fps = round(self.workers / avg_encode_sec, 1) if avg_encode_sec > 0.0 else 0.0
+                        kbytes = round(encode_size_statistics[codec].average() / 1024, 1)
+                        logger.info(f"encode {codec}: {msec:.1f}ms, {kbytes:.1f} KiB per frame [{fps} FPS available with {self.workers} workers]")
+                    logger.info(f"encode: render wait {input_wait_msec:.1f}ms; send sync wait {wait_msec:.1f}ms")
                     last_report_time = time_now
 
-                time.sleep(0.01)  # rate-limit the encoder to 100 FPS maximum (this could be adjusted later)
         self.encoder_thread = threading.Thread(target=encoder_update, daemon=True)
         self.encoder_thread.start()
         atexit.register(self.exit)
@@ -1227,5 +1365,10 @@ class Encoder:
         Called automatically when the process exits.
         """
         self._terminated = True
+        with _animator_output_condition:
+            _animator_output_condition.notify_all()
+        global_frame_hub.wake()
         self.encoder_thread.join()
         self.encoder_thread = None
+        self.executor.shutdown(wait=True)
+        self.executor = None
@@ -0,0 +1,84 @@
+"""Frame codecs for the talkinghead result feed.
+
+Each viewer of the result feed picks a codec (`/api/talkinghead/result_feed?codec=...`):
+
+    "png"         PNG, fastest compression level. Default; what SillyTavern expects.
+    "webp"        WebP, lossless, with alpha. Smaller than PNG at a similar encode time.
+    "webp-lossy"  WebP, lossy color (quality 80) with lossless alpha. Much smaller frames.
+    "jpeg-alpha"  JPEG color plus a separate alpha plane. Fastest compressed codec. The part is
+                  a 4-byte big-endian length, the JPEG of the RGB channels, then the alpha channel
+                  as a grayscale PNG; the client recombines them.
+    "raw"         Raw RGBA bytes, no compression at all. Only for viewers on localhost.
+
+Every part of the feed has an `X-Frame-Size: <width>x<height>` header, which clients need for "raw".
+"""
+
+__all__ = ["FrameCodec", "CODECS", "DEFAULT_CODEC"]
+
+import io
+import struct
+from typing import Callable
+
+import numpy as np
+
+import PIL.Image
+
+
+class FrameCodec:
+    def __init__(self, name: str, content_type: str, encode: Callable[[np.ndarray], bytes]):
+        """`encode`: [h, w, c] uint8 RGBA (or RGB) image -> encoded bytes."""
+        self.name = name
+        self.content_type = content_type
+        self.encode = encode
+
+
+def _to_pil(image_rgba: np.ndarray) -> PIL.Image.Image:
+    return PIL.Image.fromarray(np.ascontiguousarray(image_rgba, dtype=np.uint8), mode="RGBA" if image_rgba.shape[2] == 4 else "RGB")
+
+
+def _encode_png(image_rgba: np.ndarray) -> bytes:
+    # Use the fastest compression level available.
+    #
+    # On an i7-12700H @ 2.3 GHz (laptop optimized for low fan noise):
+    #  - `compress_level=1` (fastest), about 20 ms
+    #  - `compress_level=6` (default), about 40 ms (!) - too slow!
+    #  - `compress_level=9` (smallest size), about 120 ms
+    buffer = io.BytesIO()
+    _to_pil(image_rgba).save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def _encode_webp_lossless(image_rgba: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    _to_pil(image_rgba).save(buffer, format="WEBP", lossless=True, quality=0, method=0)  # fastest effort
+    return buffer.getvalue()
+
+
+def _encode_webp_lossy(image_rgba: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    _to_pil(image_rgba).save(buffer, format="WEBP", quality=80, alpha_quality=100, method=0)
+    return buffer.getvalue()
+
+
+def _encode_jpeg_alpha(image_rgba: np.ndarray) -> bytes:
+    color_buffer = io.BytesIO()
+    PIL.Image.fromarray(np.ascontiguousarray(image_rgba[:, :, :3], dtype=np.uint8), mode="RGB").save(color_buffer, format="JPEG", quality=85)
+    color_bytes = color_buffer.getvalue()
+    alpha = image_rgba[:, :, 3] if image_rgba.shape[2] == 4 else np.full(image_rgba.shape[:2], 255)
+    alpha_buffer = io.BytesIO()
+    PIL.Image.fromarray(np.ascontiguousarray(alpha, dtype=np.uint8), mode="L").save(alpha_buffer, format="PNG", compress_level=1)
+    return struct.pack(">I", len(color_bytes)) + color_bytes + alpha_buffer.getvalue()
+
+
+def _encode_raw(image_rgba: np.ndarray) -> bytes:
+    return np.ascontiguousarray(image_rgba, dtype=np.uint8).tobytes()
+
+
+CODECS = {codec.name: codec for codec in [
+    FrameCodec("png", "image/png", _encode_png),
+    FrameCodec("webp", "image/webp", _encode_webp_lossless),
+    FrameCodec("webp-lossy", "image/webp", _encode_webp_lossy),
+    FrameCodec("jpeg-alpha", "application/x-talkinghead-jpeg-alpha", _encode_jpeg_alpha),
+    FrameCodec("raw", "application/x-talkinghead-rgba", _encode_raw),
+]}
+DEFAULT_CODEC = "png"
@@ -0,0 +1,172 @@
+"""Fan-out of encoded talkinghead frames to the `result_feed` viewers.
+
+The encoder publishes each frame once, encoded with every codec the viewers currently use (see
+`frame_codecs.py`). Each viewer (HTTP client of the result feed) subscribes with its codec, and gets
+its own bounded slot of frames; when a viewer falls behind, its oldest frames are dropped.
+When a viewer has no new frame in its slot, it re-sends its current frame to keep its output rate.
+This also covers the animator idling (not rendering while the character pose stays the same).
+
+Back-pressure: before publishing a new frame, the encoder waits until the previous frame has been sent
+at least once by the primary viewer (the one connected first), or by every viewer ("slowest" mode).
+This prevents rendering and encoding more frames than are actually shown.
+"""
+
+__all__ = ["Frame", "FrameHub", "Subscriber",
+           "BACKPRESSURE_MODES"]
+
+import collections
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from tha3.app.util import RunningAverage
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BACKPRESSURE_MODES = ("primary", "slowest")
+
+
+class Frame:
+    """An encoded frame.
+
+    `data`: `{codec_name: encoded_bytes}`
+    `size`: `(width, height)` in pixels
+    `timestamp`: `time.time_ns()` at render start, for latency measurement.
+    """
+    def __init__(self, number: int, data: Dict[str, bytes], size: Tuple[int, int], timestamp: Optional[int]):
+        self.number = number
+        self.data = data
+        self.size = size
+        self.timestamp = timestamp
+
+
+class Subscriber:
+    """The frame slot of one viewer. Created by `FrameHub.subscribe`."""
+    def __init__(self, hub: "FrameHub", subscriber_id: int, codec: str, slot_size: int):
+        self.hub = hub
+        self.subscriber_id = subscriber_id
+        self.codec = codec
+        self.frames = collections.deque(maxlen=slot_size)
+        # A new viewer starts with the latest frame, if it is available in its codec.
+        self.current: Optional[Frame] = hub.latest if hub.latest is not None and codec in hub.latest.data else None
+        self.last_sent_number = -1
+        self.dropped = 0
+        self.last_send_time = None
+        self.send_duration_statistics = RunningAverage()  # time between sends
+
+    def get(self) -> Frame:
+        """Return the next frame to send: the oldest new frame in the slot, or else the current frame again.
+
+        Block until a first frame is available.
+        """
+        with self.hub.condition:
+            self.hub.condition.wait_for(lambda: self.frames or self.current is not None)
+            if self.frames:
+                self.current = self.frames.popleft()
+            return self.current
+
+    def mark_sent(self, frame: Frame) -> None:
+        """Record that `frame` has been sent, releasing the back-pressure on the encoder."""
+        time_now = time.time_ns()
+        if self.last_send_time is not None:
+            self.send_duration_statistics.add_datapoint((time_now - self.last_send_time) / 10**9)
+        self.last_send_time = time_now
+        with self.hub.condition:
+            if frame.number > self.last_sent_number:
+                self.last_sent_number = frame.number
+                self.hub.condition.notify_all()
+
+    def fps(self) -> float:
+        avg_send_sec = self.send_duration_statistics.average()
+        return 1 / avg_send_sec if avg_send_sec > 0.0 else 0.0
+
+
+class FrameHub:
+    def __init__(self, backpressure: str = "primary", slot_size: int = 1, default_codec: str = "png"):
+        if backpressure not in BACKPRESSURE_MODES:
+            raise ValueError(f"Unknown back-pressure mode '{backpressure}'; valid: {BACKPRESSURE_MODES}")
+        self.backpressure = backpressure
+        self.slot_size = slot_size
+        self.default_codec = default_codec
+        self.condition = threading.Condition()  # protects all state, and is notified on every change
+        self.subscribers: List[Subscriber] = []  # in connection order; the first one is the primary viewer
+        self.latest: Optional[Frame] = None
+        self._frame_numbers = itertools.count()
+        self._subscriber_ids = itertools.count(1)
+
+    def subscribe(self, codec: str) -> Subscriber:
+        with self.condition:
+            subscriber = Subscriber(self, next(self._subscriber_ids), codec, self.slot_size)
+            self.subscribers.append(subscriber)
+            self.condition.notify_all()
+        logger.info(f"result feed: viewer #{subscriber.subscriber_id} connected with codec {codec} ({len(self.subscribers)} viewers)")
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        with self.condition:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+            self.condition.notify_all()  # the encoder may be waiting for this viewer
+        logger.info(f"result feed: viewer #{subscriber.subscriber_id} disconnected ({len(self.subscribers)} viewers)")
+
+    def codecs(self) -> Set[str]:
+        """Return the codecs used by the viewers, or the default codec if there are no viewers."""
+        with self.condition:
+            return {subscriber.codec for subscriber in self.subscribers} or {self.default_codec}
+
+    def needs_frame(self) -> bool:
+        """Return whether some viewer has no frame yet in its codec (e.g. it just connected with a new codec)."""
+        with self.condition:
+            if self.latest is None:
+                return True
+            return any(subscriber.current is None and not subscriber.frames for subscriber in self.subscribers)
+
+    def _previous_frame_sent(self) -> bool:
+        if self.latest is None:
+            return True
+        if not self.subscribers:
+            return False
+        targets = self.subscribers[:1] if self.backpressure == "primary" else self.subscribers
+        # A viewer that connected after the previous frame was encoded may not have it in its codec; it gets the next one.
+        return all(subscriber.last_sent_number >= self.latest.number
+                   for subscriber in targets if subscriber.codec in self.latest.data)
+
+    def publish(self, data: Dict[str, bytes], size: Tuple[int, int], timestamp: Optional[int],
+                cancelled: Callable[[], bool] = lambda: False) -> bool:
+        """Publish a new frame, encoded with one or more codecs (`{codec_name: encoded_bytes}`), to all viewers.
+
+        First block until the previous frame has been sent (see back-pressure in the module docstring),
+        or until `cancelled()` returns true (checked whenever the hub is notified; see `wake`).
+
+        Return whether the frame was published.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self._previous_frame_sent() or cancelled())
+            if cancelled():
+                return False
+            frame = Frame(next(self._frame_numbers), data, size, timestamp)
+            for subscriber in self.subscribers:
+                if subscriber.codec not in data:  # connected while this frame was being encoded
+                    continue
+                if len(subscriber.frames) == subscriber.frames.maxlen:
+                    subscriber.dropped += 1  # the deque drops the oldest frame
+                subscriber.frames.append(frame)
+            self.latest = frame
+            self.condition.notify_all()
+            return True
+
+    def wake(self) -> None:
+        """Wake up all waiting threads, e.g. to let them check for termination."""
+        with self.condition:
+            self.condition.notify_all()
+
+    def report(self) -> str:
+        """Return a one-line summary of the viewers, for logging."""
+        with self.condition:
+            subscribers = list(self.subscribers)
+        viewers = ", ".join(f"#{subscriber.subscriber_id} {subscriber.codec} {subscriber.fps():.1f} FPS ({subscriber.dropped} dropped)"
+                            for subscriber in subscribers)
+        return f"{len(subscribers)} viewers ({self.backpressure} back-pressure): {viewers}"
@@ -49,6 +49,11 @@ MaybeContained = Union[T, List[T], Dict[str, T]]
 
 VHS_GLITCH_BLANK = object()  # nonce value, see `analog_vhsglitches`
 
+# The [dynamic] filters, which animate even a stationary input image. See `Postprocessor.has_dynamic_filters`.
+dynamic_filters = {"alphanoise", "lumanoise",
+                   "analog_badhsync", "analog_distort", "analog_vhsglitches", "analog_vhstracking",
+                   "shift_distort", "banding", "scanlines"}
+
 class Postprocessor:
     """
     `chain`: Postprocessor filter chain configuration.
@@ -128,6 +133,20 @@ class Postprocessor:
         self.shift_distort_last_frame_no = defaultdict(lambda: 0.0)
         self.shift_distort_grid = defaultdict(lambda: None)
 
+    def has_dynamic_filters(self) -> bool:
+        """Return whether the current chain contains a [dynamic] filter.
+
+        If it doesn't, the output for a stationary input image is stationary, too, so the animator
+        does not need to re-render frames while the character pose stays the same.
+        """
+        chain = self.chain  # read just once; other threads might reassign it
+        for filter_name, settings in chain:
+            if filter_name == "scanlines" and not settings.get("dynamic", True):  # static scanlines
+                continue
+            if filter_name in dynamic_filters:
+                return True
+        return False
+
     def render_into(self, image):
         """Apply current postprocess chain, modifying `image` in-place."""
         time_render_start = time.time_ns()
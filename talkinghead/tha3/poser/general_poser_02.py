@@ -6,6 +6,7 @@ from torch.nn import Module
 
 from tha3.poser.poser import PoseParameterGroup, Poser
 from tha3.compute.cached_computation_func import TensorListCachedComputationFunc
+from tha3.compute.staged_cache import StagedCache
 
 
 class GeneralPoser02(Poser):
@@ -18,8 +19,10 @@ class GeneralPoser02(Poser):
                  subrect: Optional[Tuple[Tuple[int, int], Tuple[int, int]]] = None,
                  default_output_index: int = 0,
                  image_size: int = 256,
-                 dtype: torch.dtype = torch.float):
+                 dtype: torch.dtype = torch.float,
+                 staged_cache: Optional[StagedCache] = None):
         self.dtype = dtype
+        self.staged_cache = staged_cache
         self.image_size = image_size
         self.default_output_index = default_output_index
         self.output_list_func = output_list_func
@@ -83,3 +86,8 @@ class GeneralPoser02(Poser):
 
     def get_dtype(self) -> torch.dtype:
         return self.dtype
+
+    def get_cache_statistics(self) -> Dict[str, float]:
+        if self.staged_cache is None:
+            return {}
+        return self.staged_cache.get_statistics()
@@ -20,6 +20,7 @@ from tha3.poser.modes.pose_parameters import get_pose_parameters
 from tha3.util import torch_load
 from tha3.compute.cached_computation_func import TensorListCachedComputationFunc
 from tha3.compute.cached_computation_protocol import CachedComputationProtocol
+from tha3.compute.staged_cache import StagedCache
 from tha3.nn.nonlinearity_factory import ReLUFactory, LeakyReLUFactory
 from tha3.nn.normalization import InstanceNorm2dFactory
 from tha3.nn.util import BlockArgs
@@ -52,25 +53,27 @@ class FiveStepPoserComputationProtocol(CachedComputationProtocol):
     def __init__(self, eyebrow_morphed_image_index: int):
         super().__init__()
         self.eyebrow_morphed_image_index = eyebrow_morphed_image_index
-        self.cached_batch_0 = None
-        self.cached_eyebrow_decomposer_output = None
+        # Pose params consumed by each stage (a prefix of the pose vector).
+        num_face_pose_params = NUM_EYEBROW_PARAMS + NUM_FACE_PARAMS
+        num_pose_params = num_face_pose_params + NUM_ROTATION_PARAMS
+        self.staged_cache = StagedCache({
+            Network.eyebrow_decomposer.outputs_key: 0,
+            Network.eyebrow_morphing_combiner.outputs_key: NUM_EYEBROW_PARAMS,
+            Network.face_morpher.outputs_key: num_face_pose_params,
+            Branch.face_morphed_full.name: num_face_pose_params,
+            Branch.face_morphed_half.name: num_face_pose_params,
+            Network.two_algo_face_body_rotator.outputs_key: num_pose_params,
+            Network.editor.outputs_key: num_pose_params,
+            Branch.all_outputs.name: num_pose_params,
+        })
 
     def compute_func(self) -> TensorListCachedComputationFunc:
         def func(modules: Dict[str, Module],
                  batch: List[Tensor],
                  outputs: Dict[str, List[Tensor]]):
-            if self.cached_batch_0 is None:
-                new_batch_0 = True
-            elif batch[0].shape[0] != self.cached_batch_0.shape[0]:
-                new_batch_0 = True
-            else:
-                new_batch_0 = torch.max((batch[0] - self.cached_batch_0).abs()).item() > 0
-            if not new_batch_0:
-                outputs[Network.eyebrow_decomposer.outputs_key] = self.cached_eyebrow_decomposer_output
+            self.staged_cache.begin_frame(batch, outputs)
             output = self.get_output(Branch.all_outputs.name, modules, batch, outputs)
-            if new_batch_0:
-                self.cached_batch_0 = batch[0]
-                self.cached_eyebrow_decomposer_output = outputs[Network.eyebrow_decomposer.outputs_key]
+            self.staged_cache.end_frame(batch, outputs)
             return output
 
         return func
@@ -293,11 +296,13 @@ def create_poser(
         Network.editor.name:
             lambda: load_editor(module_file_names[Network.editor.name]),
     }
+    computation_protocol = FiveStepPoserComputationProtocol(eyebrow_morphed_image_index)
     return GeneralPoser02(
         image_size=512,
         module_loaders=loaders,
         pose_parameters=get_pose_parameters().get_pose_parameter_groups(),
-        output_list_func=FiveStepPoserComputationProtocol(eyebrow_morphed_image_index).compute_func(),
+        output_list_func=computation_protocol.compute_func(),
+        staged_cache=computation_protocol.staged_cache,
         subrect=None,
         device=device,
         output_length=29,
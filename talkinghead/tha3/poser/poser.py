@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
 from enum import Enum
-from typing import Tuple, List, Optional
+from typing import Dict, Tuple, List, Optional
 
 import torch
 from torch import Tensor
@@ -156,3 +156,7 @@ class Poser(ABC):
 
     def get_dtype(self) -> torch.dtype:
         return torch.float
+
+    def get_cache_statistics(self) -> Dict[str, float]:
+        """Return `{stage: hit_rate}` of the cached stages since the last call (empty if the poser caches nothing)."""
+        return {}